@@ -11,8 +11,10 @@ The last few IMFs can represent the general trend or envelope of the signal.
 import numpy as np
 import matplotlib.pyplot as plt
 from PyEMD import EMD
+from fast_emd import fast_emd_envelope, slow_modes, EMD_FAST, EMD_FAST_MIN_SAMPLES
 import sys
 import os
+from tracing import traced
 
 def load_signal(file_path):
     """
@@ -22,6 +24,7 @@ def load_signal(file_path):
     # For example, if the file contains a column of values
     return np.loadtxt(file_path)
 
+@traced('save_outputs')
 def save_results(t, noisy_signal, smooth_envelope, output_directory):
     """
     Saves the plot and the envelope data to the output directory.
@@ -41,6 +44,31 @@ def save_results(t, noisy_signal, smooth_envelope, output_directory):
 
     print(f"Results saved to {output_directory}")
 
+def run(input_file, output_dir):
+    """
+    Runs EMD on the input signal and saves the smooth envelope to the output directory.
+    """
+    # Load the signal
+    noisy_signal = load_signal(input_file)
+
+    # Simulate time axis (adjust based on actual sampling rate, etc.)
+    t = np.linspace(0, 10, len(noisy_signal))
+
+    if EMD_FAST and len(noisy_signal) >= EMD_FAST_MIN_SAMPLES:
+        # Long signals: about the same envelope from a decimated copy, see fast_emd
+        smooth_envelope = fast_emd_envelope(noisy_signal)
+    else:
+        # Apply EMD
+        emd = EMD()
+        IMFs = emd.emd(noisy_signal)
+
+        # Sum the low-frequency IMFs for a smooth envelope, selected by how slowly they oscillate
+        # (the last IMFs don't always hold the same modes, see fast_emd)
+        smooth_envelope = slow_modes(IMFs)
+
+    # Save the results (plot and data)
+    save_results(t, noisy_signal, smooth_envelope, output_dir)
+
 if __name__ == "__main__":
     import sys
 
@@ -56,19 +84,4 @@ if __name__ == "__main__":
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
 
-    # Load the signal
-    noisy_signal = load_signal(file_path)
-
-    # Simulate time axis (adjust based on actual sampling rate, etc.)
-    t = np.linspace(0, 10, len(noisy_signal))
-
-    # Apply EMD
-    emd = EMD()
-    IMFs = emd.emd(noisy_signal)
-
-    # Sum the low-frequency IMFs for a smooth envelope (e.g., the last few IMFs)
-    smooth_envelope = np.sum(IMFs[-2:], axis=0)
-
-    # Save the results (plot and data)
-    save_results(t, noisy_signal, smooth_envelope, output_directory)
-
+    run(file_path, output_directory)
@@ -1,5 +1,6 @@
 import numpy as np
-import librosa
+from pcm_cache import load_audio
+from tracing import traced
 import soundfile as sf
 import os
 import sys
@@ -19,7 +20,7 @@ def create_envelope_ema(signal, sr, alpha=0.1):
 # Full pipeline with plot saving
 def audio_processing_pipeline(input_file, output_dir, alpha=0.1):
     # Load the audio file
-    y, sr = librosa.load(input_file, sr=None)
+    y, sr = load_audio(input_file)
 
     # Stage 1: Create envelope using rectification and EMA
     envelope_signal = create_envelope_ema(y, sr, alpha)
@@ -30,6 +31,7 @@ def audio_processing_pipeline(input_file, output_dir, alpha=0.1):
     # Generate plots
     plot_and_save(time, y, envelope_signal, output_dir)
 
+@traced('save_outputs')
 def plot_and_save(time, original_signal, envelope_signal, output_dir):
     """Generate and save the 2 requested plots."""
     base_filename = "processed_audio"
@@ -54,6 +56,10 @@ def plot_and_save(time, original_signal, envelope_signal, output_dir):
     plt.savefig(os.path.join(output_dir, f'{base_filename}_comparison.png'))
     plt.close()
 
+# Uniform entry point used by the algorithm worker when running in-process
+def run(input_file, output_dir):
+    audio_processing_pipeline(input_file, output_dir)
+
 # Main script usage
 if __name__ == "__main__":
     file_path = sys.argv[1]
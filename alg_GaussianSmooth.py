@@ -1,6 +1,6 @@
 import numpy as np
 import matplotlib.pyplot as plt
-import librosa
+from pcm_cache import load_audio
 import os
 import sys
 from scipy.ndimage import gaussian_filter1d
@@ -14,7 +14,7 @@ def gaussian_envelope(signal, sigma=1):
 # Function to generate and save the envelope plots
 def plot_envelope(input_file, output_dir, sigma=5):
     # Load the audio file
-    signal, sr = librosa.load(input_file, sr=None)
+    signal, sr = load_audio(input_file)
     time = np.linspace(0, len(signal) / sr, len(signal))
 
     # Apply Gaussian smoothing to the envelope
@@ -49,6 +49,10 @@ def plot_envelope(input_file, output_dir, sigma=5):
     plt.savefig(os.path.join(output_dir, 'comparison_signal_gaussian.png'))
     plt.close()
 
+# Uniform entry point used by the algorithm worker when running in-process
+def run(input_file, output_dir):
+    plot_envelope(input_file, output_dir, sigma=5)
+
 # Main script usage with sys.argv inputs
 if __name__ == "__main__":
     if len(sys.argv) != 3:
@@ -1,26 +1,17 @@
 import numpy as np
-import librosa
+from pcm_cache import load_audio
+from tracing import traced
+from signal_batch import reuse
+from envelope import rectified_envelope
 import soundfile as sf
 import os
 import sys
 import matplotlib.pyplot as plt
-import pandas as pd
 
 # Stage 1: Rectify and smooth signal to create envelope
 def create_envelope(signal, sr, window_size_ms=50):
-    # Rectify the signal (take the absolute value)
-    rectified_signal = np.abs(signal)
-
-    # Convert to a Pandas Series to apply rolling window
-    rectified_series = pd.Series(rectified_signal)
-
-    # Calculate the rolling window size in samples
-    window_size = int(sr * window_size_ms / 1000)  # Convert ms to samples
-
-    # Apply rolling average (moving average) to smooth the rectified signal
-    smoothed_envelope = rectified_series.rolling(window=window_size, min_periods=1).mean().values
-
-    return smoothed_envelope
+    # Rectify the signal and smooth it with a rolling average (float32, as the signal)
+    return rectified_envelope(signal, sr, window_size_ms)
 
 # Stage 2: Scale the envelope based on the peak amplitude of the original signal
 def scale_envelope(original_signal, envelope_signal):
@@ -35,10 +26,11 @@ def scale_envelope(original_signal, envelope_signal):
 # Full pipeline with plot saving
 def audio_processing_pipeline(input_file, output_dir, window_size_ms=50):
     # Load the audio file
-    y, sr = librosa.load(input_file, sr=None)
+    y, sr = load_audio(input_file)
 
     # Stage 1: Create envelope using rectification and rolling average
-    envelope_signal = create_envelope(y, sr, window_size_ms)
+    # (shared with the other envelope algorithms of a batch task)
+    envelope_signal = reuse(('envelope', window_size_ms), y, lambda: create_envelope(y, sr, window_size_ms))
 
     # Stage 2: Scale the envelope to match the original signal's peak amplitude
     scaled_envelope_signal = scale_envelope(y, envelope_signal)
@@ -49,6 +41,7 @@ def audio_processing_pipeline(input_file, output_dir, window_size_ms=50):
     # Generate plots
     plot_and_save(time, y, scaled_envelope_signal, output_dir)
 
+@traced('save_outputs')
 def plot_and_save(time, original_signal, envelope_signal, output_dir):
     """Generate and save the 2 requested plots."""
     base_filename = "processed_audio"
@@ -73,6 +66,10 @@ def plot_and_save(time, original_signal, envelope_signal, output_dir):
     plt.savefig(os.path.join(output_dir, f'{base_filename}_comparison.png'))
     plt.close()
 
+# Uniform entry point used by the algorithm worker when running in-process
+def run(input_file, output_dir):
+    audio_processing_pipeline(input_file, output_dir)
+
 # Main script usage
 if __name__ == "__main__":
     file_path = sys.argv[1]
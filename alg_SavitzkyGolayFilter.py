@@ -12,6 +12,7 @@ from scipy.signal import savgol_filter
 import sys
 import os
 from scipy.io import wavfile
+from tracing import traced
 
 def load_wav_signal(file_path):
     """
@@ -21,6 +22,7 @@ def load_wav_signal(file_path):
     sample_rate, data = wavfile.read(file_path)
     return sample_rate, data
 
+@traced('save_outputs')
 def save_results(t, noisy_signal, smooth_envelope, output_directory):
     """
     Saves the plot and the smooth envelope data to the output directory.
@@ -40,21 +42,12 @@ def save_results(t, noisy_signal, smooth_envelope, output_directory):
 
     print(f"Results saved to {output_directory}")
 
-if __name__ == "__main__":
-    # Ensure correct number of arguments
-    if len(sys.argv) != 3:
-        print("Usage: python script.py <file_path> <output_directory>")
-        sys.exit(1)
-
-    file_path = sys.argv[1]
-    output_directory = sys.argv[2]
-
-    # Ensure the output directory exists
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-
+def run(input_file, output_dir):
+    """
+    Computes the Savitzky-Golay envelope of a WAV file and saves the results.
+    """
     # Load the signal from the WAV file
-    sample_rate, noisy_signal = load_wav_signal(file_path)
+    sample_rate, noisy_signal = load_wav_signal(input_file)
 
     # Simulate time axis based on sample rate
     t = np.linspace(0, len(noisy_signal) / sample_rate, len(noisy_signal))
@@ -68,4 +61,19 @@ if __name__ == "__main__":
     smooth_envelope = savgol_filter(positive_signal, window_length, poly_order)
 
     # Save the results (plot and data)
-    save_results(t, noisy_signal, smooth_envelope, output_directory)
+    save_results(t, noisy_signal, smooth_envelope, output_dir)
+
+if __name__ == "__main__":
+    # Ensure correct number of arguments
+    if len(sys.argv) != 3:
+        print("Usage: python script.py <file_path> <output_directory>")
+        sys.exit(1)
+
+    file_path = sys.argv[1]
+    output_directory = sys.argv[2]
+
+    # Ensure the output directory exists
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    run(file_path, output_directory)
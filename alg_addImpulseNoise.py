@@ -1,5 +1,6 @@
 import numpy as np
-import librosa
+from pcm_cache import load_audio
+from tracing import traced
 import soundfile as sf
 import os
 import sys
@@ -12,7 +13,7 @@ def generate_impulse_noise(size, num_impulses=500):
     return impulse_noise
 
 def run_add_impulse_noise(input_file, output_dir):
-    y, sr = librosa.load(input_file, sr=None)
+    y, sr = load_audio(input_file)
     impulse_noise = generate_impulse_noise(len(y)) * 0.01
     noisy_audio = y + impulse_noise
 
@@ -22,6 +23,7 @@ def run_add_impulse_noise(input_file, output_dir):
     time = np.linspace(0, len(y) / sr, len(y))
     plot_and_save(time, y, noisy_audio, 'impulse', output_dir)
 
+@traced('save_outputs')
 def plot_and_save(time, y, noisy_audio, noise_type, output_dir):
     plt.figure()
     plt.plot(time, y)
@@ -46,6 +48,10 @@ def plot_and_save(time, y, noisy_audio, noise_type, output_dir):
     plt.savefig(os.path.join(output_dir, f'comparison_signal_{noise_type}.png'))
     plt.close()
 
+# Uniform entry point used by the algorithm worker when running in-process
+def run(input_file, output_dir):
+    run_add_impulse_noise(input_file, output_dir)
+
 if __name__ == "__main__":
     file_path = sys.argv[1]
     output_directory = sys.argv[2]
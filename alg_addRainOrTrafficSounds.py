@@ -1,5 +1,6 @@
 import numpy as np
-import librosa
+from pcm_cache import load_audio
+from tracing import traced
 import soundfile as sf
 import os
 import sys
@@ -15,7 +16,7 @@ def adjust_noise_length(noise, target_length):
 
 def run_add_traffic_noise(input_file, output_dir, noise_file='traffic_noise.wav'):
     # Load the original audio file
-    y, sr = librosa.load(input_file, sr=None)
+    y, sr = load_audio(input_file)
     
     # Load the traffic noise
     noise_audio = AudioSegment.from_wav(noise_file)
@@ -40,6 +41,7 @@ def run_add_traffic_noise(input_file, output_dir, noise_file='traffic_noise.wav'
     # Generate plots
     plot_and_save(time, y, noisy_audio, 'traffic', output_dir)
 
+@traced('save_outputs')
 def plot_and_save(time, y, noisy_audio, noise_type, output_dir):
     """Generate and save plots for the original, noisy, and comparison signals."""
     plt.figure()
@@ -65,6 +67,10 @@ def plot_and_save(time, y, noisy_audio, noise_type, output_dir):
     plt.savefig(os.path.join(output_dir, f'comparison_signal_{noise_type}.png'))
     plt.close()
 
+# Uniform entry point used by the algorithm worker when running in-process
+def run(input_file, output_dir):
+    run_add_traffic_noise(input_file, output_dir)
+
 if __name__ == "__main__":
     file_path = sys.argv[1]
     output_directory = sys.argv[2]
@@ -1,5 +1,5 @@
 import numpy as np
-import librosa
+from pcm_cache import load_audio
 import soundfile as sf
 import os
 import sys
@@ -7,7 +7,7 @@ import matplotlib.pyplot as plt
 
 def run_add_white_noise(input_file, output_dir):
     # Load the original audio file
-    y, sr = librosa.load(input_file, sr=None)
+    y, sr = load_audio(input_file)
 
     # Generate white noise
     noise = np.random.normal(0, 0.01, y.shape)
@@ -51,6 +51,10 @@ def run_add_white_noise(input_file, output_dir):
     plt.savefig(os.path.join(output_dir, 'comparison_signal.png'))
     plt.close()
 
+# Uniform entry point used by the algorithm worker when running in-process
+def run(input_file, output_dir):
+    run_add_white_noise(input_file, output_dir)
+
 if __name__ == "__main__":
     file_path = sys.argv[1]
     output_directory = sys.argv[2]
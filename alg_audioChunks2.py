@@ -1,49 +1,31 @@
 import numpy as np
-import librosa
+from pcm_cache import load_audio
+from tracing import traced
+from signal_batch import reuse
+from envelope import rectified_envelope, rolling_mean, window_samples
+from segmentation import detect_audio_chunks as detect_chunks
 import soundfile as sf
 import os
 import sys
 import matplotlib.pyplot as plt
-import pandas as pd
 
 # Stage 1: Rectify and smooth signal to create envelope
 def create_envelope(signal, sr, window_size_ms=50):
-    rectified_signal = np.abs(signal)
-    rectified_series = pd.Series(rectified_signal)
-    window_size = int(sr * window_size_ms / 1000)  # Convert ms to samples
-    smoothed_envelope = rectified_series.rolling(window=window_size, min_periods=1).mean().values
-    return smoothed_envelope
+    return rectified_envelope(signal, sr, window_size_ms)
 
 # Stage 2: Apply multi-pass smoothing for cleaner envelope
 def multi_pass_smoothing(envelope_signal, sr, pass1_ms=50, pass2_ms=100, pass3_ms=150):
-    envelope_pass1 = create_envelope(envelope_signal, sr, pass1_ms)
-    envelope_pass2 = create_envelope(envelope_pass1, sr, pass2_ms)
-    envelope_pass3 = create_envelope(envelope_pass2, sr, pass3_ms)
-    return envelope_pass3
+    # One sweep, float64 for the slope comparisons of the chunk detector
+    windows = [window_samples(sr, pass1_ms), window_samples(sr, pass2_ms), window_samples(sr, pass3_ms)]
+    return rolling_mean(envelope_signal, windows, dtype=np.float64)
 
 # Stage 3: Detect audio chunks
 def detect_audio_chunks(envelope_signal, sr, threshold_percent=0.05, min_chunk_duration_ms=100):
-    max_value = np.max(envelope_signal)
-    threshold = threshold_percent * max_value
-    min_chunk_samples = int(sr * min_chunk_duration_ms / 1000)
-    
-    chunks = []
-    in_chunk = False
-    chunk_start = 0
-    
-    for i in range(10, len(envelope_signal) - 10):
-        if envelope_signal[i] > threshold:
-            if not in_chunk and np.all(np.diff(envelope_signal[i:i + 10]) > 0):
-                chunk_start = i
-                in_chunk = True
-            elif in_chunk and np.all(np.diff(envelope_signal[i:i + 10]) < 0):
-                chunk_end = i
-                if chunk_end - chunk_start >= min_chunk_samples:
-                    chunks.append((chunk_start, chunk_end))
-                in_chunk = False
-    return chunks
+    # Unpadded, the padding is applied when the chunks are saved
+    return detect_chunks(envelope_signal, sr, threshold_percent, min_chunk_duration_ms)
 
 # Stage 4: Extract audio chunks with separate start and end padding
+@traced('save_outputs')
 def save_audio_chunks(original_signal, chunks, sr, file_name, output_dir, start_padding_ms=400, end_padding_ms=1000):
     start_padding_samples = int(sr * start_padding_ms / 1000)
     end_padding_samples = int(sr * end_padding_ms / 1000)
@@ -72,11 +54,12 @@ def save_audio_chunks(original_signal, chunks, sr, file_name, output_dir, start_
 
 # Full pipeline
 def audio_processing_pipeline(input_file, output_dir, window_size_ms=50, threshold_percent=0.05, min_chunk_duration_ms=100, start_padding_ms=400, end_padding_ms=1000):
-    y, sr = librosa.load(input_file, sr=None)
+    y, sr = load_audio(input_file)
     file_name = os.path.splitext(os.path.basename(input_file))[0]
 
     # Stage 1: Create envelope using rectification and rolling average
-    envelope_signal = create_envelope(y, sr, window_size_ms)
+    # (shared with the other envelope algorithms of a batch task)
+    envelope_signal = reuse(('envelope', window_size_ms), y, lambda: create_envelope(y, sr, window_size_ms))
 
     # Stage 2: Apply multi-pass smoothing to create a smoother envelope
     smoothed_envelope_signal = multi_pass_smoothing(envelope_signal, sr)
@@ -87,6 +70,10 @@ def audio_processing_pipeline(input_file, output_dir, window_size_ms=50, thresho
     # Stage 4: Save audio chunks and plots with separate start and end padding
     save_audio_chunks(y, chunks, sr, file_name, output_dir, start_padding_ms, end_padding_ms)
 
+# Uniform entry point used by the algorithm worker when running in-process
+def run(input_file, output_dir):
+    audio_processing_pipeline(input_file, output_dir)
+
 # Main script usage
 if __name__ == "__main__":
     file_path = sys.argv[1]
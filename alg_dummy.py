@@ -3,6 +3,10 @@ def running_alg():
     print("In a dummy alg....")
     print("~*"*20)
 
+# Uniform entry point used by the algorithm worker when running in-process
+def run(input_file=None, output_dir=None):
+    running_alg()
+
 # Example usage
 if __name__ == "__main__":
     running_alg()
@@ -1,5 +1,6 @@
 import numpy as np
-import librosa
+from pcm_cache import load_audio
+from tracing import traced
 import soundfile as sf
 import os
 import sys
@@ -20,6 +21,7 @@ def compute_envelope_lowpass(signal, sr, cutoff=10):
     envelope = filtfilt(b, a, np.abs(signal))
     return envelope
 
+@traced('save_outputs')
 def plot_and_save(time, y, envelope_hilbert, envelope_lowpass, output_dir):
     """Generate and save plots for original and envelope signals."""
     # 1. Original Signal
@@ -65,15 +67,9 @@ def plot_and_save(time, y, envelope_hilbert, envelope_lowpass, output_dir):
     plt.savefig(os.path.join(output_dir, 'comparison_envelopes.png'))
     plt.close()
 
-if __name__ == "__main__":
-    file_path = sys.argv[1]
-    output_directory = sys.argv[2]
-
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-
+def run(input_file, output_dir):
     # Load audio file
-    y, sr = librosa.load(file_path, sr=None)
+    y, sr = load_audio(input_file)
 
     # Time array
     time = np.linspace(0, len(y) / sr, len(y))
@@ -83,4 +79,13 @@ if __name__ == "__main__":
     envelope_lowpass = compute_envelope_lowpass(y, sr)
 
     # Generate plots
-    plot_and_save(time, y, envelope_hilbert, envelope_lowpass, output_directory)
+    plot_and_save(time, y, envelope_hilbert, envelope_lowpass, output_dir)
+
+if __name__ == "__main__":
+    file_path = sys.argv[1]
+    output_directory = sys.argv[2]
+
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    run(file_path, output_directory)
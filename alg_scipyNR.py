@@ -1,11 +1,12 @@
 import numpy as np
-import librosa
+from pcm_cache import load_audio
+from tracing import traced
 import soundfile as sf
 import os
 import sys
 import matplotlib.pyplot as plt
 import noisereduce as nr
-import pandas as pd
+from envelope import rolling_mean, window_samples
 
 # Stage 1: Noise Reduction using Noisereduce
 def noise_reduction(signal, sr):
@@ -14,18 +15,13 @@ def noise_reduction(signal, sr):
 
 # Stage 2: Smoothing (can be tweaked as needed)
 def smoothed_signal(signal, sr, window_size_ms, iterations=1):
-    window_size = int(sr * window_size_ms / 1000)
-    signal_series = pd.Series(signal)
-    rectified = signal_series.abs()
-    smoothed = rectified
-    for _ in range(iterations):
-        smoothed = smoothed.rolling(window=window_size, min_periods=1).mean()
-    smoothed = smoothed.fillna(0).values
-    return smoothed
+    window_size = window_samples(sr, window_size_ms)
+    # Rectified, then iterations rolling averages in one sweep
+    return rolling_mean(signal, [window_size] * iterations, rectify=True)
 
 # Full pipeline with plot saving
 def audio_processing_pipeline(input_file, output_dir, window_size_ms=50):
-    y, sr = librosa.load(input_file, sr=None)
+    y, sr = load_audio(input_file)
 
     # Stage 1: Noise Reduction
     denoised_signal = noise_reduction(y, sr)
@@ -43,6 +39,7 @@ def audio_processing_pipeline(input_file, output_dir, window_size_ms=50):
     # Generate plots
     plot_and_save(time, y, denoised_signal, smoothed_signal_result, output_dir)
 
+@traced('save_outputs')
 def plot_and_save(time, original_signal, denoised_signal, smoothed_signal, output_dir):
     """Generate and save the 3 requested plots."""
     base_filename = "processed_audio"
@@ -76,6 +73,10 @@ def plot_and_save(time, original_signal, denoised_signal, smoothed_signal, outpu
     plt.savefig(os.path.join(output_dir, f'{base_filename}_comparison.png'))
     plt.close()
 
+# Uniform entry point used by the algorithm worker when running in-process
+def run(input_file, output_dir):
+    audio_processing_pipeline(input_file, output_dir)
+
 # Main script usage
 if __name__ == "__main__":
     file_path = sys.argv[1]
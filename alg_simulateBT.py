@@ -1,5 +1,6 @@
 import numpy as np
-import librosa
+from pcm_cache import load_audio
+from tracing import traced
 import soundfile as sf
 import os
 import sys
@@ -36,7 +37,7 @@ def add_microphone_noise(audio, noise_level=0.005):
 
 def run_bluetooth_quality_simulation(input_file, output_dir, lowcut=300, highcut=3400, noise_level=0.005, bitrate='16k'):
     # Load the original audio file
-    y, sr = librosa.load(input_file, sr=None)
+    y, sr = load_audio(input_file)
 
     # Apply bandpass filter to simulate Bluetooth's frequency range
     filtered_audio = apply_bandpass(y, sr, lowcut, highcut)
@@ -57,6 +58,7 @@ def run_bluetooth_quality_simulation(input_file, output_dir, lowcut=300, highcut
     # Generate plots
     plot_and_save(time, y, degraded_audio, 'bluetooth', output_dir)
 
+@traced('save_outputs')
 def plot_and_save(time, original_audio, degraded_audio, label, output_dir):
     """Generate and save plots for the original, degraded, and comparison signals."""
     plt.figure()
@@ -82,6 +84,10 @@ def plot_and_save(time, original_audio, degraded_audio, label, output_dir):
     plt.savefig(os.path.join(output_dir, f'comparison_signal_{label}.png'))
     plt.close()
 
+# Uniform entry point used by the algorithm worker when running in-process
+def run(input_file, output_dir):
+    run_bluetooth_quality_simulation(input_file, output_dir)
+
 if __name__ == "__main__":
     file_path = sys.argv[1]
     output_directory = sys.argv[2]
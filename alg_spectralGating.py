@@ -1,5 +1,9 @@
 import os
 import librosa
+from pcm_cache import load_audio, is_decoded
+from tracing import traced
+from stft_cache import stft as cached_stft, stft_db as cached_stft_db
+from streaming_stft import StreamingSTFT, use_streaming, spectrum_statistics, stream_process, amplitude_to_db, overview_db
 import numpy as np
 import soundfile as sf
 import matplotlib.pyplot as plt
@@ -12,8 +16,11 @@ from datetime import datetime
 def convert_to_wav(input_file):
     file_format = input_file.split('.')[-1].lower()
     if file_format in ['mp3', 'm4a']:
-        audio = AudioSegment.from_file(input_file, format=file_format)
         wav_file = input_file.replace(f".{file_format}", ".wav")
+        # Already decoded by the download worker or the batch, skip the pydub round trip
+        if is_decoded(input_file):
+            return wav_file
+        audio = AudioSegment.from_file(input_file, format=file_format)
         audio.export(wav_file, format="wav")
         return wav_file
     return input_file
@@ -23,12 +30,17 @@ def spectral_gating(input_file, output_dir, noise_threshold_db=-30):
     # Convert to WAV if needed
     wav_file = convert_to_wav(input_file)
     
-    # Load the audio file
-    y, sr = librosa.load(wav_file, sr=None)
+    # Load the audio file, reusing the already decoded signal when there is one
+    y, sr = load_audio(input_file if is_decoded(input_file) else wav_file)
+
+    # Long recordings are gated block by block instead of holding their whole spectrogram
+    if use_streaming(y, sr):
+        return spectral_gating_streaming(y, sr, input_file, wav_file, output_dir, noise_threshold_db)
 
     # Perform Short-Time Fourier Transform (STFT)
-    stft = librosa.stft(y)
-    stft_db = librosa.amplitude_to_db(np.abs(stft), ref=np.max)
+    # (from the STFT cache, shared with the plots and the other spectral algorithms run on the file)
+    stft = cached_stft(y)
+    stft_db = cached_stft_db(y)
 
     # Create a noise gate mask by thresholding
     mask = stft_db > noise_threshold_db
@@ -52,12 +64,39 @@ def spectral_gating(input_file, output_dir, noise_threshold_db=-30):
 
     return output_wav
 
+# Function to apply spectral gating to a long signal with bounded memory
+def spectral_gating_streaming(y, sr, input_file, wav_file, output_dir, noise_threshold_db):
+    engine = StreamingSTFT()
+
+    # First pass for the peak magnitude the dB spectrogram is relative to (ref=np.max)
+    peak, _ = spectrum_statistics(engine, y)
+
+    def gate(stft, first_frame):
+        return stft * (amplitude_to_db(stft, peak) > noise_threshold_db)
+
+    # Second pass, the gated signal is written as it is resynthesized
+    output_wav = os.path.join(output_dir, f"spectral_gating_{os.path.basename(wav_file)}")
+    with sf.SoundFile(output_wav, 'w', samplerate=sr, channels=1) as output:
+        overview = stream_process(engine, y, sr, gate, output.write)
+
+    save_overview_spectrograms(overview, sr, wav_file, output_dir)
+
+    if input_file != wav_file:
+        save_converted_format(input_file, output_wav, output_dir)
+
+    return output_wav
+
+# dB spectrogram of the original signal, computed once per file
+def original_spectrogram_db(original_audio):
+    return cached_stft_db(original_audio)
+
 # Function to save spectrograms
+@traced('save_outputs')
 def save_spectrograms(original_audio, processed_audio, sr, original_file, output_dir):
     # Plot original audio
     plt.figure(figsize=(10, 6))
     plt.subplot(3, 1, 1)
-    librosa.display.specshow(librosa.amplitude_to_db(np.abs(librosa.stft(original_audio)), ref=np.max), sr=sr, x_axis='time', y_axis='log')
+    librosa.display.specshow(original_spectrogram_db(original_audio), sr=sr, x_axis='time', y_axis='log')
     plt.colorbar(format='%+2.0f dB')
     plt.title('Original Spectrogram')
 
@@ -79,7 +118,35 @@ def save_spectrograms(original_audio, processed_audio, sr, original_file, output
     plt.savefig(output_img)
     plt.close()
 
+# Same figure as save_spectrograms from the overview of a streamed signal
+@traced('save_outputs')
+def save_overview_spectrograms(overview, sr, original_file, output_dir):
+    plt.figure(figsize=(10, 6))
+    plt.subplot(3, 1, 1)
+    librosa.display.specshow(overview_db(overview['input_spectrum']), sr=sr, hop_length=overview['hop_length'], x_axis='time', y_axis='log')
+    plt.colorbar(format='%+2.0f dB')
+    plt.title('Original Spectrogram')
+
+    # The gated spectra, before resynthesis
+    plt.subplot(3, 1, 2)
+    librosa.display.specshow(overview_db(overview['processed_spectrum']), sr=sr, hop_length=overview['hop_length'], x_axis='time', y_axis='log')
+    plt.colorbar(format='%+2.0f dB')
+    plt.title('Processed Spectrogram')
+
+    # Minimum and maximum of every column of samples
+    plt.subplot(3, 1, 3)
+    for (minima, maxima), label in ((overview['input_waveform'], 'Original'), (overview['output_waveform'], 'Processed')):
+        positions = np.arange(len(minima)) * overview['hop_length']
+        plt.fill_between(positions, minima, maxima, label=label, alpha=0.7)
+    plt.legend()
+    plt.title('Original vs Processed Audio')
+
+    output_img = os.path.join(output_dir, f"{os.path.basename(original_file).split('.')[0]}_spectrograms.png")
+    plt.savefig(output_img)
+    plt.close()
+
 # Function to save files in the original format
+@traced('save_outputs')
 def save_converted_format(original_file, processed_wav_file, output_dir):
     file_format = original_file.split('.')[-1].lower()
     if file_format in ['mp3', 'm4a']:
@@ -95,6 +162,10 @@ def run_spectral_gating_worker(input_file, output_dir):
     
     print(f"Processed file saved at: {output_wav}")
 
+# Uniform entry point used by the algorithm worker when running in-process
+def run(input_file, output_dir):
+    run_spectral_gating_worker(input_file, output_dir)
+
 # Example usage
 if __name__ == "__main__":
     file_path = sys.argv[1]
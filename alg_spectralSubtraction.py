@@ -1,5 +1,9 @@
 import os
 import librosa
+from pcm_cache import load_audio, is_decoded
+from tracing import traced
+from stft_cache import stft as cached_stft, stft_db as cached_stft_db
+from streaming_stft import StreamingSTFT, use_streaming, spectrum_statistics, stream_process, amplitude_to_db, db_to_amplitude, overview_db
 import numpy as np
 import soundfile as sf
 import matplotlib.pyplot as plt
@@ -10,8 +14,11 @@ import sys
 def convert_to_wav(input_file):
     file_format = input_file.split('.')[-1].lower()
     if file_format in ['mp3', 'm4a']:
-        audio = AudioSegment.from_file(input_file, format=file_format)
         wav_file = input_file.replace(f".{file_format}", ".wav")
+        # Already decoded by the download worker or the batch, skip the pydub round trip
+        if is_decoded(input_file):
+            return wav_file
+        audio = AudioSegment.from_file(input_file, format=file_format)
         audio.export(wav_file, format="wav")
         return wav_file
     return input_file
@@ -21,12 +28,17 @@ def spectral_subtraction(input_file, output_dir):
     # Convert to WAV if needed
     wav_file = convert_to_wav(input_file)
     
-    # Load the audio file
-    y, sr = librosa.load(wav_file, sr=None)
+    # Load the audio file, reusing the already decoded signal when there is one
+    y, sr = load_audio(input_file if is_decoded(input_file) else wav_file)
+
+    # Long recordings are processed block by block instead of holding their whole spectrogram
+    if use_streaming(y, sr):
+        return spectral_subtraction_streaming(y, sr, input_file, wav_file, output_dir)
 
     # Perform Short-Time Fourier Transform (STFT)
-    stft = librosa.stft(y)
-    stft_db = librosa.amplitude_to_db(np.abs(stft), ref=np.max)
+    # (from the STFT cache, shared with the plots and the other spectral algorithms run on the file)
+    stft = cached_stft(y)
+    stft_db = cached_stft_db(y)
 
     # Estimate noise spectrum from silent parts (noise floor)
     noise_estimation = np.mean(stft_db[:, :10], axis=1, keepdims=True)
@@ -52,11 +64,40 @@ def spectral_subtraction(input_file, output_dir):
 
     return output_wav
 
+# Function to apply spectral subtraction to a long signal with bounded memory
+def spectral_subtraction_streaming(y, sr, input_file, wav_file, output_dir):
+    engine = StreamingSTFT()
+
+    # First pass for the peak magnitude (ref=np.max) and the first 10 frames the noise is estimated from
+    peak, head = spectrum_statistics(engine, y, head_frames=10)
+    noise_estimation = np.mean(amplitude_to_db(head, peak), axis=1, keepdims=True)
+
+    def subtract(stft, first_frame):
+        stft_cleaned_db = np.maximum(amplitude_to_db(stft, peak) - noise_estimation, -80)
+        return db_to_amplitude(stft_cleaned_db)
+
+    # Second pass, the cleaned signal is written as it is resynthesized
+    output_wav = os.path.join(output_dir, f"processed_{os.path.basename(wav_file)}")
+    with sf.SoundFile(output_wav, 'w', samplerate=sr, channels=1) as output:
+        overview = stream_process(engine, y, sr, subtract, output.write)
+
+    save_overview_spectrograms(overview, sr, wav_file, output_dir)
+
+    if input_file != wav_file:
+        save_converted_format(input_file, output_wav, output_dir)
+
+    return output_wav
+
+# dB spectrogram of the original signal, computed once per file
+def original_spectrogram_db(original_audio):
+    return cached_stft_db(original_audio)
+
 # Function to save spectrograms separately
+@traced('save_outputs')
 def save_spectrograms(original_audio, processed_audio, sr, original_file, output_dir):
     # Save Original Spectrogram
     plt.figure(figsize=(10, 6))
-    librosa.display.specshow(librosa.amplitude_to_db(np.abs(librosa.stft(original_audio)), ref=np.max), sr=sr, x_axis='time', y_axis='log')
+    librosa.display.specshow(original_spectrogram_db(original_audio), sr=sr, x_axis='time', y_axis='log')
     plt.colorbar(format='%+2.0f dB')
     plt.title('Original Spectrogram')
     original_img = os.path.join(output_dir, f"{os.path.basename(original_file).split('.')[0]}_original_spectrogram.png")
@@ -84,7 +125,43 @@ def save_spectrograms(original_audio, processed_audio, sr, original_file, output
 
     print(f"Spectrograms saved: {original_img}, {processed_img}, {overlay_img}")
 
+# Same images as save_spectrograms from the overview of a streamed signal
+@traced('save_outputs')
+def save_overview_spectrograms(overview, sr, original_file, output_dir):
+    base_name = os.path.basename(original_file).split('.')[0]
+
+    plt.figure(figsize=(10, 6))
+    librosa.display.specshow(overview_db(overview['input_spectrum']), sr=sr, hop_length=overview['hop_length'], x_axis='time', y_axis='log')
+    plt.colorbar(format='%+2.0f dB')
+    plt.title('Original Spectrogram')
+    original_img = os.path.join(output_dir, f"{base_name}_original_spectrogram.png")
+    plt.savefig(original_img)
+    plt.close()
+
+    # The cleaned spectra, before resynthesis
+    plt.figure(figsize=(10, 6))
+    librosa.display.specshow(overview_db(overview['processed_spectrum']), sr=sr, hop_length=overview['hop_length'], x_axis='time', y_axis='log')
+    plt.colorbar(format='%+2.0f dB')
+    plt.title('Processed Spectrogram')
+    processed_img = os.path.join(output_dir, f"{base_name}_processed_spectrogram.png")
+    plt.savefig(processed_img)
+    plt.close()
+
+    # Minimum and maximum of every column of samples
+    plt.figure(figsize=(10, 6))
+    for (minima, maxima), label in ((overview['input_waveform'], 'Original'), (overview['output_waveform'], 'Processed')):
+        positions = np.arange(len(minima)) * overview['hop_length']
+        plt.fill_between(positions, minima, maxima, label=label, alpha=0.7)
+    plt.legend()
+    plt.title('Original vs Processed Waveform')
+    overlay_img = os.path.join(output_dir, f"{base_name}_overlay_waveform.png")
+    plt.savefig(overlay_img)
+    plt.close()
+
+    print(f"Spectrograms saved: {original_img}, {processed_img}, {overlay_img}")
+
 # Function to save files in the original format
+@traced('save_outputs')
 def save_converted_format(original_file, processed_wav_file, output_dir):
     file_format = original_file.split('.')[-1].lower()
     if file_format in ['mp3', 'm4a']:
@@ -103,6 +180,10 @@ def run_spectral_subtraction_worker(input_file, output_dir):
     
     print(f"Processed file saved at: {output_wav}")
 
+# Uniform entry point used by the algorithm worker when running in-process
+def run(input_file, output_dir):
+    run_spectral_subtraction_worker(input_file, output_dir)
+
 # Example usage
 if __name__ == "__main__":
     file_path = sys.argv[1]  # Input file path
@@ -39,6 +39,10 @@ def convert_and_split_audio(input_file, output_folder):
         chunk.export(output_path, format="wav")
         print(f"Exported {output_filename}")
 
+# Uniform entry point used by the algorithm worker when running in-process
+def run(input_file, output_dir):
+    convert_and_split_audio(input_file, output_dir)
+
 if __name__ == "__main__":
     file_path = sys.argv[1]  # Input file path
     output_directory = sys.argv[2]  # Output directory path
@@ -3,8 +3,12 @@ import numpy as np
 import matplotlib.pyplot as plt
 import soundfile as sf
 import librosa
+from pcm_cache import load_audio, is_decoded
+from tracing import traced
+from stft_cache import stft as cached_stft, stft_db as cached_stft_db
 import librosa.display
 from scipy.signal import wiener
+from segmented_wiener import segmented_wiener, WIENER_SEGMENT_MIN_SECONDS
 from pydub import AudioSegment
 import sys
 
@@ -12,8 +16,11 @@ import sys
 def convert_to_wav(input_file):
     file_format = input_file.split('.')[-1].lower()
     if file_format in ['mp3', 'm4a']:
-        audio = AudioSegment.from_file(input_file, format=file_format)
         wav_file = input_file.replace(f".{file_format}", ".wav")
+        # Already decoded by the download worker or the batch, skip the pydub round trip
+        if is_decoded(input_file):
+            return wav_file
+        audio = AudioSegment.from_file(input_file, format=file_format)
         audio.export(wav_file, format="wav")
         return wav_file
     return input_file
@@ -23,11 +30,14 @@ def wiener_filtering(input_file, output_dir):
     # Convert to WAV if needed
     wav_file = convert_to_wav(input_file)
     
-    # Load the audio file
-    y, sr = librosa.load(wav_file, sr=None)
+    # Load the audio file, reusing the already decoded signal when there is one
+    y, sr = load_audio(input_file if is_decoded(input_file) else wav_file)
     
-    # Apply the Wiener filter
-    filtered_signal = wiener(y)
+    # Apply the Wiener filter, long signals in segments on every core (same result)
+    if y.ndim == 1 and len(y) >= WIENER_SEGMENT_MIN_SECONDS * sr:
+        filtered_signal = segmented_wiener(y)
+    else:
+        filtered_signal = wiener(y)
     
     # Save the filtered audio
     output_wav = os.path.join(output_dir, f"wiener_filtered_{os.path.basename(wav_file)}")
@@ -42,14 +52,19 @@ def wiener_filtering(input_file, output_dir):
     
     return output_wav
 
+# dB spectrogram of the original signal, computed once per file
+def original_spectrogram_db(original_audio):
+    return cached_stft_db(original_audio)
+
 # Function to save spectrograms
+@traced('save_outputs')
 def save_spectrograms(original_audio, filtered_audio, sr, original_file, output_dir):
     # Spectrogram before noise removal
     plt.figure(figsize=(10, 6))
     
     # Original Spectrogram
     plt.subplot(3, 1, 1)
-    D_original = librosa.amplitude_to_db(np.abs(librosa.stft(original_audio)), ref=np.max)
+    D_original = original_spectrogram_db(original_audio)
     librosa.display.specshow(D_original, sr=sr, x_axis='time', y_axis='log')
     plt.colorbar(format='%+2.0f dB')
     plt.title('Original Spectrogram')
@@ -74,6 +89,7 @@ def save_spectrograms(original_audio, filtered_audio, sr, original_file, output_
     plt.close()
 
 # Function to save files in the original format
+@traced('save_outputs')
 def save_converted_format(original_file, processed_wav_file, output_dir):
     file_format = original_file.split('.')[-1].lower()
     if file_format in ['mp3', 'm4a']:
@@ -92,6 +108,10 @@ def run_wiener_filter_worker(input_file, output_dir):
     
     print(f"Processed file saved at: {output_wav}")
 
+# Uniform entry point used by the algorithm worker when running in-process
+def run(input_file, output_dir):
+    run_wiener_filter_worker(input_file, output_dir)
+
 # Example usage
 if __name__ == "__main__":
     file_path = sys.argv[1]  # Path of the input file passed as argument
@@ -4,13 +4,70 @@ import subprocess
 import logging
 import traceback
 import json
+import importlib
+import time
 from datetime import datetime
 import  sys
 
+# Algorithms draw their plots off-screen; this has to be set before matplotlib is imported
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+from alglist import alglist
+from pcm_cache import load_audio
+from signal_batch import batch_scope
+from worker_protocol import WorkerConnection
+from job_events import EventPublisher
+from output_uploader import OutputUploader, OUTPUT_BUCKET
+from metrics import counter, gauge, histogram, start_metrics_server, Utilisation, METRICS_WORKER_PORTS
+from tracing import activate, current, record_span, span, start_span
+
 # Configure logging
-logging.basicConfig(filename='algorithmworker.log', level=logging.INFO, 
+logging.basicConfig(filename='algorithmworker.log', level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s')
 
+# 'inprocess' imports each alg_* module once and keeps it warm across tasks,
+# 'subprocess' launches a fresh interpreter for every task
+ALGORITHM_WORKER_MODE = os.getenv('ALGORITHM_WORKER_MODE', 'inprocess')
+
+# Crash isolation for the in-process mode: the worker exits after this many tasks
+# (0 disables it) or after a failed task, and run_algo_wrkrs starts a fresh one
+MAX_TASKS_PER_WORKER = int(os.getenv('MAX_TASKS_PER_WORKER', '50'))
+RECYCLE_ON_ERROR = os.getenv('RECYCLE_ON_ERROR', '1') == '1'
+
+# Import every algorithm in alglist when the worker starts instead of on first use
+PRELOAD_ALGORITHMS = os.getenv('PRELOAD_ALGORITHMS', '1') == '1'
+
+# PUSH socket for the stage-completion events read by the Flask app, set up by algorithm_worker
+publisher = None
+
+# Uploads finished output directories to OUTPUT_BUCKET in the background, None when not configured
+uploader = None
+
+# How often (seconds) an idle worker reports output uploads that finished
+OUTPUT_POLL_INTERVAL = float(os.getenv('OUTPUT_POLL_INTERVAL', '0.5'))
+
+ALGORITHM_RUNS = counter('algorithm_runs_total', 'Algorithm runs finished', ['algorithm', 'status'])
+ALGORITHM_SECONDS = histogram('algorithm_seconds', 'Execution time of the algorithms', ['algorithm'])
+ALGORITHMS_RUNNING = gauge('algorithms_running', 'Algorithms being executed')
+OUTPUT_UPLOADS = counter('output_uploads_total', 'Output directories uploaded to S3', ['status'])
+OUTPUT_BYTES = counter('output_bytes_total', 'Bytes of outputs uploaded to S3')
+
+def create_uploader():
+    from dotenv import load_dotenv
+    from s3_manager import S3Manager
+
+    # Same credentials as the download workers
+    load_dotenv()
+    s3_manager = S3Manager(os.getenv('AWS_ACCESS_KEY_ID'), os.getenv('AWS_SECRET_ACCESS_KEY'), os.getenv('AWS_DEFAULT_REGION'))
+    return OutputUploader(s3_manager)
+
+def report_uploads():
+    for task, algorithm, result in uploader.drain():
+        OUTPUT_UPLOADS.inc(status=result['status'])
+        OUTPUT_BYTES.inc(result['bytes'])
+        publisher.publish(task, 'output', result.pop('started_at'), result.pop('finished_at'),
+                          status=result.pop('status'), algorithm=algorithm, **result)
+
 
 def create_algorithm_output_directory(algorithm, directory):
     # Get the current date and time as a string
@@ -33,47 +90,209 @@ def create_algorithm_output_directory(algorithm, directory):
             logging.info(f"Directory already exists: {out_path}")
     except Exception as e:
         logging.error(f"Failed to create directory {out_path}: {e}")
-    
+
     return out_path
 
+def algorithm_exists(algorithm):
+    # Only alg_* scripts from the working directory can be run
+    return algorithm.startswith("alg_") and os.path.exists(algorithm + ".py")
+
+def load_algorithm(algorithm):
+    # importlib keeps the module in sys.modules, so the import cost is paid once per worker
+    return importlib.import_module(algorithm)
+
+def preload_algorithms():
+    for algorithm in alglist:
+        if not algorithm_exists(algorithm):
+            continue
+        try:
+            load_algorithm(algorithm)
+            logging.info(f"Worker {os.getpid()} preloaded {algorithm}")
+        except Exception:
+            logging.warning(f"Worker {os.getpid()} could not preload {algorithm}", exc_info=True)
+
 def algorithm_worker():
+    global publisher, uploader
+
     print(f"This is an algorithm worker .... on PID: {os.getpid()} ready for processing")
     context = zmq.Context()
 
-    # DEALER socket to receive tasks from algorithm router
-    receiver = context.socket(zmq.DEALER)
-    receiver.connect("tcp://localhost:5560")  # Connect to algorithm router
+    # DEALER connection to receive tasks from algorithm router, one task at a time
+    receiver = WorkerConnection(context, "tcp://localhost:5560")  # Connect to algorithm router
+
+    logging.info(f"Worker {os.getpid()} connected to ROUTER on port 5560 in {ALGORITHM_WORKER_MODE} mode.")
+
+    publisher = EventPublisher(context)
+
+    if OUTPUT_BUCKET:
+        uploader = create_uploader()
+        logging.info(f"Worker {os.getpid()} uploads outputs to s3://{OUTPUT_BUCKET}")
+
+    if ALGORITHM_WORKER_MODE == 'inprocess' and PRELOAD_ALGORITHMS:
+        preload_algorithms()
+
+    # Execution times and utilisation, scraped by the Flask app
+    utilisation = Utilisation('algorithm')
+    start_metrics_server(METRICS_WORKER_PORTS)
+
+    tasks_done = 0
 
-    logging.info(f"Worker {os.getpid()} connected to ROUTER on port 5560.")
-    
     while True:
+        # Nothing taken yet this iteration, the error log and the READY credit depend on it
+        task = None
+        message = None
         try:
 
-            message = receiver.recv_multipart()
-            
+            # Wake up regularly while outputs are uploading, to report them when done
+            waiting_uploads = uploader is not None and uploader.has_pending()
+            message = receiver.recv_task(timeout=OUTPUT_POLL_INTERVAL if waiting_uploads else None)
+            if uploader is not None:
+                report_uploads()
+            if message is None:
+                continue
+            received_at = time.time()
+            utilisation.busy()
+
             # The first part is the routing ID, second part is the task (JSON)
             routing_id = message[0]
             task_data = message[1].decode('utf-8')  # Decode the second part to get the JSON string
-        
+
             task = json.loads(task_data)
 
+            # Time the task spent in the algorithm router
+            trace = task.get('trace')
+            record_span('queue.algorithm_router', trace, trace and trace.get('sent_at'), received_at)
 
             file_path = task['file']
-            algorithm = task['algorithm']
 
-            logging.info(f"Worker {os.getpid()} processing {file_path} with {algorithm}")
-            print(f"Worker {os.getpid()} processing {file_path} with {algorithm}")
+            if 'algorithms' in task:
+                # Batch task: one file with all of its algorithms
+                algorithms = task['algorithms']
+                logging.info(f"Worker {os.getpid()} processing {file_path} with batch {algorithms}")
+                print(f"Worker {os.getpid()} processing {file_path} with batch {algorithms}")
+
+                succeeded = run_algorithm_batch(task, algorithms)
+                tasks_done += len(algorithms)
+            else:
+                algorithm = task['algorithm']
+
+                logging.info(f"Worker {os.getpid()} processing {file_path} with {algorithm}")
+                print(f"Worker {os.getpid()} processing {file_path} with {algorithm}")
+
 
+                # Run the algorithm on the file
+                succeeded = run_algorithm(task, algorithm)
+                tasks_done += 1
 
-            # Run the algorithm on the file
-            run_algorithm(algorithm, file_path)
+            if ALGORITHM_WORKER_MODE == 'inprocess':
+                if not succeeded and RECYCLE_ON_ERROR:
+                    logging.info(f"Worker {os.getpid()} recycling after a failed task")
+                    break
+                if MAX_TASKS_PER_WORKER and tasks_done >= MAX_TASKS_PER_WORKER:
+                    logging.info(f"Worker {os.getpid()} recycling after {tasks_done} tasks")
+                    break
 
         except Exception as e:
             logging.error(f"Error in worker {os.getpid()} while processing task: {task}", exc_info=True)
             traceback.print_exc()
 
-def run_algorithm(algorithm, file_path):
+        # Ask the router for the next task, only when this iteration took one from it
+        if message is not None:
+            utilisation.idle()
+            receiver.task_done()
+
+    if uploader is not None:
+        # Outputs still being uploaded are finished before the worker exits
+        uploader.close()
+        report_uploads()
+
+    receiver.close()
+    publisher.close()
+    context.term()
+
+def run_reported(task, algorithm, runner):
+    # Runs one algorithm of the task and publishes its completion event
+    started_at = time.time()
+    ALGORITHMS_RUNNING.inc()
+    # Inside a batch the algorithm is a child of the batch span, otherwise of the download
+    algorithm_span = start_span('algorithm', None if current() else task.get('trace'),
+                                algorithm=algorithm, mode=ALGORITHM_WORKER_MODE)
+    try:
+        with activate(algorithm_span):
+            succeeded, out_path = runner(algorithm, task['file'])
+    finally:
+        ALGORITHMS_RUNNING.dec()
+    finished_at = time.time()
+    status = 'ok' if succeeded else 'error'
+    algorithm_span.end(status=status, end=finished_at)
+    ALGORITHM_RUNS.inc(algorithm=algorithm, status=status)
+    ALGORITHM_SECONDS.observe(finished_at - started_at, algorithm=algorithm)
+    publisher.publish(task, 'algorithm', started_at, finished_at, status=status,
+                      algorithm=algorithm, mode=ALGORITHM_WORKER_MODE)
+
+    # Send the outputs to S3 without waiting for the transfer
+    if succeeded and out_path and uploader is not None:
+        uploader.submit(dict(task, trace=algorithm_span.context()), algorithm, out_path)
+    return succeeded
+
+def run_algorithm(task, algorithm):
+    if ALGORITHM_WORKER_MODE == 'inprocess':
+        return run_reported(task, algorithm, run_algorithm_inprocess)
+    return run_reported(task, algorithm, run_algorithm_subprocess)
+
+def run_algorithm_batch(task, algorithms):
+    # The algorithms of a batch share one parent span
+    with span('batch', task.get('trace'), algorithms=algorithms):
+        return run_batch_algorithms(task, algorithms)
+
+def run_batch_algorithms(task, algorithms):
+    file_path = task['file']
+
+    if ALGORITHM_WORKER_MODE != 'inprocess':
+        # Separate interpreters can't share the signal, just run the algorithms back to back
+        return all([run_reported(task, algorithm, run_algorithm_subprocess) for algorithm in algorithms])
+
+    try:
+        # Load the signal once; the algorithms get it back from load_audio
+        y, sr = load_audio(file_path)
+    except Exception:
+        logging.warning(f"Could not load {file_path} for the batch, algorithms will load it themselves", exc_info=True)
+        return all([run_reported(task, algorithm, run_algorithm_inprocess) for algorithm in algorithms])
+
+    with batch_scope(file_path, y, sr):
+        return all([run_reported(task, algorithm, run_algorithm_inprocess) for algorithm in algorithms])
+
+def run_algorithm_inprocess(algorithm, file_path):
+    # Returns whether the algorithm succeeded and its output directory
+    logging.info(f"Running algorithm {algorithm} on {file_path} in-process")
+    out_path = None
+    try:
+        if algorithm_exists(algorithm):
+            # Extract the directory path from the filename
+            directory = os.path.dirname(file_path)
+            out_path = create_algorithm_output_directory(algorithm, directory)
+            print(f"out path: {out_path}")
+
+            load_algorithm(algorithm).run(file_path, out_path)
+        else:
+            print(f"Algorithm implementatiom for {algorithm} does not exists. running dummy")
+            load_algorithm("alg_dummy").run(file_path)
+
+        logging.info(f"Algorithm {algorithm} executed on {file_path}")
+        print(f"Algorithm {algorithm} executed on {file_path}")
+        return True, out_path
+    except Exception as e:
+        logging.error(f"Error in worker {os.getpid()} while trying to run the algorithm: {algorithm}", exc_info=True)
+        traceback.print_exc()
+        return False, out_path
+    finally:
+        # Don't leak figures left open by an algorithm into the next task
+        if 'matplotlib.pyplot' in sys.modules:
+            sys.modules['matplotlib.pyplot'].close('all')
+
+def run_algorithm_subprocess(algorithm, file_path):
     logging.info(f"Running algorithm {algorithm} on {file_path}")
+    out_path = None
     try:
         # Check if the file doesn't already have the .py extension
         if not algorithm.endswith(".py"):
@@ -89,13 +308,8 @@ def run_algorithm(algorithm, file_path):
             print(f"Directory {file_path}")
             sys.stdout.flush()  # Force the buffer to flush
 
-
-
             out_path = create_algorithm_output_directory(algorithm, directory)
-            print("~o"*20)
-            print(f"out path: {out_path}")
-            print("~o"*20)
-
+            logging.info(f"Output path of {algorithm}: {out_path}")
 
             result = subprocess.run(
                 ["python", algorithm_file, file_path, out_path],
@@ -116,9 +330,11 @@ def run_algorithm(algorithm, file_path):
         print(f"Algorithm {algorithm} executed on {file_path}, result: {result.stdout}")
         if result.stderr:
             logging.error(f"Algorithm {algorithm} executed with errors. Stderr: {result.stderr}")
+        return result.returncode == 0, out_path
     except Exception as e:
         logging.error(f"Error in worker {os.getpid()} while trying to run the algorithm: {algorithm}", exc_info=True)
         traceback.print_exc()
+        return False, out_path
 
 if __name__ == "__main__":
     algorithm_worker()
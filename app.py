@@ -1,8 +1,14 @@
 from flask import Flask, render_template, jsonify, request, url_for, session, redirect
-from s3_manager import S3Manager
+from s3_manager import S3Manager, TransferProgress, DIRECT_UPLOADS
+from multipart_stream import MultipartReader, parse_boundary
 from alglist import alglist
+from job_events import JobIndex, start_results_listener
+from submission_client import SubmissionClient
+from metrics import counter, gauge, aggregate
+from tracing import new_trace, start_span
 import zmq
 import json
+import uuid
 
 
 
@@ -25,6 +31,18 @@ flask_session_key = os.getenv('FLASK_SESSION_KEY')
 
 app = Flask(__name__)
 
+# Progress of submitted jobs, fed by the events the workers publish
+job_index = JobIndex()
+
+# Pooled DEALER sockets to the download router, shared by all requests
+submission_client = SubmissionClient()
+
+# Progress of running uploads by the upload ID chosen by the client
+upload_progress = {}
+
+TASKS_SUBMITTED = counter('tasks_submitted_total', 'Download tasks sent to the download router', ['status'])
+JOBS = gauge('jobs', 'Jobs in the job index', ['state'])
+
 # Set a secret key for session management
 app.secret_key = flask_session_key
 
@@ -60,8 +78,8 @@ def list_buckets():
     else:
         return jsonify({'error': 'Unable to list buckets'}), 500
     
-@app.route('/list_files', methods=['GET'])
-def list_files():
+@app.route('/list_files_page', methods=['GET'])
+def list_files_page():
     global s3_manager
 
     bucket_name = request.args.get('bucket')  # Get the bucket name from the query parameters
@@ -69,23 +87,21 @@ def list_files():
         return jsonify({'error': 'Bucket name is required'}), 400
 
     try:
-        # Call the s3_manager to list files in the bucket
-        files = s3_manager.list_files(bucket_name)
-        
-        # If files exist, return them; otherwise, return an empty list
-        if files is not None:
-            if len(files) > 0:
-                return jsonify({'files': files}), 200  # Return the list of files
-            else:
-                return jsonify({'files': []}), 200  # Return an empty list if no files found
-        else:
-            return jsonify({'error': f'Unable to retrieve files from bucket: {bucket_name}'}), 500
+        max_keys = int(request.args.get('max_keys', 1000))
+    except ValueError:
+        return jsonify({'error': 'max_keys must be a number'}), 400
+
+    page = s3_manager.list_files_page(
+        bucket_name,
+        prefix=request.args.get('prefix', ''),
+        delimiter=request.args.get('delimiter', ''),
+        continuation_token=request.args.get('continuation_token'),
+        max_keys=max_keys
+    )
+    if page is None:
+        return jsonify({'error': f'Unable to retrieve files from bucket: {bucket_name}'}), 500
+    return jsonify(page), 200
 
-    except Exception as e:
-        # Catch any unexpected errors and return a 500 response
-        print(f"Error listing files in bucket {bucket_name}: {e}")
-        return jsonify({'error': 'An error occurred while retrieving files'}), 500
-    
 @app.route('/create_bucket', methods=['POST'])
 def create_bucket():
     global s3_manager
@@ -125,38 +141,149 @@ def delete_files():
     data = request.get_json()
     bucket_name = data.get('bucket_name')
     files_to_delete = data.get('files', [])
+    prefix = data.get('prefix')
 
     if not bucket_name:
         return jsonify({'error': 'Bucket name is required'}), 400
 
-    if len(files_to_delete) == 0:
+    if len(files_to_delete) == 0 and not prefix:
         return jsonify({'error': 'No files specified for deletion'}), 400
 
-    success = s3_manager.delete_files(bucket_name, files_to_delete)
-    if success:
-        return jsonify({'message': 'Files deleted successfully'}), 200
+    if prefix:
+        # Everything under the prefix, e.g. the outputs of a processed batch
+        result = s3_manager.delete_prefix(bucket_name, prefix)
     else:
+        result = s3_manager.delete_files(bucket_name, files_to_delete)
+
+    if result is None:
         return jsonify({'error': 'Failed to delete files'}), 500
+    elif result['errors']:
+        return jsonify({'error': f"Failed to delete {len(result['errors'])} files", **result}), 500
+    else:
+        return jsonify({'message': 'Files deleted successfully', **result}), 200
     
 @app.route('/upload_files', methods=['POST'])
 def upload_files():
     global s3_manager
 
-    bucket_name = request.form['bucket_name']
-    files = request.files.getlist('files')
-
-    if not bucket_name:
+    # The body is read part by part from the request stream and every file is sent to S3 as it
+    # arrives; request.form/request.files would first spool the whole body on the app server.
+    # The client sends bucket_name, upload_id and sizes before the files, and uploads several
+    # files in parallel as one request each (the files of a request are sent one after the other).
+    fields = {}
+    results = []
+    progress = None
+    try:
+        reader = MultipartReader(request.stream, parse_boundary(request.content_type))
+        for part in reader.parts():
+            if part.filename is None:
+                fields[part.name] = MultipartReader.read_field(part)
+                continue
+            if part.name != 'files' or not part.filename:
+                continue
+
+            if progress is None:
+                if not fields.get('bucket_name'):
+                    return jsonify({'error': 'Bucket name is required'}), 400
+                # The client can follow the transfer to S3 on /upload_progress/<upload_id>
+                upload_id = fields.get('upload_id') or uuid.uuid4().hex
+                progress = upload_progress[upload_id] = TransferProgress()
+                sizes = json.loads(fields.get('sizes') or '{}')
+
+            results.append(s3_manager.upload_stream(fields['bucket_name'], part.filename, part,
+                                                    sizes.get(part.filename), progress))
+    except ValueError as e:
+        # A malformed body (MultipartError) or sizes field
+        return jsonify({'error': str(e), 'files': results}), 400
+    finally:
+        if progress is not None:
+            upload_progress.pop(upload_id, None)
+
+    if not fields.get('bucket_name'):
         return jsonify({'error': 'Bucket name is required'}), 400
 
-    if len(files) == 0:
+    if len(results) == 0:
         return jsonify({'error': 'No files selected for upload'}), 400
 
-    success = s3_manager.upload_files(bucket_name, files)
+    s3_manager.uploads_finished(fields['bucket_name'], results)
+
+    if all(result['status'] == 'uploaded' for result in results):
+        return jsonify({'message': 'Files uploaded successfully', 'files': results}), 200
+    else:
+        return jsonify({'error': 'Failed to upload files', 'files': results}), 500
+
+@app.route('/upload_progress/<upload_id>', methods=['GET'])
+def get_upload_progress(upload_id):
+    progress = upload_progress.get(upload_id)
+    if progress is None:
+        return jsonify({'error': f'No running upload {upload_id}'}), 404
+    return jsonify({'files': progress.snapshot()}), 200
+
+# Tells the client whether to upload straight to S3 or through /upload_files
+@app.route('/upload_config', methods=['GET'])
+def upload_config():
+    return jsonify({'direct_uploads': DIRECT_UPLOADS}), 200
+
+# Direct uploads: the browser sends the parts straight to S3 on presigned URLs
+@app.route('/multipart_upload/initiate', methods=['POST'])
+def initiate_multipart_upload():
+    global s3_manager
+
+    if not DIRECT_UPLOADS:
+        # Without a CORS rule for the app the browser's part uploads would be blocked
+        return jsonify({'error': 'Direct uploads are disabled, use /upload_files', 'direct_uploads': False}), 409
+
+    data = request.get_json()
+    bucket_name = data.get('bucket_name')
+    file_name = data.get('file_name')
+    size = data.get('size')
+
+    if not bucket_name or not file_name or size is None:
+        return jsonify({'error': 'Bucket name, file name and size are required'}), 400
+
+    upload = s3_manager.create_multipart_upload(bucket_name, file_name, int(size), data.get('content_type'))
+    if upload:
+        return jsonify(upload), 200
+    else:
+        return jsonify({'error': f'Failed to start the upload of {file_name}'}), 500
+
+@app.route('/multipart_upload/complete', methods=['POST'])
+def complete_multipart_upload():
+    global s3_manager
+
+    data = request.get_json()
+    bucket_name = data.get('bucket_name')
+    file_name = data.get('file_name')
+    upload_id = data.get('upload_id')
+    parts = data.get('parts', [])
+
+    if not bucket_name or not file_name or not upload_id or len(parts) == 0:
+        return jsonify({'error': 'Bucket name, file name, upload ID and parts are required'}), 400
+
+    success = s3_manager.complete_multipart_upload(bucket_name, file_name, upload_id, parts)
     if success:
-        return jsonify({'message': 'Files uploaded successfully'}), 200
+        return jsonify({'message': f'File {file_name} uploaded successfully'}), 200
     else:
-        return jsonify({'error': 'Failed to upload files'}), 500
-    
+        return jsonify({'error': f'Failed to complete the upload of {file_name}'}), 500
+
+@app.route('/multipart_upload/abort', methods=['POST'])
+def abort_multipart_upload():
+    global s3_manager
+
+    data = request.get_json()
+    bucket_name = data.get('bucket_name')
+    file_name = data.get('file_name')
+    upload_id = data.get('upload_id')
+
+    if not bucket_name or not file_name or not upload_id:
+        return jsonify({'error': 'Bucket name, file name and upload ID are required'}), 400
+
+    success = s3_manager.abort_multipart_upload(bucket_name, file_name, upload_id)
+    if success:
+        return jsonify({'message': f'Upload of {file_name} aborted'}), 200
+    else:
+        return jsonify({'error': f'Failed to abort the upload of {file_name}'}), 500
+
 @app.route('/generate_presigned_url', methods=['POST'])
 def generate_presigned_url():
     global s3_manager
@@ -167,12 +294,8 @@ def generate_presigned_url():
     if not bucket_name or not files:
         return jsonify({'error': 'Bucket name and files are required'}), 400
 
-    presigned_urls = []
-
-    for file_name in files:
-        url = s3_manager.generate_presigned_url(bucket_name, file_name)
-        if url:
-            presigned_urls.append({'file_name': file_name, 'url': url})
+    # Signed in one batch, reusing the URLs of recently requested files
+    presigned_urls = s3_manager.generate_presigned_urls(bucket_name, files)
 
     return jsonify({'presigned_urls': presigned_urls}), 200
 
@@ -246,10 +369,6 @@ def process_data():
 def process_data():
     data = request.get_json()  # Get the dictionary from the frontend
 
-    context = zmq.Context()
-    socket = context.socket(zmq.DEALER)  # Dealer to forword to router
-    socket.connect("tcp://localhost:5557")  # Connect to Dealer socket for workers
-
     selected_files = data.get('files', {})
     selected_algorithms = data.get('algorithms', [])
 
@@ -257,40 +376,80 @@ def process_data():
     print("Selected Files:", selected_files)
     print("Selected Algorithms:", selected_algorithms)
 
+    # Every task of this submission carries the job ID, so worker events can be matched to it
+    job_id = uuid.uuid4().hex
+    job_index.register(job_id, selected_files, selected_algorithms)
+
     tasks = []
+    spans = []
 
    # Iterate over each bucket and its files
     for bucket, files in selected_files.items():
         for file in files:
+            # Every file gets its own trace, the workers add their spans to it
+            span = start_span('submit', new_trace(), job_id=job_id, bucket=bucket, key=file)
             # Create a task for each file with all selected algorithms
             task = {
+                'job_id': job_id,
                 'bucket': bucket,
                 'file': file,
-                'algorithms': selected_algorithms  # Pass the entire list of algorithms
+                'algorithms': selected_algorithms,  # Pass the entire list of algorithms
+                'trace': span.context()
             }
+            tasks.append(task)
+            spans.append((span, task))
 
-            # Log the task and its type for debugging
-            task_json = json.dumps(task)
-            print(f"Sending task: {task_json}, Type: {type(task_json)}")
+    print("Generated Tasks:", tasks)
 
-            try:
-                # Send the task in non-blocking mode
-                socket.send_string(task_json, zmq.NOBLOCK)
-            except zmq.ZMQError as e:
-                print(f"Could not send task due to: {e}")
+    # Send the whole submission to the download router without blocking
+    try:
+        failed = submission_client.submit(tasks)
+    except zmq.ZMQError as e:
+        print(f"Could not send tasks due to: {e}")
+        failed = tasks
 
-            # Add task to list for tracking (if needed)
-            tasks.append(task)
+    TASKS_SUBMITTED.inc(len(tasks) - len(failed), status='ok')
+    TASKS_SUBMITTED.inc(len(failed), status='error')
 
-    print("Generated Tasks:", tasks)
+    for span, task in spans:
+        span.end(status='error' if task in failed else 'ok')
+
+    if failed:
+        return jsonify({'error': f'Could not queue {len(failed)} of {len(tasks)} tasks', 'status': 'error',
+                        'job_id': job_id}), 503
 
     # Send a response back to the frontend
-    return jsonify({'message': 'Processing initiated', 'status': 'success'})
+    return jsonify({'message': 'Processing initiated', 'status': 'success', 'job_id': job_id,
+                    'status_url': url_for('job_status', job_id=job_id)})
+
+@app.route('/job_status/<job_id>', methods=['GET'])
+def job_status(job_id):
+    status = job_index.status(job_id)
+    if status is None:
+        return jsonify({'error': f'Unknown job {job_id}'}), 404
+    return jsonify(status), 200
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify({'jobs': job_index.list_jobs()}), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Metrics of this app followed by the sum of the routers' and workers' metrics
+    states = [job['state'] for job in job_index.list_jobs()]
+    for state in ('queued', 'running', 'done', 'failed'):
+        JOBS.set(states.count(state), state=state)
+    return aggregate(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 if __name__ == '__main__':
 
     # Pass environment variables to S3Manager
     s3_manager = S3Manager(aws_access_key, aws_secret_key, aws_region)
 
+    # Receive the stage-completion events of the workers
+    start_results_listener(job_index)
+
     #app.run(debug=True)
-    app.run(debug=False, threaded=False)
+    # Threaded, so status and progress requests are answered while an upload or listing runs
+    app.run(debug=False, threaded=True)
     
\ No newline at end of file
@@ -0,0 +1,412 @@
+"""
+Micro-benchmark of the alg_* scripts registered in alglist.
+
+Every algorithm runs on generated signals of each duration and sample rate, one case per
+fresh interpreter, the way an in-process algorithm worker runs a task. Wall time, CPU time
+and peak RSS are split into three phases:
+
+    io        loading the input and writing outputs (load_audio, soundfile, wavfile, pydub, np.savetxt ...)
+    plotting  matplotlib.pyplot and librosa.display calls, including savefig
+    compute   everything else run() does
+
+    python benchmarks/algorithm_benchmark.py --durations 10s,1m --rates 16000,44100 \
+        --algorithms alg_audioChunks,alg_EMD --output algorithms.json
+
+The inputs get a PCM cache like the download workers write, unless --no-pcm-cache is given
+to include decoding in the io phase. With --baseline the results are printed next to a
+previous output, and the exit code is 1 when a case got slower than --tolerance allows.
+"""
+import os
+import sys
+import json
+import time
+import wave
+import shutil
+import inspect
+import argparse
+import platform
+import tempfile
+import functools
+import importlib
+import threading
+import subprocess
+import numpy as np
+
+from pipeline_benchmark import REPO_DIR, synthetic_signal, rss_bytes
+
+PHASES = ('compute', 'plotting', 'io')
+
+# Algorithms that can't read a WAV file get their input in this format
+INPUT_FORMATS = {
+    'alg_EMD': 'csv',
+    'alg_splitAndConvert': 'm4a'
+}
+
+# Samples generated and written at a time, so an hour at 48 kHz doesn't have to fit in memory
+BLOCK_SECONDS = 60
+
+
+class PhaseClock:
+    """
+    Bills wall time, CPU time and RSS peaks to the phase of the innermost instrumented call.
+    """
+    def __init__(self, sample_interval=0.01):
+        self.lock = threading.Lock()
+        self.sample_interval = sample_interval
+        self.stack = ['compute']
+        self.wall = dict.fromkeys(PHASES, 0.0)
+        self.cpu = dict.fromkeys(PHASES, 0.0)
+        self.peak_rss = dict.fromkeys(PHASES, 0)
+        self.calls = dict.fromkeys(PHASES, 0)
+        self.running = False
+        self.last_wall = self.last_cpu = 0.0
+
+    def bill(self):
+        now_wall, now_cpu = time.perf_counter(), time.process_time()
+        phase = self.stack[-1]
+        self.wall[phase] += now_wall - self.last_wall
+        self.cpu[phase] += now_cpu - self.last_cpu
+        self.last_wall, self.last_cpu = now_wall, now_cpu
+        self.peak_rss[phase] = max(self.peak_rss[phase], rss_bytes(os.getpid()))
+
+    def enter(self, phase):
+        with self.lock:
+            if self.running:
+                self.bill()
+                self.calls[phase] += 1
+            self.stack.append(phase)
+
+    def leave(self):
+        with self.lock:
+            if self.running:
+                self.bill()
+            self.stack.pop()
+
+    def sample(self):
+        # Peaks in the middle of a long call are only seen by the sampler
+        while self.running:
+            rss = rss_bytes(os.getpid())
+            with self.lock:
+                phase = self.stack[-1]
+                self.peak_rss[phase] = max(self.peak_rss[phase], rss)
+            time.sleep(self.sample_interval)
+
+    def start(self):
+        self.last_wall, self.last_cpu = time.perf_counter(), time.process_time()
+        self.running = True
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        with self.lock:
+            self.bill()
+            self.running = False
+        self.sampler.join()
+
+    def wrap(self, function, phase):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            self.enter(phase)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.leave()
+        return wrapper
+
+
+def instrumented_calls():
+    """
+    (owner, attribute, phase) of the calls billed to plotting and io.
+    """
+    calls = []
+
+    import matplotlib.pyplot as plt
+    for name, value in vars(plt).items():
+        if inspect.isfunction(value) and value.__module__ == 'matplotlib.pyplot' and not name.startswith('_'):
+            calls.append((plt, name, 'plotting'))
+
+    try:
+        import librosa.display
+        for name, value in vars(librosa.display).items():
+            if inspect.isfunction(value) and value.__module__ == 'librosa.display' and not name.startswith('_'):
+                calls.append((librosa.display, name, 'plotting'))
+    except ImportError:
+        pass
+
+    # pcm_cache.load_audio has to be wrapped before the algorithms import it by name
+    import pcm_cache
+    calls += [(pcm_cache, 'load_audio', 'io'), (np, 'loadtxt', 'io'), (np, 'savetxt', 'io'),
+              (np, 'load', 'io'), (np, 'save', 'io')]
+
+    optional = [
+        ('soundfile', None, ['read', 'write']),
+        ('scipy.io.wavfile', None, ['read', 'write']),
+        ('librosa', None, ['load']),
+        ('pandas', None, ['read_csv']),
+        ('pandas', 'DataFrame', ['to_csv']),
+        ('pydub', 'AudioSegment', ['from_file', 'from_wav', 'export'])
+    ]
+    for module_name, class_name, names in optional:
+        try:
+            owner = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        if class_name:
+            owner = getattr(owner, class_name)
+        calls += [(owner, name, 'io') for name in names]
+    return calls
+
+
+def instrument(clock):
+    for owner, name, phase in instrumented_calls():
+        if isinstance(owner, type) and isinstance(inspect.getattr_static(owner, name), classmethod):
+            # Wrap the bound class method, calls through the class keep working
+            setattr(owner, name, staticmethod(clock.wrap(getattr(owner, name), phase)))
+        else:
+            setattr(owner, name, clock.wrap(getattr(owner, name), phase))
+
+
+def peak_process_rss():
+    try:
+        import resource
+        # Kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        return None
+
+
+def run_case(algorithm, input_path, out_dir):
+    """
+    Runs one algorithm in this process and returns its measurements.
+    """
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    clock = PhaseClock()
+    instrument(clock)
+
+    started_at = time.perf_counter()
+    module = importlib.import_module(algorithm)
+    import_seconds = time.perf_counter() - started_at
+    rss_before = rss_bytes(os.getpid())
+
+    error = None
+    clock.start()
+    try:
+        module.run(input_path, out_dir)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        clock.stop()
+
+    output_bytes = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(out_dir) for name in names)
+    peak = peak_process_rss()
+    return {
+        'status': 'error' if error else 'ok',
+        'error': error,
+        'import_seconds': import_seconds,
+        'wall': dict(clock.wall, total=sum(clock.wall.values())),
+        'cpu': dict(clock.cpu, total=sum(clock.cpu.values())),
+        'calls': clock.calls,
+        'rss_before_mb': rss_before / 1024 ** 2,
+        'peak_rss_mb': dict({phase: clock.peak_rss[phase] / 1024 ** 2 for phase in PHASES},
+                            process=peak / 1024 ** 2 if peak else None),
+        'output_bytes': output_bytes
+    }
+
+
+def signal_blocks(duration, sample_rate, seed):
+    rng = np.random.default_rng(seed)
+    total = int(duration * sample_rate)
+    block = BLOCK_SECONDS * sample_rate
+    for start in range(0, total, block):
+        yield synthetic_signal(np.arange(start, min(start + block, total)) / sample_rate, rng)
+
+
+def write_input(path, input_format, duration, sample_rate, seed=0):
+    if input_format == 'csv':
+        # One value per line, what np.loadtxt reads back
+        with open(path, 'w') as f:
+            for block in signal_blocks(duration, sample_rate, seed):
+                np.savetxt(f, block, fmt='%.6f')
+        return
+
+    wav_path = path if input_format == 'wav' else path + '.wav'
+    with wave.open(wav_path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        for block in signal_blocks(duration, sample_rate, seed):
+            f.writeframes((block * 32767).astype('<i2').tobytes())
+
+    if input_format == 'm4a':
+        from pydub import AudioSegment
+        # 'ipod' is ffmpeg's name for the m4a container
+        AudioSegment.from_wav(wav_path).export(path, format='ipod')
+        os.remove(wav_path)
+
+
+def prepare_input(work_dir, input_format, duration, sample_rate, pcm_cache):
+    path = os.path.join(work_dir, f"signal_{duration}s_{sample_rate}Hz.{input_format}")
+    if not os.path.exists(path):
+        write_input(path, input_format, duration, sample_rate)
+        if pcm_cache and input_format != 'csv':
+            from pcm_cache import write_pcm_cache
+            write_pcm_cache(path)
+    return path
+
+
+def benchmark(algorithm, input_path, timeout):
+    """
+    Runs one case in a fresh interpreter, so imports and memory of other cases don't leak into it.
+    """
+    with tempfile.TemporaryDirectory(prefix='algorithm_benchmark_out_') as out_dir:
+        result_path = os.path.join(out_dir, 'result.json')
+        case_dir = os.path.join(out_dir, 'output')
+        os.makedirs(case_dir)
+        command = [sys.executable, os.path.abspath(__file__), '--case', algorithm, input_path, case_dir, result_path]
+        try:
+            process = subprocess.run(command, cwd=REPO_DIR, env=dict(os.environ, MPLBACKEND='Agg'),
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return {'status': 'timeout', 'error': f"Did not finish within {timeout}s"}
+
+        if not os.path.exists(result_path):
+            stderr = process.stderr.decode('utf-8', 'replace').strip().splitlines()
+            return {'status': 'crashed', 'error': stderr[-1] if stderr else f"exit code {process.returncode}"}
+        with open(result_path) as f:
+            return json.load(f)
+
+
+def case_key(case):
+    return case['algorithm'], case['sample_rate'], case['duration']
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    previous = {case_key(case): case for case in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        before = previous.get(case_key(case))
+        if before is None or before['status'] != 'ok' or case['status'] != 'ok':
+            continue
+        case['baseline_wall'] = before['wall']['total']
+        change = case['wall']['total'] / before['wall']['total'] - 1 if before['wall']['total'] else 0
+        case['wall_change'] = change
+        if change > tolerance:
+            regressions.append(case_key(case))
+    return regressions
+
+
+def print_table(cases):
+    header = (f"{'algorithm':<30} {'rate':>6} {'length':>7} {'status':>8} {'wall s':>9} {'cpu s':>9} "
+              f"{'compute':>9} {'plotting':>9} {'io':>9} {'peak MB':>8} {'baseline':>9} {'change':>7}")
+    print(header)
+    print('-' * len(header))
+    for case in cases:
+        line = f"{case['algorithm']:<30} {case['sample_rate']:>6} {format_duration(case['duration']):>7} {case['status']:>8}"
+        if case['status'] == 'ok':
+            wall = case['wall']
+            line += (f" {wall['total']:>9.3f} {case['cpu']['total']:>9.3f} {wall['compute']:>9.3f} "
+                     f"{wall['plotting']:>9.3f} {wall['io']:>9.3f} {max(case['peak_rss_mb'][phase] for phase in PHASES):>8.0f}")
+            if 'baseline_wall' in case:
+                line += f" {case['baseline_wall']:>9.3f} {case['wall_change']:>+7.0%}"
+        else:
+            line += f"  {case['error']}"
+        print(line)
+
+
+def parse_duration(value):
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    if value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def format_duration(seconds):
+    for unit, size in (('h', 3600), ('m', 60)):
+        if seconds >= size and seconds % size == 0:
+            return f"{seconds // size}{unit}"
+    return f"{seconds}s"
+
+
+def registered_algorithms():
+    from alglist import alglist
+    # Only alg_* scripts can be run, the other entries are placeholders
+    return [algorithm for algorithm in alglist
+            if algorithm.startswith('alg_') and os.path.exists(os.path.join(REPO_DIR, algorithm + '.py'))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--algorithms', type=lambda value: value.split(','), help='default: every alg_* in alglist')
+    parser.add_argument('--durations', type=lambda value: [parse_duration(item) for item in value.split(',')],
+                        default=[10, 60, 600, 3600], help='signal lengths, e.g. 10s,1m,10m,1h')
+    parser.add_argument('--rates', type=lambda value: [int(item) for item in value.split(',')],
+                        default=[16000, 44100, 48000], help='sample rates in Hz')
+    parser.add_argument('--timeout', type=float, default=1800, help='seconds per case')
+    parser.add_argument('--no-pcm-cache', dest='pcm_cache', action='store_false',
+                        help='make load_audio decode the file, as without a download worker in front')
+    parser.add_argument('--work-dir', help='keep the generated signals here instead of a temporary directory')
+    parser.add_argument('--output', default='algorithm_benchmark.json')
+    parser.add_argument('--baseline', help='previous output to compare the wall times against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed wall time increase against the baseline')
+    args = parser.parse_args()
+
+    algorithms = args.algorithms or registered_algorithms()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='algorithm_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'pcm_cache': args.pcm_cache
+        },
+        'cases': []
+    }
+
+    try:
+        # Short signals first, the numbers that come quickly are the ones to look at first
+        for duration in args.durations:
+            for sample_rate in args.rates:
+                for algorithm in algorithms:
+                    input_format = INPUT_FORMATS.get(algorithm, 'wav')
+                    case = {'algorithm': algorithm, 'sample_rate': sample_rate, 'duration': duration, 'input_format': input_format}
+                    print(f"{algorithm} on {format_duration(duration)} at {sample_rate} Hz ...", flush=True)
+                    try:
+                        input_path = prepare_input(work_dir, input_format, duration, sample_rate, args.pcm_cache)
+                    except Exception as e:
+                        case.update(status='error', error=f"Could not generate the {input_format} input: {e}")
+                    else:
+                        case.update(benchmark(algorithm, input_path, args.timeout))
+                    results['cases'].append(case)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    regressions = compare(results, os.path.abspath(args.baseline), args.tolerance) if args.baseline else []
+    results['regressions'] = regressions
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print()
+    print_table(results['cases'])
+    print(f"\nResults written to {args.output}")
+    for algorithm, sample_rate, duration in regressions:
+        print(f"Regression: {algorithm} on {format_duration(duration)} at {sample_rate} Hz")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 6 and sys.argv[1] == '--case':
+        # Child process of benchmark(): algorithm, input, output directory, result file
+        _, _, algorithm, input_path, out_dir, result_path = sys.argv
+        result = run_case(algorithm, input_path, out_dir)
+        with open(result_path, 'w') as f:
+            json.dump(result, f)
+    else:
+        main()
@@ -0,0 +1,196 @@
+import re
+import time
+import hashlib
+import threading
+from urllib.parse import urlsplit, parse_qs, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from email.utils import formatdate
+from xml.sax.saxutils import escape
+
+# In-memory stand-in for the part of the S3 REST API the pipeline uses (path-style
+# addressing): HEAD/GET with If-Match and Range, PUT, DELETE and multipart uploads.
+# Point S3Manager at it with S3_ENDPOINT_URL; requests are not authenticated.
+
+
+class LocalS3:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.objects = {}  # (bucket, key) -> (data, etag, last_modified)
+        self.uploads = {}  # upload id -> {part number: data}
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'bytes_sent': 0, 'bytes_received': 0}
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='local-s3', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def put_object(self, bucket, key, data):
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        with self.lock:
+            self.objects[(bucket, key)] = (data, etag, time.time())
+        return etag
+
+    def get_object(self, bucket, key):
+        with self.lock:
+            return self.objects.get((bucket, key))
+
+    def handler_class(self):
+        s3 = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def parse(self):
+                parts = urlsplit(self.path)
+                bucket, _, key = parts.path.lstrip('/').partition('/')
+                query = {name: values[0] for name, values in parse_qs(parts.query, keep_blank_values=True).items()}
+                with s3.lock:
+                    s3.stats['requests'] += 1
+                return unquote(bucket), unquote(key), query
+
+            def read_body(self):
+                if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                    body = decode_chunked(self.rfile)
+                else:
+                    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if 'aws-chunked' in self.headers.get('Content-Encoding', '') or 'x-amz-decoded-content-length' in self.headers:
+                    body = decode_aws_chunked(body)
+                with s3.lock:
+                    s3.stats['bytes_received'] += len(body)
+                return body
+
+            def reply(self, status, body=b'', headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+                    with s3.lock:
+                        s3.stats['bytes_sent'] += len(body)
+
+            def error(self, status, code):
+                body = f"<Error><Code>{code}</Code><Message>{code}</Message></Error>".encode()
+                self.reply(status, body, {'Content-Type': 'application/xml'})
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                bucket, key, _ = self.parse()
+                obj = s3.get_object(bucket, key)
+                if obj is None:
+                    return self.error(404, 'NoSuchKey')
+                data, etag, last_modified = obj
+
+                if_match = self.headers.get('If-Match')
+                if if_match and if_match != etag:
+                    return self.error(412, 'PreconditionFailed')
+
+                headers = {'ETag': etag, 'Last-Modified': formatdate(last_modified, usegmt=True),
+                           'Content-Type': 'application/octet-stream', 'Accept-Ranges': 'bytes'}
+
+                match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+                if match:
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+                    headers['Content-Range'] = f"bytes {start}-{end}/{len(data)}"
+                    return self.reply(206, data[start:end + 1], headers)
+
+                if self.command == 'HEAD':
+                    # Content-Length of the object, without a body
+                    self.send_response(200)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    return
+                self.reply(200, data, headers)
+
+            def do_PUT(self):
+                bucket, key, query = self.parse()
+                body = self.read_body()
+                if 'uploadId' in query:
+                    with s3.lock:
+                        parts = s3.uploads.get(query['uploadId'])
+                        if parts is None:
+                            return self.error(404, 'NoSuchUpload')
+                        parts[int(query['partNumber'])] = body
+                    return self.reply(200, headers={'ETag': f'"{hashlib.md5(body).hexdigest()}"'})
+                self.reply(200, headers={'ETag': s3.put_object(bucket, key, body)})
+
+            def do_POST(self):
+                bucket, key, query = self.parse()
+                self.read_body()
+                if 'uploads' in query:
+                    upload_id = hashlib.md5(f"{bucket}/{key}/{time.time()}".encode()).hexdigest()
+                    with s3.lock:
+                        s3.uploads[upload_id] = {}
+                    body = (f"<InitiateMultipartUploadResult><Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>"
+                            f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>")
+                    return self.reply(200, body.encode(), {'Content-Type': 'application/xml'})
+                if 'uploadId' in query:
+                    with s3.lock:
+                        parts = s3.uploads.pop(query['uploadId'], None)
+                    if parts is None:
+                        return self.error(404, 'NoSuchUpload')
+                    etag = s3.put_object(bucket, key, b''.join(parts[number] for number in sorted(parts)))
+                    body = (f"<CompleteMultipartUploadResult><Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>"
+                            f"<ETag>{escape(etag)}</ETag></CompleteMultipartUploadResult>")
+                    return self.reply(200, body.encode(), {'Content-Type': 'application/xml'})
+                self.error(400, 'InvalidRequest')
+
+            def do_DELETE(self):
+                bucket, key, query = self.parse()
+                with s3.lock:
+                    if 'uploadId' in query:
+                        s3.uploads.pop(query['uploadId'], None)
+                    else:
+                        s3.objects.pop((bucket, key), None)
+                self.reply(204)
+
+        return Handler
+
+
+def decode_chunked(stream):
+    # HTTP/1.1 chunked transfer encoding
+    body = b''
+    while True:
+        size = int(stream.readline().split(b';')[0].strip(), 16)
+        if size == 0:
+            # Trailers end with an empty line
+            while stream.readline().strip():
+                pass
+            return body
+        body += stream.read(size)
+        stream.readline()
+
+
+def decode_aws_chunked(body):
+    # Chunked payload with optional signatures and checksum trailers, sent by newer botocore versions
+    data = []
+    position = 0
+    while True:
+        line_end = body.index(b'\r\n', position)
+        size = int(body[position:line_end].split(b';')[0], 16)
+        position = line_end + 2
+        if size == 0:
+            return b''.join(data)
+        data.append(body[position:position + size])
+        position += size + 2
@@ -0,0 +1,361 @@
+"""
+End-to-end throughput benchmark of the processing pipeline.
+
+Starts the whole topology locally (both routers, download workers and algorithm workers)
+against an in-process S3 stand-in holding a synthetic audio corpus, submits the corpus
+through the Flask /process_data handler and follows the job through the worker events.
+For every combination of worker counts and file durations it reports files/s, per-stage
+p50/p95/p99 latencies and peak memory as JSON.
+
+    python benchmarks/pipeline_benchmark.py --algorithm-workers 1,2,4 --durations 10,60 \
+        --files 20 --algorithms alg_MovingAverage --output results.json
+
+With --baseline, runs whose files/s dropped by more than --tolerance compared to the
+same run in a previous output are reported and the exit code is 1.
+
+The pipeline uses fixed ports (5557-5561), so nothing else of it may run meanwhile.
+"""
+import os
+import sys
+import io
+import json
+import time
+import wave
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from local_s3 import LocalS3
+
+PIPELINE_PORTS = [5557, 5558, 5559, 5560, 5561]
+BUCKET = 'benchmark'
+SAMPLE_RATE = 44100
+
+
+def synthetic_signal(t, rng):
+    """
+    A chirp with bursts of noise at the times t (seconds), so segmenters and filters have work to do.
+    The chirp restarts every 10 s, long signals look like a series of short ones.
+    """
+    sweep = t % 10
+    signal = 0.3 * np.sin(2 * np.pi * (200 + 50 * sweep) * sweep)
+    bursts = (np.sin(2 * np.pi * 0.5 * t) > 0.7) * rng.normal(0, 0.3, t.size)
+    return np.clip(signal + bursts + rng.normal(0, 0.02, t.size), -1, 1)
+
+
+def synthetic_wav(duration, seed, sample_rate=SAMPLE_RATE):
+    """
+    Mono 16-bit WAV of synthetic_signal.
+    """
+    rng = np.random.default_rng(seed)
+    signal = synthetic_signal(np.arange(int(duration * sample_rate)) / sample_rate, rng)
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes((signal * 32767).astype('<i2').tobytes())
+    return buffer.getvalue()
+
+
+def port_in_use(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        return s.connect_ex(('localhost', port)) == 0
+
+
+def rss_bytes(pid):
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except ImportError:
+        pass
+    except Exception:
+        return 0
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class MemorySampler:
+    """
+    Samples the summed RSS of each group of processes and keeps the peaks.
+    """
+    def __init__(self, groups, interval=0.2):
+        self.groups = groups  # name -> list of Popen
+        self.interval = interval
+        self.peaks = {name: 0 for name in groups}
+        self.peaks['total'] = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while self.running:
+            total = 0
+            for name, processes in self.groups.items():
+                rss = sum(rss_bytes(process.pid) for process in processes if process.poll() is None)
+                self.peaks[name] = max(self.peaks[name], rss)
+                total += rss
+            self.peaks['total'] = max(self.peaks['total'], total)
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = np.asarray(values)
+    return {
+        'count': int(values.size),
+        'mean': float(values.mean()),
+        'p50': float(np.percentile(values, 50)),
+        'p95': float(np.percentile(values, 95)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(values.max())
+    }
+
+
+def stage_latencies(status):
+    stages = {'download_queue': [], 'download': [], 'algorithm_queue': [], 'algorithm': [], 'end_to_end': []}
+    for entry in status['file_status']:
+        download = entry['download']
+        if download is None:
+            continue
+        stages['download_queue'].append(download['started_at'] - status['submitted_at'])
+        stages['download'].append(download['duration'])
+        runs = list(entry['algorithms'].values())
+        for run in runs:
+            stages['algorithm_queue'].append(run['started_at'] - download['finished_at'])
+            stages['algorithm'].append(run['duration'])
+        if runs:
+            stages['end_to_end'].append(max(run['finished_at'] for run in runs) - status['submitted_at'])
+    return {stage: percentiles(values) for stage, values in stages.items()}
+
+
+class Topology:
+    """
+    Both routers plus the requested number of download and algorithm workers, as subprocesses.
+    """
+    def __init__(self, download_workers, algorithm_workers, env, log_dir):
+        self.env = env
+        self.log_dir = log_dir
+        self.groups = {'routers': [], 'download_workers': [], 'algorithm_workers': []}
+        self.counts = {'download_workers': download_workers, 'algorithm_workers': algorithm_workers}
+
+    def spawn(self, group, script):
+        log_path = os.path.join(self.log_dir, f"{group}_{len(self.groups[group])}.log")
+        with open(log_path, 'w') as log:
+            process = subprocess.Popen([sys.executable, script], cwd=REPO_DIR, env=self.env,
+                                       stdout=log, stderr=subprocess.STDOUT)
+        process.log_path = log_path
+        self.groups[group].append(process)
+
+    def start(self):
+        self.spawn('routers', 'router_for_download_workers.py')
+        self.spawn('routers', 'router_for_algorithm_workers.py')
+        time.sleep(0.5)
+        for _ in range(self.counts['download_workers']):
+            self.spawn('download_workers', 'download_worker.py')
+        for _ in range(self.counts['algorithm_workers']):
+            self.spawn('algorithm_workers', 'algorithm_worker.py')
+
+    def check(self):
+        for group, processes in self.groups.items():
+            for process in processes:
+                if process.poll() is not None:
+                    # The work directory is removed with the run, show the end of the log now
+                    with open(process.log_path) as log:
+                        tail = ''.join(log.readlines()[-20:])
+                    raise RuntimeError(f"A process of {group} exited with code {process.returncode}:\n{tail}")
+
+    def stop(self):
+        processes = [process for group in self.groups.values() for process in group]
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def run_point(webapp, s3, args, download_workers, algorithm_workers, duration, corpus_seed):
+    with tempfile.TemporaryDirectory(prefix='pipeline_benchmark_') as work_dir:
+        # Fresh download directory and cache, every run starts cold
+        env = dict(os.environ,
+                   S3_ENDPOINT_URL=s3.url,
+                   AWS_ACCESS_KEY_ID='benchmark', AWS_SECRET_ACCESS_KEY='benchmark', AWS_DEFAULT_REGION='us-east-1',
+                   AWS_REQUEST_CHECKSUM_CALCULATION='when_required',
+                   SHARED_DOWNLOAD_DIR=work_dir, DOWNLOAD_CACHE_DIR=os.path.join(work_dir, 'cache'),
+                   MAX_TASKS_PER_WORKER='0', RECYCLE_ON_ERROR='0', MPLBACKEND='Agg')
+        env.pop('OUTPUT_BUCKET', None)
+
+        keys = []
+        for i in range(args.files):
+            key = f"corpus/{duration}s/run{corpus_seed}_{i:04d}.wav"
+            s3.put_object(BUCKET, key, synthetic_wav(duration, seed=corpus_seed * 100000 + i))
+            keys.append(key)
+
+        topology = Topology(download_workers, algorithm_workers, env, work_dir)
+        topology.start()
+        try:
+            # Workers import the algorithms and announce themselves to the routers
+            time.sleep(args.warmup)
+            topology.check()
+
+            with MemorySampler(topology.groups) as memory:
+                response = webapp.app.test_client().post('/process_data', json={
+                    'files': {BUCKET: keys},
+                    'algorithms': args.algorithms
+                })
+                if response.status_code != 200:
+                    raise RuntimeError(f"process_data failed: {response.get_json()}")
+                job_id = response.get_json()['job_id']
+
+                deadline = time.time() + args.timeout
+                while True:
+                    status = webapp.job_index.status(job_id)
+                    if status['state'] in ('done', 'failed'):
+                        break
+                    if time.time() > deadline:
+                        raise RuntimeError(f"Timed out after {args.timeout}s: {status['runs_completed']}/{status['runs_expected']} runs")
+                    topology.check()
+                    time.sleep(0.2)
+        finally:
+            topology.stop()
+
+    elapsed = status['finished_at'] - status['submitted_at']
+    return {
+        'download_workers': download_workers,
+        'algorithm_workers': algorithm_workers,
+        'duration': duration,
+        'files': args.files,
+        'algorithms': args.algorithms,
+        'state': status['state'],
+        'runs_failed': status['runs_failed'],
+        'elapsed': elapsed,
+        'files_per_second': args.files / elapsed if elapsed > 0 else None,
+        'runs_per_second': status['runs_completed'] / elapsed if elapsed > 0 else None,
+        'latency': stage_latencies(status),
+        'peak_rss_mb': {name: peak / 1024 ** 2 for name, peak in memory.peaks.items()}
+    }
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    def point(run):
+        return (run['download_workers'], run['algorithm_workers'], run['duration'], run['files'], tuple(run['algorithms']))
+
+    previous = {point(run): run for run in baseline['runs']}
+    regressions = []
+    for run in results['runs']:
+        before = previous.get(point(run))
+        if before is None or not before['files_per_second'] or not run['files_per_second']:
+            continue
+        change = run['files_per_second'] / before['files_per_second'] - 1
+        run['files_per_second_change'] = change
+        if change < -tolerance:
+            regressions.append({'run': point(run), 'before': before['files_per_second'],
+                                'after': run['files_per_second'], 'change': change})
+    return regressions
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--download-workers', type=int_list, default=[1])
+    parser.add_argument('--algorithm-workers', type=int_list, default=[1, 2, 4])
+    parser.add_argument('--durations', type=int_list, default=[10, 60], help='seconds of audio per file')
+    parser.add_argument('--files', type=int, default=20, help='files per run')
+    parser.add_argument('--algorithms', type=lambda value: value.split(','), default=['alg_MovingAverage'])
+    parser.add_argument('--warmup', type=float, default=5, help='seconds for the workers to start')
+    parser.add_argument('--timeout', type=float, default=900, help='seconds per run')
+    parser.add_argument('--output', default='pipeline_benchmark.json')
+    parser.add_argument('--baseline', help='previous output to compare files/s against')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed files/s drop against the baseline')
+    args = parser.parse_args()
+
+    args.output = os.path.abspath(args.output)
+    if args.baseline:
+        args.baseline = os.path.abspath(args.baseline)
+
+    busy = [port for port in PIPELINE_PORTS if port_in_use(port)]
+    if busy:
+        sys.exit(f"Ports {busy} are in use, stop the running pipeline first")
+
+    s3 = LocalS3().start()
+    # The Flask app submits to the routers and receives the worker events in this process
+    os.environ.update(S3_ENDPOINT_URL=s3.url, SHARED_DOWNLOAD_DIR=tempfile.gettempdir())
+    os.chdir(REPO_DIR)
+    import app as webapp
+    from job_events import start_results_listener
+    start_results_listener(webapp.job_index)
+
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()
+        },
+        'runs': []
+    }
+
+    try:
+        seed = 0
+        for download_workers in args.download_workers:
+            for algorithm_workers in args.algorithm_workers:
+                for duration in args.durations:
+                    seed += 1
+                    print(f"Running {download_workers} download / {algorithm_workers} algorithm workers, "
+                          f"{args.files} files of {duration}s ...", flush=True)
+                    run = run_point(webapp, s3, args, download_workers, algorithm_workers, duration, seed)
+                    end_to_end = run['latency']['end_to_end']
+                    print(f"  {run['state']}: {run['files_per_second']:.3f} files/s, end to end p95 "
+                          f"{end_to_end['p95'] if end_to_end else float('nan'):.2f}s, "
+                          f"peak {run['peak_rss_mb']['total']:.0f} MB", flush=True)
+                    results['runs'].append(run)
+    finally:
+        s3.stop()
+        results['s3'] = s3.stats
+
+    regressions = compare(results, args.baseline, args.tolerance) if args.baseline else []
+    results['regressions'] = regressions
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    for regression in regressions:
+        print(f"Regression in {regression['run']}: {regression['before']:.3f} -> {regression['after']:.3f} files/s "
+              f"({regression['change']:+.0%})")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
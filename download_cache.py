@@ -0,0 +1,236 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from file_lock import fetch_once
+from pcm_cache import pcm_paths
+
+# Local copies of S3 objects, keyed by bucket, key and ETag. Every version of an object
+# gets its own directory under <root>/objects, so same-named keys of different buckets
+# never collide and a changed object is fetched into a new place. A SQLite index shared
+# by all download workers records the entries, their size and last use, and the counters.
+
+DOWNLOAD_CACHE_DIR = os.getenv('DOWNLOAD_CACHE_DIR', os.getenv('SHARED_DOWNLOAD_DIR', '/tmp/shared_audio_files'))
+
+# Size quota of the cache (audio files and their PCM cache), 0 disables eviction. The algorithm
+# outputs written next to a file are not the cache's: they may be the only copy when OUTPUT_BUCKET
+# is not set, so they are neither counted nor removed with the file
+DOWNLOAD_CACHE_QUOTA = int(float(os.getenv('DOWNLOAD_CACHE_QUOTA_GB', '20')) * 1024 ** 3)
+
+# By default the ETag of a cached object is checked (a HEAD request, no data transfer) on every
+# use, so an object overwritten in S3 is never served stale. A number of seconds here opts into
+# serving a copy validated that recently without asking S3, at the cost of possibly stale data
+DOWNLOAD_CACHE_REVALIDATE = float(os.getenv('DOWNLOAD_CACHE_REVALIDATE_SECONDS', '0'))
+
+# Entries used more recently than this (seconds) are not evicted, algorithms may still be reading them
+DOWNLOAD_CACHE_EVICTION_GRACE = float(os.getenv('DOWNLOAD_CACHE_EVICTION_GRACE_SECONDS', '3600'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL,
+    last_validated REAL NOT NULL,
+    PRIMARY KEY (bucket, key, etag)
+);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def entry_files(path):
+    # What the cache owns of an entry: the audio file and the PCM cache decoded next to it
+    return (path,) + pcm_paths(path)
+
+
+def entry_size(path):
+    return sum(os.path.getsize(p) for p in entry_files(path) if os.path.exists(p))
+
+
+class DownloadCache:
+    def __init__(self, s3_manager, root=DOWNLOAD_CACHE_DIR, quota=DOWNLOAD_CACHE_QUOTA,
+                 revalidate=DOWNLOAD_CACHE_REVALIDATE, eviction_grace=DOWNLOAD_CACHE_EVICTION_GRACE):
+        self.s3_manager = s3_manager
+        self.root = root
+        self.quota = quota
+        self.revalidate = revalidate
+        self.eviction_grace = eviction_grace
+        self.index_path = os.path.join(root, 'download_cache.sqlite3')
+        self.local = threading.local()
+
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        with self.db() as db:
+            db.executescript(SCHEMA)
+
+    def db(self):
+        # sqlite3 connections can't be shared between threads, each transfer thread gets its own
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.index_path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            self.local.db = db
+        return db
+
+    def entry_path(self, bucket, key, etag):
+        digest = hashlib.sha1(f"{bucket}\0{key}\0{etag}".encode('utf-8')).hexdigest()
+        # Keep the file name, the algorithms pick the decoder from its extension
+        return os.path.join(self.root, 'objects', digest[:2], digest, os.path.basename(key)).replace("\\", "/")
+
+    def count(self, name, value=1):
+        with self.db() as db:
+            db.execute("INSERT INTO counters (name, value) VALUES (?, ?) "
+                       "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (name, value))
+
+    def lookup(self, bucket, key):
+        row = self.db().execute(
+            "SELECT etag, path, last_validated FROM entries WHERE bucket = ? AND key = ? "
+            "ORDER BY created DESC LIMIT 1", (bucket, key)).fetchone()
+        if row is None or not os.path.exists(row[1]):
+            return None
+        return {'etag': row[0], 'path': row[1], 'last_validated': row[2]}
+
+    def fetch(self, bucket, key, prepare=None):
+        """
+        Returns (local_path, hit) for the current version of s3://bucket/key, downloading it on a miss.
+        prepare(local_path) runs once on a freshly downloaded file before any worker is handed its path.
+        """
+        now = time.time()
+        entry = self.lookup(bucket, key)
+
+        if entry is not None and now - entry['last_validated'] < self.revalidate:
+            self.hit(bucket, key, entry['etag'], entry['path'], prepare)
+            return entry['path'], True
+
+        head = self.s3_manager.head_file(bucket, key)
+        if head is None:
+            raise RuntimeError(f"Could not read the ETag of {key} in {bucket}")
+
+        if entry is not None and entry['etag'] == head['etag']:
+            self.hit(bucket, key, entry['etag'], entry['path'], prepare, validated=True)
+            return entry['path'], True
+
+        path = self.entry_path(bucket, key, head['etag'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        def download(tmp_path):
+            # IfMatch makes S3 refuse the transfer if the object changed since the HEAD request
+            if not self.s3_manager.download_file(bucket, key, tmp_path, extra_args={'IfMatch': head['etag']}):
+                raise RuntimeError(f"Download of {key} from {bucket} failed")
+
+        def is_done():
+            return self.has_entry(bucket, key, head['etag'])
+
+        def record(path):
+            if prepare is not None:
+                prepare(path)
+            recorded_at = time.time()
+            with self.db() as db:
+                db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                           (bucket, key, head['etag'], path, entry_size(path), recorded_at, recorded_at, recorded_at))
+
+        # Only one worker, in any process, downloads a given version; the others wait for it
+        if not fetch_once(path, download, is_done, finish=record):
+            self.hit(bucket, key, head['etag'], path, prepare, validated=True)
+            return path, True
+
+        self.count('misses')
+        self.count('bytes_downloaded', head['size'])
+
+        # Older versions of the object will never be served again
+        self.remove_stale_versions(bucket, key, head['etag'])
+        self.evict()
+        return path, False
+
+    def has_entry(self, bucket, key, etag):
+        row = self.db().execute("SELECT path FROM entries WHERE bucket = ? AND key = ? AND etag = ?",
+                                (bucket, key, etag)).fetchone()
+        return row is not None and os.path.exists(row[0])
+
+    def hit(self, bucket, key, etag, path, prepare, validated=False):
+        # The PCM cache may be written on a later use (e.g. after a failed decode), so the size
+        # is measured again, for this entry only
+        if prepare is not None:
+            prepare(path)
+        now = time.time()
+        with self.db() as db:
+            db.execute("UPDATE entries SET last_access = ?, size = ?, "
+                       "last_validated = CASE WHEN ? THEN ? ELSE last_validated END "
+                       "WHERE bucket = ? AND key = ? AND etag = ?",
+                       (now, entry_size(path), validated, now, bucket, key, etag))
+        self.count('hits')
+
+    def remove_entry(self, bucket, key, etag, path):
+        # Only the files the cache owns; output directories written next to them stay
+        for file_path in entry_files(path):
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+        try:
+            # The version's directory, once nothing else is left in it
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+        with self.db() as db:
+            db.execute("DELETE FROM entries WHERE bucket = ? AND key = ? AND etag = ?", (bucket, key, etag))
+
+    def remove_stale_versions(self, bucket, key, current_etag):
+        rows = self.db().execute("SELECT etag, path FROM entries WHERE bucket = ? AND key = ? AND etag != ?",
+                                 (bucket, key, current_etag)).fetchall()
+        for etag, path in rows:
+            logging.info(f"Removing stale version {etag} of {key} in {bucket}")
+            self.remove_entry(bucket, key, etag, path)
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in its quota.
+        """
+        if not self.quota:
+            return
+
+        total = self.db().execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.quota:
+            return
+
+        candidates = self.db().execute(
+            "SELECT bucket, key, etag, path, size FROM entries WHERE last_access < ? ORDER BY last_access",
+            (time.time() - self.eviction_grace,)).fetchall()
+
+        for bucket, key, etag, path, size in candidates:
+            if total <= self.quota:
+                break
+            logging.info(f"Evicting {key} of {bucket} ({size} bytes) from the download cache")
+            self.remove_entry(bucket, key, etag, path)
+            self.count('evictions')
+            total -= size
+
+        if total > self.quota:
+            logging.warning(f"Download cache holds {total} bytes, over its {self.quota} byte quota, "
+                            f"but the remaining entries are still in use")
+
+    def stats(self):
+        counters = dict(self.db().execute("SELECT name, value FROM counters").fetchall())
+        entries, size = self.db().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {
+            'hits': counters.get('hits', 0),
+            'misses': counters.get('misses', 0),
+            'evictions': counters.get('evictions', 0),
+            'bytes_downloaded': counters.get('bytes_downloaded', 0),
+            'entries': entries,
+            'size': size,
+            'quota': self.quota
+        }
+
+
+if __name__ == "__main__":
+    # Print the counters of the shared cache
+    print(DownloadCache(s3_manager=None).stats())
@@ -1,7 +1,18 @@
 import zmq
 import os
 import time
+import queue
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from s3_manager import S3Manager
+from pcm_cache import has_pcm_cache, write_pcm_cache
+from download_cache import DownloadCache
+from file_lock import fetch_once
+from worker_protocol import WorkerConnection
+from job_events import EventPublisher
+from metrics import counter, gauge, histogram, start_metrics_server, Utilisation, METRICS_WORKER_PORTS
+from tracing import NULL_SPAN, activate, record_span, span, start_span
 import json
 
 
@@ -25,79 +36,260 @@ aws_region = os.getenv('AWS_DEFAULT_REGION')
 
 SHARED_DOWNLOAD_DIR = os.getenv('SHARED_DOWNLOAD_DIR', '/tmp/shared_audio_files')
 
+# Send each file to a single algorithm worker with all of its algorithms instead of
+# one task per algorithm (a task can also ask for it with 'batch': true)
+BATCH_ALGORITHM_TASKS = os.getenv('BATCH_ALGORITHM_TASKS', '0') == '1'
+
+# Decode every downloaded file once into a float32 PCM cache the algorithms can map
+PCM_CACHE = os.getenv('PCM_CACHE', '1') == '1'
+
+# Transfers run concurrently by one download worker; the router sends it this many tasks at once
+DOWNLOAD_CONCURRENCY = int(os.getenv('DOWNLOAD_CONCURRENCY', '4'))
+
+# How often (seconds) the worker checks for finished transfers while some are in flight
+DOWNLOAD_POLL_INTERVAL = float(os.getenv('DOWNLOAD_POLL_INTERVAL', '0.05'))
+
+# Serve downloads from the ETag-validated download cache; 0 keeps the old behavior of
+# downloading to SHARED_DOWNLOAD_DIR/<key> once and never checking it again
+DOWNLOAD_CACHE = os.getenv('DOWNLOAD_CACHE', '1') == '1'
+download_cache = None  # DownloadCache, created at startup
+
+DOWNLOAD_TASKS = counter('download_tasks_total', 'Download tasks finished', ['status'])
+DOWNLOAD_CACHE_REQUESTS = counter('download_cache_requests_total', 'Files served from the local copy or downloaded', ['result'])
+DOWNLOAD_BYTES = counter('download_bytes_total', 'Bytes downloaded from S3')
+DOWNLOAD_SECONDS = histogram('download_seconds', 'Time from receiving a download task to the file being ready', ['result'])
+DOWNLOADS_IN_FLIGHT = gauge('downloads_in_flight', 'Transfers running')
+DOWNLOAD_SLOTS = gauge('download_slots', 'Transfers the download workers run at once')
+ALGORITHM_TASKS_DISPATCHED = counter('algorithm_tasks_dispatched_total', 'Tasks sent to the algorithm router')
+
+# One lock per object, so two tasks for the same file don't download it twice at once.
+# Entries are [lock, holders] and removed when the last holder releases them
+object_locks = {}
+object_locks_guard = threading.Lock()
+
+@contextmanager
+def object_lock(bucket, file):
+    key = (bucket, file)
+    with object_locks_guard:
+        entry = object_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with object_locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del object_locks[key]
+
+def ensure_pcm_cache(download_path):
+    if not PCM_CACHE or has_pcm_cache(download_path):
+        return
+    try:
+        with span('decode'):
+            write_pcm_cache(download_path)
+    except Exception:
+        # The algorithms fall back to decoding the file themselves
+        logging.warning(f"Could not decode {download_path} into the PCM cache", exc_info=True)
+
+def algorithm_task(task, download_path, **fields):
+    # The job ID and the S3 location travel with the task so the algorithm worker's events
+    # can be matched to the submitted file
+    task_to_push = {
+        'job_id': task.get('job_id'),
+        'bucket': task['bucket'],
+        'key': task['file'],
+        'file': download_path
+    }
+    task_to_push.update(fields)
+    return task_to_push
+
+def dispatch_batch_task(routerAlgorithm, task, download_path, algorithms, trace=None):
+    # One task carrying all the algorithms, run back to back by a single algorithm worker
+    task_to_push = algorithm_task(task, download_path, algorithms=algorithms, trace=trace)
+    logging.info(f"batch task_push {task_to_push} going to algo router")
+    routerAlgorithm.send(json.dumps(task_to_push).encode('utf-8'))
+    ALGORITHM_TASKS_DISPATCHED.inc()
+    print(f"Dispatched batch task for {task['file']} with algorithms {algorithms}")
+
+def dispatch_algorithm_tasks(routerAlgorithm, task, download_path, algorithms, trace=None):
+    for algorithm in algorithms:
+        task_to_push = algorithm_task(task, download_path, algorithm=algorithm, trace=trace)
+        logging.info(f"task_push {task_to_push} going to algo router")
+        # Convert the message to JSON
+        task_json = json.dumps(task_to_push)
+        logging.info(f"task_json {task_json} going to algo router")
+
+        # Send as multipart (including an empty routing frame if needed)
+        routerAlgorithm.send(task_json.encode('utf-8'))  # No empty frame
+        ALGORITHM_TASKS_DISPATCHED.inc()
+
+        print(f"Dispatched task for {task['file']} with algorithm {algorithm}")
+
+def fetch_file(bucket, file, download_span=NULL_SPAN):
+    """
+    Runs on a transfer thread: downloads the file unless an up to date copy is there and decodes it.
+    Returns the local path and whether the file was already present.
+    """
+    # Tasks of this process for the same object wait here, other processes on its lock file
+    with activate(download_span), object_lock(bucket, file):
+        if download_cache is not None:
+            download_path, cached = download_cache.fetch(bucket, file, prepare=ensure_pcm_cache)
+        else:
+            # Define local file path
+            download_path = os.path.join(SHARED_DOWNLOAD_DIR, file)
+
+            # Normalize to forward slashes
+            download_path = download_path.replace("\\", "/")
+
+            def download(tmp_path):
+                print(f"Downloading {file} from {bucket} to {download_path}")
+                if not s3_manager.download_file(bucket, file, tmp_path):
+                    raise RuntimeError(f"Download of {file} from {bucket} failed")
+
+            # Download the file from S3 if it doesn't already exist
+            cached = not fetch_once(download_path, download, lambda: os.path.exists(download_path),
+                                    finish=ensure_pcm_cache)
+
+        if cached:
+            print(f"File {file} already exists, skipping download.")
+            logging.info(f"File {file} already exists, skipping download.")
+
+            # Decode it if whoever downloaded it didn't
+            ensure_pcm_cache(download_path)
+
+    return download_path, cached
+
 def download_worker():
     global s3_manager
 
     context = zmq.Context()  # Reuse the same context for all sockets
 
-    # DEALER socket to receive tasks from the ROUTER (task distributor)
-    dealerDownloaders = context.socket(zmq.DEALER)
-    dealerDownloaders.connect("tcp://localhost:5558")  # Connect to the ROUTER for download workers
+    # DEALER connection to receive tasks from the ROUTER (task distributor), up to DOWNLOAD_CONCURRENCY at a time
+    dealerDownloaders = WorkerConnection(context, "tcp://localhost:5558", capacity=DOWNLOAD_CONCURRENCY)  # Connect to the ROUTER for download workers
 
     # DEALER socket to send tasks to algorithm workers via another ROUTER
     routerAlgorithm = context.socket(zmq.DEALER)
     routerAlgorithm.connect("tcp://localhost:5559")  # Connect to ROUTER for algorithm workers
 
+    # PUSH socket for the stage-completion events read by the Flask app
+    publisher = EventPublisher(context)
+
+    # Transfers run on a thread pool; ZMQ sockets are only used from this thread,
+    # finished transfers are handed back through the completed queue
+    transfers = ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY, thread_name_prefix='download')
+    completed = queue.Queue()
+    in_flight = 0
+
+    # Transfers and cache hits, scraped by the Flask app
+    utilisation = Utilisation('download')
+    DOWNLOAD_SLOTS.set(DOWNLOAD_CONCURRENCY)
+    start_metrics_server(METRICS_WORKER_PORTS)
+
     # Instantiate the S3Manager for downloading files
     print(f"Started a download worker... on PID {os.getpid()} ready for processing")
-    logging.info(f"Worker {os.getpid()} connected to ROUTER sockets.")
+    logging.info(f"Worker {os.getpid()} connected to ROUTER sockets, {DOWNLOAD_CONCURRENCY} concurrent transfers.")
 
     while True:
+        task = None
+        message = None
+        # Set once the transfer's completion is queued: from then on the completion path reports
+        # the task and returns its READY credit, exactly once
+        handed_off = False
         try:
 
-             # Receive a multipart message from the ROUTER
-            message = dealerDownloaders.recv_multipart()
-            
-            # The first part is the routing ID, second part is the task (JSON)
-            routing_id = message[0]
-            task_data = message[1].decode('utf-8')  # Decode the second part to get the JSON string
-            
-            # Now, parse the JSON data
-            task = json.loads(task_data)  # Convert the string back to JSON
-            logging.info(f"Worker {os.getpid()} received task: {task}")
+             # Receive a multipart message from the ROUTER, waking up regularly while transfers are running
+            message = dealerDownloaders.recv_task(timeout=DOWNLOAD_POLL_INTERVAL if in_flight else None)
 
-            bucket = task['bucket']
-            file = task['file']
-            algorithms = task['algorithms']
+            if message is not None:
+                started_at = time.time()
 
-            logging.info(f"bucket: {bucket}, file: {file}, task: {algorithms}")
+                # The first part is the routing ID, second part is the task (JSON)
+                routing_id = message[0]
+                task_data = message[1].decode('utf-8')  # Decode the second part to get the JSON string
 
-            # Define local file path
-            download_path = os.path.join(SHARED_DOWNLOAD_DIR, file)
+                # Now, parse the JSON data
+                task = json.loads(task_data)  # Convert the string back to JSON
+                logging.info(f"Worker {os.getpid()} received task: {task}")
 
-            # Normalize to forward slashes
-            download_path = download_path.replace("\\", "/")
+                bucket = task['bucket']
+                file = task['file']
+
+                logging.info(f"bucket: {bucket}, file: {file}, task: {task['algorithms']}")
+
+                # Time the task spent in the download router, then the download itself
+                trace = task.get('trace')
+                record_span('queue.download_router', trace, trace and trace.get('sent_at'), started_at)
+                download_span = start_span('download', trace, start=started_at, bucket=bucket, key=file)
+
+                future = transfers.submit(fetch_file, bucket, file, download_span)
+                future.add_done_callback(
+                    lambda f, task=task, started_at=started_at, download_span=download_span:
+                        completed.put((task, started_at, download_span, f)))
+                in_flight += 1
+                handed_off = True
+                utilisation.busy()
 
-            # Download the file from S3 if it doesn't already exist
-            if not os.path.exists(download_path):
-                print(f"Downloading {file} from {bucket} to {download_path}")
-                # Uncomment the following line to enable actual S3 download
-                s3_manager.download_file(bucket, file, download_path)
-            else:
-                print(f"File {file} already exists, skipping download.")
-                logging.info(f"File {file} already exists, skipping download.")
-
-            # Once the file is downloaded, push tasks to algorithm workers
-            for algorithm in algorithms:
-                task_to_push = {
-                    'file': download_path,
-                    'algorithm': algorithm
-                }
-                logging.info(f"task_push {task_to_push} going to algo router")
-                # Convert the message to JSON
-                task_json = json.dumps(task_to_push)
-                logging.info(f"task_json {task_json} going to algo router")
-
-                # Send as multipart (including an empty routing frame if needed)
-                routerAlgorithm.send(task_json.encode('utf-8'))  # No empty frame
-
-                print(f"Dispatched task for {file} with algorithm {algorithm}")
-                
         except Exception as e:
             # Log the error with stack trace
             logging.error(f"Error in worker {os.getpid()} while processing task: {task}", exc_info=True)
             traceback.print_exc()
             print(f"Worker {os.getpid()} encountered an error: {e}")
+            if task is not None and not handed_off:
+                publisher.publish(task, 'download', started_at, time.time(), status='error', error=str(e))
+                DOWNLOAD_TASKS.inc(status='error')
+
+            # A task taken but never handed to the transfer pool, ask the router for the next one
+            if message is not None and not handed_off:
+                dealerDownloaders.task_done()
+
+        # Dispatch the algorithms of every file that landed, in the order they finished
+        while True:
+            try:
+                task, started_at, download_span, future = completed.get_nowait()
+            except queue.Empty:
+                break
+            in_flight -= 1
+            if not in_flight:
+                utilisation.idle()
+            finish_download(task, started_at, download_span, future, routerAlgorithm, publisher)
+
+            # Ask the router for the next task
+            dealerDownloaders.task_done()
+
+        DOWNLOADS_IN_FLIGHT.set(in_flight)
+
+def finish_download(task, started_at, download_span, future, routerAlgorithm, publisher):
+    try:
+        download_path, cached = future.result()
+        size = os.path.getsize(download_path)
+        finished_at = time.time()
+
+        publisher.publish(task, 'download', started_at, finished_at, cached=cached, size=size)
+        download_span.end(end=finished_at, cached=cached, size=size)
+
+        result = 'hit' if cached else 'miss'
+        DOWNLOAD_TASKS.inc(status='ok')
+        DOWNLOAD_CACHE_REQUESTS.inc(result=result)
+        DOWNLOAD_SECONDS.observe(finished_at - started_at, result=result)
+        if not cached:
+            DOWNLOAD_BYTES.inc(size)
+
+        # Once the file is downloaded, push tasks to algorithm workers
+        # The algorithm workers' spans become children of the download
+        if task.get('batch', BATCH_ALGORITHM_TASKS):
+            dispatch_batch_task(routerAlgorithm, task, download_path, task['algorithms'], download_span.context())
+        else:
+            dispatch_algorithm_tasks(routerAlgorithm, task, download_path, task['algorithms'], download_span.context())
+
+    except Exception as e:
+        # Log the error with stack trace
+        logging.error(f"Error in worker {os.getpid()} while processing task: {task}", exc_info=True)
+        traceback.print_exc()
+        print(f"Worker {os.getpid()} encountered an error: {e}")
+        publisher.publish(task, 'download', started_at, time.time(), status='error', error=str(e))
+        DOWNLOAD_TASKS.inc(status='error')
+        download_span.end(status='error', error=str(e))
 
 if __name__ == "__main__":
     # Pass environment variables to S3Manager
@@ -106,4 +298,6 @@ if __name__ == "__main__":
     # Ensure the shared directory exists before starting
     os.makedirs(SHARED_DOWNLOAD_DIR, exist_ok=True)
 
+    download_cache = DownloadCache(s3_manager) if DOWNLOAD_CACHE else None
+
     download_worker()
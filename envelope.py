@@ -0,0 +1,71 @@
+import numpy as np
+
+# Moving-average kernels shared by the envelope and smoothing algorithms. They compute the
+# same trailing mean as pandas' .rolling(window, min_periods=1).mean() (the first samples
+# average over what is there so far) from running sums, without a Series or a float64 copy
+# of the whole signal. Several passes are run block by block in one sweep: each block carries
+# just enough samples before it for every pass to see its full window.
+
+# Output samples computed at a time; the float64 running sums only ever cover one block
+BLOCK_SAMPLES = 1 << 20
+
+
+def window_samples(sr, window_ms):
+    # Same conversion the algorithms use
+    return int(sr * window_ms / 1000)
+
+
+def trailing_mean(x, window):
+    """
+    out[i] = mean(x[max(0, i - window + 1):i + 1]) for a float64 block x.
+    """
+    sums = np.empty(len(x) + 1)
+    sums[0] = 0.0
+    np.cumsum(x, out=sums[1:])
+
+    out = np.empty(len(x))
+    head = min(window, len(x))
+    # The first window - 1 samples average over fewer values, like min_periods=1
+    out[:head] = sums[1:head + 1] / np.arange(1, head + 1)
+    if window < len(x):
+        out[head:] = (sums[head + 1:] - sums[1:len(x) - window + 1]) / window
+    return out
+
+
+def rolling_mean(signal, windows, rectify=False, dtype=np.float32, block_samples=BLOCK_SAMPLES):
+    """
+    Applies a trailing moving average of each window (in samples) in windows, one after the other,
+    to signal (of its absolute value when rectify is set). A single int is one pass.
+    NaN are not skipped like pandas does; decoded audio has none.
+    """
+    windows = [windows] if np.isscalar(windows) else list(windows)
+    if any(window < 1 for window in windows):
+        raise ValueError(f"Moving average windows must be at least one sample, got {windows}")
+
+    signal = np.asarray(signal)
+    out = np.empty(len(signal), dtype=dtype)
+    lead = sum(window - 1 for window in windows)
+
+    for start in range(0, len(signal), block_samples):
+        stop = min(start + block_samples, len(signal))
+        offset = max(0, start - lead)
+        block = signal[offset:stop].astype(np.float64)
+        if rectify:
+            np.abs(block, out=block)
+
+        for window in windows:
+            block = trailing_mean(block, window)
+            if offset > 0:
+                # Samples whose window reaches before the block are wrong, the next pass doesn't need them
+                block = block[window - 1:]
+                offset += window - 1
+
+        out[start:stop] = block[start - offset:]
+    return out
+
+
+def rectified_envelope(signal, sr, window_ms, dtype=np.float32):
+    """
+    Rectified signal smoothed by a window_ms moving average.
+    """
+    return rolling_mean(signal, window_samples(sr, window_ms), rectify=True, dtype=dtype)
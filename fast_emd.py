@@ -0,0 +1,128 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.signal import resample_poly
+from scipy.interpolate import CubicSpline
+from PyEMD import EMD
+
+# Envelope-only EMD for long signals. alg_EMD keeps only the slowest modes of the signal, which
+# don't need every sample: the signal is low-pass filtered and decimated to about
+# EMD_TARGET_SAMPLES samples, decomposed with a cap on the sifting iterations, and the envelope
+# is interpolated back to the original samples.
+#
+# The decimated decomposition ends with a different number of IMFs than the full one, and EMD
+# can split one slow oscillation over two neighbouring IMFs differently in each, so "the last
+# N IMFs" are not the same modes in both. Both paths therefore keep the IMFs slower than
+# EMD_ENVELOPE_MAX_CYCLES oscillations over the signal, see slow_modes(). How close the two
+# envelopes are is measured by tools/emd_comparison.py, results in docs/emd_comparison.md.
+
+# The envelope sums the IMFs from the first one that oscillates at most this many times over the
+# whole signal (half its zero crossings) to the last, in both paths of alg_EMD
+EMD_ENVELOPE_MAX_CYCLES = float(os.getenv('EMD_ENVELOPE_MAX_CYCLES', '8'))
+
+# Opt-in until it has been checked against the full decomposition on real recordings, see
+# tools/emd_comparison.py and docs/emd_comparison.md
+EMD_FAST = os.getenv('EMD_FAST', '0') == '1'
+
+# With EMD_FAST=1, signals at least this long (samples) take the fast path in alg_EMD
+EMD_FAST_MIN_SAMPLES = int(os.getenv('EMD_FAST_MIN_SAMPLES', '50000'))
+
+# Length (samples) the signal is decimated to before the decomposition
+EMD_TARGET_SAMPLES = int(os.getenv('EMD_TARGET_SAMPLES', '20000'))
+
+# Sifting iterations per IMF, PyEMD's own limit is 1000
+EMD_MAX_SIFTINGS = int(os.getenv('EMD_MAX_SIFTINGS', '100'))
+
+# Decompose overlapping chunks of this many decimated samples in parallel, 0 decomposes the
+# whole decimated signal at once. The slow modes are selected within each chunk, so chunks
+# should be much longer than the slowest oscillation the envelope is meant to keep.
+EMD_CHUNK_SAMPLES = int(os.getenv('EMD_CHUNK_SAMPLES', '0'))
+
+# Part of every chunk shared with the next one, crossfaded when the envelopes are joined
+EMD_CHUNK_OVERLAP = float(os.getenv('EMD_CHUNK_OVERLAP', '0.25'))
+
+# Processes decomposing chunks, 0 uses every core
+EMD_WORKERS = int(os.getenv('EMD_WORKERS', '0'))
+
+
+def cycles(imf):
+    return np.count_nonzero(np.diff(np.signbit(imf - imf.mean()))) / 2
+
+
+def slow_modes(IMFs, max_cycles=EMD_ENVELOPE_MAX_CYCLES):
+    """
+    Sum of the slow IMFs of a decomposition, at least the last one (PyEMD puts the residue last).
+    """
+    first = next((index for index, imf in enumerate(IMFs) if cycles(imf) <= max_cycles), len(IMFs) - 1)
+    return np.sum(IMFs[first:], axis=0)
+
+
+def decimation_factor(length, target_samples=EMD_TARGET_SAMPLES):
+    return max(1, length // max(2, target_samples))
+
+
+def emd_envelope(signal, max_cycles=EMD_ENVELOPE_MAX_CYCLES, max_siftings=EMD_MAX_SIFTINGS):
+    return slow_modes(EMD(MAX_ITERATION=max_siftings).emd(np.asarray(signal, dtype=np.float64)), max_cycles)
+
+
+def chunk_bounds(length, chunk_samples, overlap):
+    step = max(1, chunk_samples - int(chunk_samples * overlap))
+    starts = list(range(0, max(length - chunk_samples, 0) + 1, step))
+    if starts[-1] + chunk_samples < length:
+        starts.append(length - chunk_samples)
+    return [(start, min(start + chunk_samples, length)) for start in starts]
+
+
+def crossfade(length, bounds, envelopes):
+    """
+    Joins the chunk envelopes, fading linearly from one to the next where they overlap.
+    """
+    total = np.zeros(length)
+    weights = np.zeros(length)
+    for index, ((start, stop), envelope) in enumerate(zip(bounds, envelopes)):
+        weight = np.ones(stop - start)
+        if index > 0:
+            fade_in = bounds[index - 1][1] - start
+            if fade_in > 0:
+                weight[:fade_in] = np.linspace(0, 1, fade_in + 2)[1:-1]
+        if index < len(bounds) - 1:
+            fade_out = stop - bounds[index + 1][0]
+            if fade_out > 0:
+                weight[-fade_out:] = np.linspace(1, 0, fade_out + 2)[1:-1]
+        total[start:stop] += envelope * weight
+        weights[start:stop] += weight
+    return total / weights
+
+
+def chunked_envelope(signal, max_cycles=EMD_ENVELOPE_MAX_CYCLES, max_siftings=EMD_MAX_SIFTINGS,
+                     chunk_samples=EMD_CHUNK_SAMPLES, overlap=EMD_CHUNK_OVERLAP, workers=EMD_WORKERS):
+    if not chunk_samples or len(signal) <= chunk_samples:
+        return emd_envelope(signal, max_cycles, max_siftings)
+
+    bounds = chunk_bounds(len(signal), chunk_samples, overlap)
+    chunks = [signal[start:stop] for start, stop in bounds]
+    # The same frequency cutoff, in oscillations over each chunk
+    chunk_cycles = [max_cycles * len(chunk) / len(signal) for chunk in chunks]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        envelopes = list(pool.map(emd_envelope, chunks, chunk_cycles, [max_siftings] * len(chunks)))
+    return crossfade(len(signal), bounds, envelopes)
+
+
+def fast_emd_envelope(signal, max_cycles=EMD_ENVELOPE_MAX_CYCLES, target_samples=EMD_TARGET_SAMPLES,
+                      max_siftings=EMD_MAX_SIFTINGS, chunk_samples=EMD_CHUNK_SAMPLES, overlap=EMD_CHUNK_OVERLAP,
+                      workers=EMD_WORKERS):
+    """
+    Approximates slow_modes(EMD().emd(signal), max_cycles) from a decimated copy of signal.
+    """
+    signal = np.asarray(signal, dtype=np.float64)
+    factor = decimation_factor(len(signal), target_samples)
+
+    # Zero-phase anti-aliasing filter, sample i of the result is sample i * factor of the signal
+    decimated = resample_poly(signal, 1, factor) if factor > 1 else signal
+    envelope = chunked_envelope(decimated, max_cycles, max_siftings, chunk_samples, overlap, workers)
+    if factor == 1:
+        return envelope
+
+    # The envelope is smooth at the decimated rate, a spline brings it back to every sample
+    positions = np.arange(len(envelope)) * factor
+    return CubicSpline(positions, envelope)(np.arange(len(signal)))
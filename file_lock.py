@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from tracing import span
+
+# Lock files coordinating the download workers: whoever creates <path>.lock fetches the
+# file into a temporary name and renames it into place, everyone else waits for the lock
+# to go away. The holder keeps touching its lock, so a lock that hasn't been touched for
+# FILE_LOCK_STALE_SECONDS belongs to a dead worker and is broken.
+FILE_LOCK_STALE_SECONDS = float(os.getenv('FILE_LOCK_STALE_SECONDS', '30'))
+FILE_LOCK_POLL_INTERVAL = float(os.getenv('FILE_LOCK_POLL_INTERVAL', '0.1'))
+
+# Locks held by this process, refreshed by a background thread
+held_locks = set()
+held_locks_guard = threading.Lock()
+refresher = None
+
+
+def refresh_held_locks():
+    while True:
+        time.sleep(FILE_LOCK_STALE_SECONDS / 3)
+        with held_locks_guard:
+            locks = list(held_locks)
+        for lock in locks:
+            try:
+                os.utime(lock.path)
+            except OSError:
+                logging.warning(f"Could not refresh lock {lock.path}", exc_info=True)
+
+
+def start_refresher():
+    global refresher
+    with held_locks_guard:
+        if refresher is None:
+            refresher = threading.Thread(target=refresh_held_locks, name='lock-refresher', daemon=True)
+            refresher.start()
+
+
+class FileLock:
+    def __init__(self, path, stale_after=FILE_LOCK_STALE_SECONDS):
+        self.path = path
+        self.stale_after = stale_after
+
+    def try_acquire(self):
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'pid': os.getpid(), 'host': socket.gethostname(), 'created': time.time()}, f)
+
+        start_refresher()
+        with held_locks_guard:
+            held_locks.add(self)
+        return True
+
+    def release(self):
+        with held_locks_guard:
+            held_locks.discard(self)
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            logging.warning(f"Lock {self.path} was already gone when released")
+
+    def age(self):
+        try:
+            return time.time() - os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return None
+
+    def break_if_stale(self):
+        age = self.age()
+        if age is None or age < self.stale_after:
+            return False
+
+        # Move the lock aside first, so only one waiter breaks it
+        aside = f"{self.path}.stale{os.getpid()}_{threading.get_ident()}"
+        try:
+            os.replace(self.path, aside)
+        except FileNotFoundError:
+            return False
+
+        if time.time() - os.path.getmtime(aside) < self.stale_after:
+            # Another waiter broke it and a live worker took the lock in between, give it back
+            try:
+                os.link(aside, self.path)
+            except FileExistsError:
+                pass
+            os.remove(aside)
+            return False
+
+        logging.warning(f"Broke stale lock {self.path}, last touched {age:.0f}s ago")
+        os.remove(aside)
+        return True
+
+    def wait(self):
+        """
+        Blocks until the lock is released by its holder or found stale.
+        """
+        while os.path.exists(self.path):
+            if self.break_if_stale():
+                return
+            time.sleep(FILE_LOCK_POLL_INTERVAL)
+
+
+def fetch_once(path, fetch, is_done, finish=None):
+    """
+    Makes sure path is fetched exactly once across processes. fetch(tmp_path) writes the
+    file under a temporary name that is renamed to path, so readers never see a partial file;
+    finish(path) runs before the lock is released (e.g. to record or decode the file).
+    is_done() tells whether a previous holder already completed the work.
+    Returns True when this call did the fetch.
+    """
+    lock = FileLock(path + '.lock')
+
+    while True:
+        if is_done():
+            return False
+
+        if not lock.try_acquire():
+            # Another worker is fetching the same file
+            with span('wait_for_lock', path=path):
+                lock.wait()
+            continue
+
+        try:
+            # The previous holder may have finished between the check and the lock
+            if is_done():
+                return False
+
+            tmp_path = f"{path}.part{os.getpid()}_{threading.get_ident()}"
+            try:
+                fetch(tmp_path)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+            if finish is not None:
+                finish(path)
+            return True
+        finally:
+            lock.release()
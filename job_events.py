@@ -0,0 +1,203 @@
+import zmq
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from metrics import counter, histogram
+
+# Workers push a stage-completion event for every download and algorithm run to the
+# Flask app, which keeps an in-memory index of jobs to answer /job_status requests.
+RESULTS_ENDPOINT = os.getenv('RESULTS_ENDPOINT', 'tcp://localhost:5561')
+RESULTS_BIND = os.getenv('RESULTS_BIND', 'tcp://*:5561')
+
+# Number of most recent jobs kept in the index
+JOB_INDEX_MAX_JOBS = int(os.getenv('JOB_INDEX_MAX_JOBS', '1000'))
+
+PIPELINE_EVENTS = counter('pipeline_events_total', 'Stage-completion events received from the workers', ['stage', 'status'])
+PIPELINE_STAGE_SECONDS = histogram('pipeline_stage_seconds', 'Duration of the stages reported by the workers', ['stage'])
+
+
+class EventPublisher:
+    """
+    Worker side: pushes stage-completion events to the results socket of the Flask app.
+    """
+    def __init__(self, context, endpoint=RESULTS_ENDPOINT):
+        self.socket = context.socket(zmq.PUSH)
+        self.socket.setsockopt(zmq.LINGER, 1000)
+        self.socket.connect(endpoint)
+
+    def publish(self, task, stage, started_at, finished_at, status='ok', **fields):
+        job_id = task.get('job_id')
+        if not job_id:
+            # Submitted without a job ID, nobody is waiting for the event
+            return
+
+        event = {
+            'job_id': job_id,
+            'stage': stage,
+            'bucket': task.get('bucket'),
+            'key': task.get('key', task.get('file')),
+            'status': status,
+            'started_at': started_at,
+            'finished_at': finished_at,
+            'duration': finished_at - started_at,
+            'worker_pid': os.getpid(),
+            # Spans of the file in TRACE_FILE, see tools/trace_report.py
+            'trace_id': (task.get('trace') or {}).get('trace_id')
+        }
+        event.update(fields)
+
+        try:
+            # Never block the pipeline on the status API
+            self.socket.send_json(event, zmq.NOBLOCK)
+        except zmq.Again:
+            logging.warning(f"Results socket is full, dropping event {event}")
+
+    def close(self):
+        self.socket.close()
+
+
+class JobIndex:
+    """
+    Flask side: in-memory index of submitted jobs and the events received for them.
+    """
+    def __init__(self, max_jobs=JOB_INDEX_MAX_JOBS):
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.max_jobs = max_jobs
+
+    def register(self, job_id, selected_files, algorithms):
+        files = {}
+        for bucket, keys in selected_files.items():
+            for key in keys:
+                files[(bucket, key)] = {'download': None, 'algorithms': {}, 'outputs': {}}
+
+        with self.lock:
+            self.jobs[job_id] = {
+                'submitted_at': time.time(),
+                'algorithms': list(algorithms),
+                'files': files
+            }
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+
+    def record(self, event):
+        with self.lock:
+            job = self.jobs.get(event.get('job_id'))
+            if job is None:
+                return
+
+            entry = job['files'].get((event.get('bucket'), event.get('key')))
+            if entry is None:
+                return
+
+            if event['stage'] == 'download':
+                entry['download'] = event
+            elif event['stage'] == 'algorithm':
+                entry['algorithms'][event.get('algorithm')] = event
+            elif event['stage'] == 'output':
+                # Outputs uploaded to S3 by the algorithm worker
+                entry['outputs'][event.get('algorithm')] = event
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            return self.summarize(job_id, job)
+
+    def list_jobs(self):
+        with self.lock:
+            return [self.summarize(job_id, job, include_files=False) for job_id, job in self.jobs.items()]
+
+    def summarize(self, job_id, job, include_files=True):
+        algorithms = job['algorithms']
+        expected = len(job['files']) * len(algorithms)
+
+        downloads = [entry['download'] for entry in job['files'].values() if entry['download']]
+        runs = [run for entry in job['files'].values() for run in entry['algorithms'].values()]
+
+        # Algorithms of a file whose download failed will never run
+        skipped = sum(len(algorithms) for entry in job['files'].values()
+                      if entry['download'] and entry['download']['status'] != 'ok')
+
+        completed = len(runs) + skipped
+        failed = sum(1 for run in runs if run['status'] != 'ok') + skipped
+
+        finished_at = max([event['finished_at'] for event in downloads + runs], default=None)
+        elapsed = (finished_at - job['submitted_at']) if finished_at else 0
+
+        if completed >= expected:
+            state = 'failed' if failed else 'done'
+        elif downloads or runs:
+            state = 'running'
+        else:
+            state = 'queued'
+
+        summary = {
+            'job_id': job_id,
+            'state': state,
+            'submitted_at': job['submitted_at'],
+            'finished_at': finished_at if state in ('done', 'failed') else None,
+            'files': len(job['files']),
+            'algorithms': algorithms,
+            'downloads_completed': len(downloads),
+            'runs_expected': expected,
+            'runs_completed': completed,
+            'runs_failed': failed,
+            'progress': completed / expected if expected else 1.0,
+            'runs_per_second': len(runs) / elapsed if elapsed > 0 else 0.0,
+            'download_seconds': stage_timings(downloads),
+            'algorithm_seconds': stage_timings(runs)
+        }
+
+        if include_files:
+            summary['file_status'] = [
+                {
+                    'bucket': bucket,
+                    'key': key,
+                    'download': entry['download'],
+                    'algorithms': entry['algorithms'],
+                    'outputs': entry['outputs']
+                }
+                for (bucket, key), entry in job['files'].items()
+            ]
+
+        return summary
+
+
+def stage_timings(events):
+    durations = [event['duration'] for event in events]
+    if not durations:
+        return None
+    return {
+        'count': len(durations),
+        'mean': sum(durations) / len(durations),
+        'max': max(durations),
+        'total': sum(durations)
+    }
+
+
+def start_results_listener(job_index, context=None, bind=RESULTS_BIND):
+    """
+    Starts a daemon thread that receives worker events on a PULL socket and records them in job_index.
+    """
+    context = context or zmq.Context.instance()
+    receiver = context.socket(zmq.PULL)
+    receiver.bind(bind)
+    logging.info(f"Results socket bound to {bind}")
+
+    def listen():
+        while True:
+            try:
+                event = receiver.recv_json()
+                PIPELINE_EVENTS.inc(stage=event.get('stage'), status=event.get('status'))
+                PIPELINE_STAGE_SECONDS.observe(event.get('duration', 0.0), stage=event.get('stage'))
+                job_index.record(event)
+            except Exception:
+                logging.error("Error while recording a job event", exc_info=True)
+
+    thread = threading.Thread(target=listen, name='results-listener', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,325 @@
+import os
+import time
+import bisect
+import logging
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Counters, gauges and histograms of one component in the Prometheus text format. Every
+# router and worker serves its own metrics on a small HTTP endpoint; the Flask app scrapes
+# all of them and serves their sum on /metrics next to its own.
+METRICS = os.getenv('METRICS', '1') == '1'
+
+# Interface the endpoints listen on, 0.0.0.0 to let a Prometheus server on another host scrape them
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+# Routers listen on fixed ports, workers take the first free port of the range
+DOWNLOAD_ROUTER_METRICS_PORT = int(os.getenv('DOWNLOAD_ROUTER_METRICS_PORT', '9101'))
+ALGORITHM_ROUTER_METRICS_PORT = int(os.getenv('ALGORITHM_ROUTER_METRICS_PORT', '9102'))
+METRICS_WORKER_PORTS = os.getenv('METRICS_WORKER_PORTS', '9110-9189')
+
+# Endpoints the Flask app scrapes for its aggregated view: host:port or host:first-last
+METRICS_TARGETS = os.getenv('METRICS_TARGETS', f"localhost:{DOWNLOAD_ROUTER_METRICS_PORT},"
+                                               f"localhost:{ALGORITHM_ROUTER_METRICS_PORT},"
+                                               f"localhost:{METRICS_WORKER_PORTS}")
+METRICS_SCRAPE_TIMEOUT = float(os.getenv('METRICS_SCRAPE_TIMEOUT', '0.5'))
+
+# Seconds, from a fast cache hit to an hour-long algorithm run
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{escape_label(str(value))}"' for name, value in labels)
+    return '{' + pairs + '}'
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> value
+        self.functions = {}  # label values -> callable read at scrape time
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set_function(self, function, **labels):
+        # The value is read from function() whenever the metrics are scraped
+        with self.lock:
+            self.functions[self.key(labels)] = function
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+            functions = dict(self.functions)
+        for key, function in functions.items():
+            try:
+                values[key] = function()
+            except Exception:
+                logging.warning(f"Could not read metric {self.name}", exc_info=True)
+        for key, value in values.items():
+            yield self.name, list(zip(self.labelnames, key)), value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        for key, (counts, total) in values.items():
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield self.name + '_bucket', labels + [('le', format_value(float(bound)))], cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            # Modules may be imported twice (as __main__ and by name), keep the first definition
+            return self.metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            samples = list(metric.samples())
+            if not samples:
+                # Defined by a module this component doesn't use
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# Worker utilisation, as counters so that they add up across the workers of a pool:
+# busy seconds / alive seconds is the share of time the pool was working
+WORKER_BUSY_SECONDS = counter('worker_busy_seconds_total', 'Seconds workers spent with at least one task', ['pool'])
+WORKER_ALIVE_SECONDS = counter('worker_alive_seconds_total', 'Seconds workers have been running', ['pool'])
+
+
+class Utilisation:
+    """
+    Tracks the busy time of one worker process for WORKER_BUSY_SECONDS.
+    """
+    def __init__(self, pool):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.busy_since = None
+        self.busy_total = 0.0
+        WORKER_ALIVE_SECONDS.set_function(lambda: time.time() - self.started_at, pool=pool)
+        WORKER_BUSY_SECONDS.set_function(self.busy_seconds, pool=pool)
+
+    def busy(self):
+        with self.lock:
+            if self.busy_since is None:
+                self.busy_since = time.time()
+
+    def idle(self):
+        with self.lock:
+            if self.busy_since is not None:
+                self.busy_total += time.time() - self.busy_since
+                self.busy_since = None
+
+    def busy_seconds(self):
+        with self.lock:
+            running = time.time() - self.busy_since if self.busy_since is not None else 0.0
+            return self.busy_total + running
+
+
+def parse_ports(ports):
+    first, _, last = str(ports).partition('-')
+    return range(int(first), int(last or first) + 1)
+
+
+def start_metrics_server(ports, host=METRICS_HOST, registry=REGISTRY):
+    """
+    Serves registry on http://host:<port>/metrics from a daemon thread, on the first free port
+    of ports ('9101' or '9110-9189'). Returns the port, or None when metrics are disabled or
+    no port is free; a component without metrics keeps working.
+    """
+    if not METRICS:
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    for port in parse_ports(ports):
+        try:
+            server = ThreadingHTTPServer((host, port), Handler)
+        except OSError:
+            continue
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        logging.info(f"Metrics served on http://{host}:{port}/metrics")
+        return port
+
+    logging.warning(f"No free port in {ports} for the metrics endpoint, metrics are not served")
+    return None
+
+
+def parse_targets(targets=METRICS_TARGETS):
+    urls = []
+    for target in targets.split(','):
+        target = target.strip()
+        if not target:
+            continue
+        host, _, ports = target.rpartition(':')
+        urls += [f"http://{host}:{port}/metrics" for port in parse_ports(ports)]
+    return urls
+
+
+def scrape(url, timeout=METRICS_SCRAPE_TIMEOUT):
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return response.read().decode('utf-8')
+    except OSError:
+        # Nothing listens on most ports of the worker range
+        return None
+
+
+def parse_families(text, families):
+    """
+    Adds the samples of one exposition to families: name -> {'help', 'type', 'samples': {series: value}}.
+    """
+    family = None
+    for line in text.splitlines():
+        if line.startswith('# HELP ') or line.startswith('# TYPE '):
+            _, kind, name, rest = (line.split(' ', 3) + [''])[:4]
+            family = families.setdefault(name, {'help': '', 'type': 'untyped', 'samples': {}})
+            family['help' if kind == 'HELP' else 'type'] = rest
+        elif line and not line.startswith('#') and family is not None:
+            series, _, value = line.rpartition(' ')
+            value = float(value)
+            family['samples'][series] = family['samples'].get(series, 0.0) + value
+
+
+def aggregate(targets=METRICS_TARGETS, registry=REGISTRY):
+    """
+    Scrapes every target and returns the sum of each series over registry and all the components
+    that answered.
+    """
+    urls = parse_targets(targets)
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        texts = [text for text in pool.map(scrape, urls) if text is not None]
+
+    # The app's own metrics first, a series it shares with the components is summed like any other
+    families = {}
+    for text in [registry.render()] + texts:
+        parse_families(text, families)
+
+    lines = ['# HELP metrics_components_up Components whose metrics endpoint answered',
+             '# TYPE metrics_components_up gauge',
+             f"metrics_components_up {len(texts)}"]
+
+    # Share of time each pool was busy since its workers started
+    busy = families.get('worker_busy_seconds_total', {}).get('samples', {})
+    alive = families.get('worker_alive_seconds_total', {}).get('samples', {})
+    if alive:
+        lines += ['# HELP worker_utilisation Busy seconds over alive seconds of all the workers of a pool',
+                  '# TYPE worker_utilisation gauge']
+        for series, alive_seconds in alive.items():
+            labels = series[len('worker_alive_seconds_total'):]
+            busy_seconds = busy.get('worker_busy_seconds_total' + labels, 0.0)
+            lines.append(f"worker_utilisation{labels} {busy_seconds / alive_seconds if alive_seconds else 0.0}")
+
+    for name, family in families.items():
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        lines += [f"{series} {format_value(value)}" for series, value in family['samples'].items()]
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,156 @@
+import re
+
+# Reads a multipart/form-data request body part by part straight from the request stream, so
+# /upload_files can hand every file to S3 while the browser is still sending it instead of
+# waiting for the framework to spool the whole body to memory or temporary files.
+
+# Bytes read from the request stream at a time
+READ_SIZE = 64 * 1024
+
+# Headers of a part and plain form fields are small, anything larger is a malformed request
+MAX_HEADER_SIZE = 16 * 1024
+MAX_FIELD_SIZE = 64 * 1024
+
+
+class MultipartError(ValueError):
+    pass
+
+
+def parse_boundary(content_type):
+    match = re.search(r'boundary="?([^";]+)"?', content_type or '')
+    if not content_type or not content_type.startswith('multipart/form-data') or not match:
+        raise MultipartError(f"Not a multipart/form-data request: {content_type}")
+    return match.group(1).encode('latin-1')
+
+
+def parse_disposition(headers):
+    disposition = headers.get('content-disposition', '')
+    params = dict(re.findall(r';\s*([\w*]+)="?([^";]*)"?', disposition))
+    return params.get('name'), params.get('filename')
+
+
+class Part:
+    """
+    One part of the body, a file-like object reading its content until the next boundary.
+    """
+    def __init__(self, reader, headers):
+        self.reader = reader
+        self.headers = headers
+        self.name, self.filename = parse_disposition(headers)
+        self.bytes_read = 0
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        # boto3 buffers the parts of a non-seekable upload itself
+        return False
+
+    def read(self, size=-1):
+        chunks = []
+        while not self.done and (size < 0 or size > 0):
+            data = self.reader.read_content(READ_SIZE if size < 0 else size)
+            if data is None:
+                self.done = True
+                break
+            chunks.append(data)
+            if size > 0:
+                size -= len(data)
+        data = b''.join(chunks)
+        self.bytes_read += len(data)
+        return data
+
+    def drain(self):
+        while not self.done:
+            self.read(READ_SIZE)
+
+
+class MultipartReader:
+    def __init__(self, stream, boundary):
+        self.stream = stream
+        # Every boundary but the first follows a CRLF, start with one so they all look the same
+        self.delimiter = b'\r\n--' + boundary
+        self.buffer = bytearray(b'\r\n')
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        data = self.stream.read(READ_SIZE)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer += data
+        return True
+
+    def skip_delimiter(self):
+        """
+        Consumes the next delimiter and what follows it, returns False after the closing one.
+        """
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0 and len(self.buffer) >= index + len(self.delimiter) + 2:
+                break
+            if not self.fill():
+                raise MultipartError("Request body ended before its closing boundary")
+        del self.buffer[:index + len(self.delimiter)]
+        if self.buffer[:2] == b'--':
+            return False
+        # Transport padding after the boundary up to the end of the line
+        while b'\r\n' not in self.buffer:
+            if not self.fill():
+                raise MultipartError("Request body ended inside a boundary line")
+        del self.buffer[:self.buffer.index(b'\r\n') + 2]
+        return True
+
+    def read_headers(self):
+        while b'\r\n\r\n' not in self.buffer:
+            if len(self.buffer) > MAX_HEADER_SIZE or not self.fill():
+                raise MultipartError("Malformed part headers")
+        end = self.buffer.index(b'\r\n\r\n')
+        lines = bytes(self.buffer[:end]).decode('utf-8', 'replace').split('\r\n')
+        del self.buffer[:end + 4]
+        headers = {}
+        for line in lines:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        return headers
+
+    def read_content(self, size):
+        """
+        Up to size bytes of the current part, None once its end (the next delimiter) is reached.
+        """
+        while True:
+            index = self.buffer.find(self.delimiter)
+            # Without a delimiter in sight, the tail could be the start of one
+            available = index if index >= 0 else len(self.buffer) - len(self.delimiter) + 1
+            if available > 0:
+                data = bytes(self.buffer[:min(size, available)])
+                del self.buffer[:len(data)]
+                return data
+            if index == 0:
+                return None
+            if not self.fill():
+                raise MultipartError("Request body ended inside a part")
+
+    def parts(self):
+        """
+        Yields the parts in the order they are sent. A part not read to its end is skipped over
+        when the next one is requested.
+        """
+        # Anything before the first boundary is a preamble
+        more = self.skip_delimiter()
+        while more:
+            part = Part(self, self.read_headers())
+            yield part
+            part.drain()
+            more = self.skip_delimiter()
+
+    @staticmethod
+    def read_field(part):
+        value = part.read(MAX_FIELD_SIZE + 1)
+        if len(value) > MAX_FIELD_SIZE:
+            raise MultipartError(f"Form field {part.name} is too large")
+        return value.decode('utf-8')
@@ -0,0 +1,119 @@
+import os
+import time
+import queue
+import shutil
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tracing import start_span
+
+# Output sink of the algorithm workers: every finished output directory is uploaded to
+# s3://OUTPUT_BUCKET/OUTPUT_PREFIX<job>/<input key>/<output directory>/ on a thread pool,
+# while the worker goes on with its next task. Disabled when OUTPUT_BUCKET is not set.
+OUTPUT_BUCKET = os.getenv('OUTPUT_BUCKET')
+OUTPUT_PREFIX = os.getenv('OUTPUT_PREFIX', 'outputs/')
+
+# Output files uploaded at the same time; large files are additionally split into parallel parts
+OUTPUT_UPLOAD_CONCURRENCY = int(os.getenv('OUTPUT_UPLOAD_CONCURRENCY', '4'))
+
+# Remove the local output directory once all of its files are in S3
+OUTPUT_DELETE_AFTER_UPLOAD = os.getenv('OUTPUT_DELETE_AFTER_UPLOAD', '0') == '1'
+
+
+class OutputUploader:
+    def __init__(self, s3_manager, bucket=OUTPUT_BUCKET, prefix=OUTPUT_PREFIX, concurrency=OUTPUT_UPLOAD_CONCURRENCY):
+        self.s3_manager = s3_manager
+        self.bucket = bucket
+        self.prefix = prefix
+        self.pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='output-upload')
+        self.completed = queue.Queue()  # (task, algorithm, result) of finished directories
+        self.lock = threading.Lock()
+        self.pending = 0  # directories not completely uploaded yet
+
+    def output_prefix(self, task, out_path):
+        # Outputs are grouped by job and input file, next to nothing else in the bucket
+        parts = [self.prefix.rstrip('/'), task.get('job_id') or 'unassigned',
+                 task.get('key') or os.path.basename(task['file']), os.path.basename(out_path)]
+        return '/'.join(part for part in parts if part)
+
+    def output_key(self, task, out_path, file_path):
+        return self.output_prefix(task, out_path) + '/' + os.path.relpath(file_path, out_path).replace('\\', '/')
+
+    def submit(self, task, algorithm, out_path):
+        """
+        Queues the upload of every file in out_path and returns immediately.
+        """
+        files = [os.path.join(root, name) for root, _, names in os.walk(out_path) for name in names]
+        with self.lock:
+            self.pending += 1
+
+        started_at = time.time()
+        upload_span = start_span('upload_outputs', task.get('trace'), algorithm=algorithm, files=len(files))
+        futures = [self.pool.submit(self.upload_file, task, out_path, file_path) for file_path in files]
+
+        if not futures:
+            self.finish(task, algorithm, out_path, started_at, [], upload_span)
+            return
+
+        # The last file to finish reports the whole directory
+        remaining = [len(futures)]
+        remaining_lock = threading.Lock()
+
+        def file_done(_):
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            self.finish(task, algorithm, out_path, started_at, [future.result() for future in futures], upload_span)
+
+        for future in futures:
+            future.add_done_callback(file_done)
+
+    def upload_file(self, task, out_path, file_path):
+        key = self.output_key(task, out_path, file_path)
+        try:
+            self.s3_manager.s3.upload_file(file_path, self.bucket, key, Config=self.s3_manager.transfer_config)
+            return {'key': key, 'size': os.path.getsize(file_path), 'error': None}
+        except Exception as e:
+            logging.error(f"Could not upload output {file_path} to s3://{self.bucket}/{key}", exc_info=True)
+            return {'key': key, 'size': 0, 'error': str(e)}
+
+    def finish(self, task, algorithm, out_path, started_at, uploads, upload_span):
+        failed = [upload for upload in uploads if upload['error']]
+        upload_span.end(status='error' if failed else 'ok', bytes=sum(upload['size'] for upload in uploads))
+        if failed:
+            logging.error(f"{len(failed)} of {len(uploads)} outputs of {out_path} could not be uploaded")
+        else:
+            logging.info(f"Uploaded {len(uploads)} outputs of {out_path} to s3://{self.bucket}/")
+            if OUTPUT_DELETE_AFTER_UPLOAD and uploads:
+                shutil.rmtree(out_path, ignore_errors=True)
+
+        self.completed.put((task, algorithm, {
+            'started_at': started_at,
+            'finished_at': time.time(),
+            'status': 'error' if failed else 'ok',
+            'files': len(uploads),
+            'bytes': sum(upload['size'] for upload in uploads),
+            'prefix': f"s3://{self.bucket}/{self.output_prefix(task, out_path)}/"
+        }))
+        with self.lock:
+            self.pending -= 1
+
+    def has_pending(self):
+        with self.lock:
+            return self.pending > 0
+
+    def drain(self):
+        """
+        Returns the directories finished since the last call, to be reported from the worker thread.
+        """
+        finished = []
+        while True:
+            try:
+                finished.append(self.completed.get_nowait())
+            except queue.Empty:
+                return finished
+
+    def close(self):
+        # Wait for the queued uploads, a recycled worker must not drop its outputs
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,147 @@
+import os
+import json
+import logging
+import numpy as np
+from signal_batch import active_signal
+from tracing import span
+
+# The download worker decodes each file once into a raw float32 array next to it
+# (<file>.pcm) plus a small JSON header (<file>.pcm.json). Algorithms map the array
+# read-only instead of decoding the file again.
+PCM_SUFFIX = '.pcm'
+HEADER_SUFFIX = '.pcm.json'
+PCM_DTYPE = 'float32'
+
+# Frames decoded at a time for the formats soundfile reads (wav, flac, ogg...), so writing the
+# cache of a long recording never holds more than one block of it in memory
+PCM_DECODE_BLOCK_FRAMES = int(os.getenv('PCM_DECODE_BLOCK_FRAMES', str(1 << 20)))
+
+def pcm_paths(audio_path):
+    return audio_path + PCM_SUFFIX, audio_path + HEADER_SUFFIX
+
+def has_pcm_cache(audio_path):
+    pcm_path, header_path = pcm_paths(audio_path)
+    # The header is written last, so its presence means the array is complete
+    return os.path.exists(header_path) and os.path.exists(pcm_path)
+
+def decode_audio(audio_path):
+    """
+    Decodes an audio file the same way the algorithms do: mono float32 at the native sample rate.
+    """
+    file_format = audio_path.split('.')[-1].lower()
+    if file_format in ['mp3', 'm4a']:
+        # Same decoder the algorithms use through convert_to_wav
+        from pydub import AudioSegment
+        audio = AudioSegment.from_file(audio_path, format=file_format)
+        samples = np.array(audio.get_array_of_samples(), dtype=np.float32)
+        samples = samples.reshape(-1, audio.channels).mean(axis=1, dtype=np.float32)
+        samples /= float(1 << (8 * audio.sample_width - 1))
+        return samples, audio.frame_rate
+
+    import librosa
+    return librosa.load(audio_path, sr=None)
+
+def open_blocks(audio_path):
+    """
+    Opens audio_path with soundfile for decoding in blocks, None for the formats it can't read
+    (mp3/m4a go through pydub, the rest through librosa's fallbacks).
+    """
+    if audio_path.split('.')[-1].lower() in ['mp3', 'm4a']:
+        return None
+    try:
+        import soundfile as sf
+        return sf.SoundFile(audio_path)
+    except Exception:
+        return None
+
+def write_blocks(source, f):
+    """
+    Writes the file opened by open_blocks to f as mono float32, block by block, as librosa.load
+    decodes it (float32 samples, channels averaged). Returns the number of samples.
+    """
+    length = 0
+    for block in source.blocks(blocksize=PCM_DECODE_BLOCK_FRAMES, dtype=PCM_DTYPE, always_2d=True):
+        mono = block[:, 0] if block.shape[1] == 1 else block.mean(axis=1, dtype=PCM_DTYPE)
+        np.ascontiguousarray(mono, dtype=PCM_DTYPE).tofile(f)
+        length += len(mono)
+    return length
+
+def write_pcm_cache(audio_path):
+    """
+    Decodes audio_path once and writes the float32 array and its header next to it.
+    Both files are written under a temporary name and renamed, so readers never see a partial cache.
+    """
+    pcm_path, header_path = pcm_paths(audio_path)
+    tmp_suffix = f".tmp{os.getpid()}"
+
+    source = open_blocks(audio_path)
+    if source is not None:
+        # Straight from the decoder to the file, the whole signal is never in memory
+        with source, open(pcm_path + tmp_suffix, 'wb') as f:
+            sr, channels, length = source.samplerate, 1, write_blocks(source, f)
+    else:
+        y, sr = decode_audio(audio_path)
+        y = np.ascontiguousarray(y, dtype=PCM_DTYPE)
+        channels, length = 1 if y.ndim == 1 else y.shape[1], y.shape[0]
+        y.tofile(pcm_path + tmp_suffix)
+    os.replace(pcm_path + tmp_suffix, pcm_path)
+
+    header = {
+        'sample_rate': int(sr),
+        'channels': channels,
+        'length': int(length),
+        'dtype': PCM_DTYPE
+    }
+    with open(header_path + tmp_suffix, 'w') as f:
+        json.dump(header, f)
+    os.replace(header_path + tmp_suffix, header_path)
+
+    logging.info(f"Decoded {audio_path} into PCM cache: {header}")
+    return header
+
+def read_pcm_header(audio_path):
+    _, header_path = pcm_paths(audio_path)
+    with open(header_path) as f:
+        return json.load(f)
+
+def map_pcm_cache(audio_path):
+    """
+    Maps the cached array read-only without copying it. Returns (signal, sample_rate).
+    """
+    header = read_pcm_header(audio_path)
+    pcm_path, _ = pcm_paths(audio_path)
+
+    shape = (header['length'],) if header['channels'] == 1 else (header['length'], header['channels'])
+    if header['length'] == 0:
+        return np.zeros(shape, dtype=header['dtype']), header['sample_rate']
+
+    signal = np.memmap(pcm_path, dtype=header['dtype'], mode='r', shape=shape)
+    # Plain ndarray view of the mapping, so results of numpy operations aren't memmaps
+    return np.asarray(signal), header['sample_rate']
+
+def load_audio(audio_path):
+    """
+    Returns (signal, sample_rate) like librosa.load(audio_path, sr=None), using the batch signal
+    or the PCM cache when present and decoding the file otherwise.
+    """
+    # Inside a batch task the signal has already been loaded for all its algorithms
+    signal = active_signal(audio_path)
+    if signal is not None:
+        return signal
+
+    # A span of the algorithm (or batch) calling it, when inside a trace
+    with span('load_audio') as load_span:
+        if has_pcm_cache(audio_path):
+            try:
+                signal = map_pcm_cache(audio_path)
+                load_span.set(source='pcm_cache')
+                return signal
+            except Exception:
+                logging.warning(f"Could not map PCM cache for {audio_path}, decoding it instead", exc_info=True)
+
+        load_span.set(source='decode')
+        return decode_audio(audio_path)
+
+def is_decoded(audio_path):
+    # True when load_audio can return the signal without decoding the file
+    return active_signal(audio_path) is not None or has_pcm_cache(audio_path)
@@ -3,6 +3,8 @@ import logging
 import traceback
 import os
 import socket
+from worker_protocol import WORKER_DISPATCH, lru_broker, split_tasks, ROUTER_MESSAGES_RECEIVED, ROUTER_TASKS_RECEIVED, ROUTER_TASKS_FORWARDED
+from metrics import start_metrics_server, ALGORITHM_ROUTER_METRICS_PORT
 
 # Configure logging
 logging.basicConfig(
@@ -29,6 +31,9 @@ def algorithm_router():
 
     logging.info("Starting the Algorithm Router...")
     
+    # Message counts and queue depth, scraped by the Flask app
+    start_metrics_server(ALGORITHM_ROUTER_METRICS_PORT)
+
     try:
         context = zmq.Context()
 
@@ -37,6 +42,16 @@ def algorithm_router():
         frontend.bind("tcp://*:5559")
         logging.info("ROUTER socket bound to tcp://*:5559 for download workers.")
 
+        if WORKER_DISPATCH == 'lru':
+            # ROUTER socket to hand tasks only to algorithm workers that announced a free slot
+            backend = context.socket(zmq.ROUTER)
+            backend.setsockopt(zmq.ROUTER_MANDATORY, 1)
+            backend.bind("tcp://*:5560")
+            logging.info("ROUTER socket bound to tcp://*:5560 for algorithm workers.")
+
+            lru_broker(frontend, backend, 'algorithm')
+            return
+
         # DEALER socket to forward tasks to algorithm workers
         backend = context.socket(zmq.DEALER)
         backend.bind("tcp://*:5560")
@@ -48,8 +63,13 @@ def algorithm_router():
             logging.info(f"Received message from frontend (download workers): {message}")
             print(f"Received message: {message}")  # Optional print for CLI
 
-            # Forward the message to the backend (algorithm workers)
-            backend.send_multipart(message)
+            # Forward the message to the backend (algorithm workers), one task per message
+            tasks = split_tasks(message)
+            ROUTER_MESSAGES_RECEIVED.inc(router='algorithm')
+            ROUTER_TASKS_RECEIVED.inc(len(tasks), router='algorithm')
+            for task_message in tasks:
+                backend.send_multipart(task_message)
+                ROUTER_TASKS_FORWARDED.inc(router='algorithm')
             logging.info(f"Forwarded message to backend (algorithm workers).")
 
     except zmq.ZMQError as e:
@@ -3,6 +3,8 @@ import logging
 import traceback
 import os
 import socket
+from worker_protocol import WORKER_DISPATCH, lru_broker, split_tasks, ROUTER_MESSAGES_RECEIVED, ROUTER_TASKS_RECEIVED, ROUTER_TASKS_FORWARDED
+from metrics import start_metrics_server, DOWNLOAD_ROUTER_METRICS_PORT
 
 # Configure logging
 logging.basicConfig(
@@ -29,6 +31,9 @@ def download_router():
 
     logging.info("Starting the Download Router...")
 
+    # Message counts and queue depth, scraped by the Flask app
+    start_metrics_server(DOWNLOAD_ROUTER_METRICS_PORT)
+
     try:
         context = zmq.Context()
 
@@ -37,6 +42,16 @@ def download_router():
         frontend.bind("tcp://*:5557")
         logging.info("ROUTER socket bound to tcp://*:5557 for Flask app.")
 
+        if WORKER_DISPATCH == 'lru':
+            # ROUTER socket to hand tasks only to download workers that announced a free slot
+            backend = context.socket(zmq.ROUTER)
+            backend.setsockopt(zmq.ROUTER_MANDATORY, 1)
+            backend.bind("tcp://*:5558")
+            logging.info("ROUTER socket bound to tcp://*:5558 for download workers.")
+
+            lru_broker(frontend, backend, 'download')
+            return
+
         # DEALER socket to forward tasks to download workers
         backend = context.socket(zmq.DEALER)
         backend.bind("tcp://*:5558")
@@ -50,8 +65,13 @@ def download_router():
             logging.info(f"Received message from frontend: {message}")
             print(f"Received message: {message}")  # Optional print for CLI
 
-            # Forward the message to the backend (download workers)
-            backend.send_multipart(message)
+            # Forward the message to the backend (download workers), one task per message
+            tasks = split_tasks(message)
+            ROUTER_MESSAGES_RECEIVED.inc(router='download')
+            ROUTER_TASKS_RECEIVED.inc(len(tasks), router='download')
+            for task_message in tasks:
+                backend.send_multipart(task_message)
+                ROUTER_TASKS_FORWARDED.inc(router='download')
             logging.info(f"Forwarded message to backend (download workers).")
 
     except zmq.ZMQError as e:
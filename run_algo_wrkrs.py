@@ -1,6 +1,7 @@
 import subprocess
 import os
 import platform
+import time
 from flask import Flask, jsonify, request
 
 app = Flask(__name__)
@@ -8,33 +9,54 @@ app = Flask(__name__)
 # List to track worker PIDs
 worker_pids = []
 
+# Number of algorithm workers kept alive by the supervisor
+ALGORITHM_WORKERS = int(os.getenv('ALGORITHM_WORKERS', '1'))
+
+# Function to spawn a single worker process
+def spawn_worker(create_console=False):
+    if platform.system() == 'Windows':
+        if not create_console:
+            # On Windows, open a process without a new console
+            return subprocess.Popen(["python", "algorithm_worker.py"], creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+        print("open console mode")
+        # On Windows, open a new console window for each worker
+        return subprocess.Popen(
+            ["python", "algorithm_worker.py"],
+            creationflags=subprocess.CREATE_NEW_CONSOLE  # Open a new console window
+        )
+    # On Linux/macOS, just spawn the process
+    return subprocess.Popen(["python3", "algorithm_worker.py"])
+
 # Function to start a worker
 def start_worker(worker_count=1, create_console=False):
     """Start a number of worker processes and store their PIDs."""
     global worker_pids
 
+    processes = []
     for _ in range(worker_count):
-        if platform.system() == 'Windows':
-            if not create_console:
-                # On Windows, open a process without a new console
-                process = subprocess.Popen(["python", "algorithm_worker.py"], creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
-            else:
-                print("open console mode")
-                # On Windows, open a new console window for each worker
-                process = subprocess.Popen(
-                    ["python", "algorithm_worker.py"],
-                    creationflags=subprocess.CREATE_NEW_CONSOLE  # Open a new console window
-                )
-        else:
-            # On Linux/macOS, just spawn the process
-            process = subprocess.Popen(["python3", "algorithm_worker.py"])
-        
+        process = spawn_worker(create_console)
+        processes.append(process)
+
         # Store the PID of the worker
         worker_pids.append(process.pid)
         print(f"Started worker with PID: {process.pid}")
 
-    return worker_pids
+    return processes
+
+def supervise_workers(worker_count=1, create_console=False, poll_interval=1.0):
+    """Keep worker_count workers running, replacing any worker that exits or is recycled."""
+    processes = start_worker(worker_count, create_console)
+
+    while True:
+        time.sleep(poll_interval)
+        for i, process in enumerate(processes):
+            if process.poll() is None:
+                continue
+
+            print(f"Worker with PID {process.pid} exited with code {process.returncode}, starting a replacement")
+            worker_pids.remove(process.pid)
+            processes[i] = start_worker(1, create_console)[0]
 
 if __name__ == '__main__':
-    # Start the worker with console mode enabled
-    start_worker(create_console=True)
+    # Start the workers with console mode enabled and keep them alive
+    supervise_workers(ALGORITHM_WORKERS, create_console=True)
@@ -1,6 +1,85 @@
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError, ClientError
 import os
+import math
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tracing import span
+
+MB = 1024 * 1024
+
+# S3-compatible endpoint to use instead of AWS (e.g. a local stand-in for benchmarks)
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')
+
+# Multipart transfer tuning, shared by all transfers of this client
+S3_MULTIPART_THRESHOLD = int(float(os.getenv('S3_MULTIPART_THRESHOLD_MB', '8')) * MB)
+S3_MULTIPART_CHUNKSIZE = int(float(os.getenv('S3_MULTIPART_CHUNKSIZE_MB', '8')) * MB)
+S3_MAX_CONCURRENCY = int(os.getenv('S3_MAX_CONCURRENCY', '10'))  # parts in flight per transfer
+
+# HTTP connections kept by the client; concurrent transfers each use up to S3_MAX_CONCURRENCY
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', '50'))
+
+# Listing pages are served from memory for this many seconds; uploads and deletes
+# through this S3Manager drop the cached pages of their bucket right away
+LISTING_CACHE_TTL = float(os.getenv('LISTING_CACHE_TTL', '10'))
+LISTING_CACHE_MAX_PAGES = int(os.getenv('LISTING_CACHE_MAX_PAGES', '256'))
+LISTING_PAGE_SIZE = 1000  # most keys list_objects_v2 returns per call
+
+# Direct browser uploads: parts are at least this large, S3 allows at most 10000 of them
+MULTIPART_MIN_PART_SIZE = 5 * MB
+MULTIPART_MAX_PARTS = 10000
+PRESIGNED_PART_EXPIRATION = int(os.getenv('PRESIGNED_PART_EXPIRATION', '3600'))
+
+# Origin of the web app; when set, buckets get a CORS rule allowing it to PUT parts
+# and read their ETag before the first direct upload
+UPLOAD_CORS_ORIGIN = os.getenv('UPLOAD_CORS_ORIGIN')
+
+# Whether browsers upload straight to S3. Off unless the app sets up the bucket CORS itself
+# (UPLOAD_CORS_ORIGIN); DIRECT_UPLOADS=1 turns it on for buckets whose CORS is managed elsewhere
+DIRECT_UPLOADS = os.getenv('DIRECT_UPLOADS', '1' if UPLOAD_CORS_ORIGIN else '0') == '1'
+
+# Download URLs: default lifetime, and how long a cached URL must still be valid to be handed out again
+PRESIGNED_URL_EXPIRATION = int(os.getenv('PRESIGNED_URL_EXPIRATION', '3600'))
+PRESIGNED_URL_MIN_REMAINING = int(os.getenv('PRESIGNED_URL_MIN_REMAINING', '600'))
+PRESIGNED_URL_CACHE_MAX = int(os.getenv('PRESIGNED_URL_CACHE_MAX', '10000'))
+PRESIGN_CONCURRENCY = int(os.getenv('PRESIGN_CONCURRENCY', '8'))
+
+# Bulk deletes: keys per delete_objects call (the S3 limit), calls in flight, and retries of failed keys
+DELETE_BATCH_SIZE = 1000
+DELETE_CONCURRENCY = int(os.getenv('DELETE_CONCURRENCY', '4'))
+DELETE_RETRIES = int(os.getenv('DELETE_RETRIES', '3'))
+RETRYABLE_DELETE_ERRORS = {'InternalError', 'SlowDown', 'ServiceUnavailable', 'RequestTimeout', 'OperationAborted', 'RequestFailed'}
+
+class TransferProgress:
+    """
+    Bytes transferred per file, updated from the transfer threads and read by the progress endpoint.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+
+    def start(self, file_name, size):
+        with self.lock:
+            self.files[file_name] = {'size': size, 'transferred': 0, 'status': 'uploading'}
+
+    def callback(self, file_name):
+        # boto3 calls it with the byte count of every chunk sent
+        def add(bytes_amount):
+            with self.lock:
+                self.files[file_name]['transferred'] += bytes_amount
+        return add
+
+    def finish(self, file_name, status):
+        with self.lock:
+            self.files[file_name]['status'] = status
+
+    def snapshot(self):
+        with self.lock:
+            return {file_name: dict(state) for file_name, state in self.files.items()}
 
 class S3Manager:
     def __init__(self, access_key, secret_key, region):
@@ -9,6 +88,16 @@ class S3Manager:
         self.secret_key = secret_key
         self.region = region
         self.s3 = None
+        self.listing_cache = OrderedDict()  # (bucket, prefix, delimiter, token, max_keys) -> (expires, page)
+        self.listing_cache_lock = threading.Lock()
+        self.cors_buckets = set()  # buckets already configured for direct uploads
+        self.url_cache = OrderedDict()  # (bucket, key, expiration) -> (url, expires_at)
+        self.url_cache_lock = threading.Lock()
+        self.transfer_config = TransferConfig(
+            multipart_threshold=S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+            max_concurrency=S3_MAX_CONCURRENCY
+        )
         self.connect_to_s3()
         
 
@@ -19,7 +108,13 @@ class S3Manager:
                 's3',
                 aws_access_key_id=self.access_key,
                 aws_secret_access_key=self.secret_key,
-                region_name=self.region
+                region_name=self.region,
+                endpoint_url=S3_ENDPOINT_URL,
+                config=Config(
+                    max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                    # Custom endpoints generally don't serve bucket subdomains
+                    s3={'addressing_style': 'path'} if S3_ENDPOINT_URL else None
+                )
             )
             print(f"Using region: {self.s3.meta.region_name}")
         except (NoCredentialsError, PartialCredentialsError) as e:
@@ -35,19 +130,61 @@ class S3Manager:
             print(f"Error listing buckets: {e}")
             return None
 
-    # List files (objects) in a specific bucket
-    def list_files(self, bucket_name):
+    # List one page of files; pass the returned next_token to get the following page.
+    # With a delimiter ('/'), keys below the next delimiter are folded into 'prefixes' like folders
+    def list_files_page(self, bucket_name, prefix='', delimiter='', continuation_token=None, max_keys=LISTING_PAGE_SIZE):
+        max_keys = max(1, min(int(max_keys), LISTING_PAGE_SIZE))
+        cache_key = (bucket_name, prefix, delimiter, continuation_token, max_keys)
+
+        page = self.cached_listing_page(cache_key)
+        if page is not None:
+            return page
+
         try:
-            response = self.s3.list_objects_v2(Bucket=bucket_name)
-            if 'Contents' in response:
-                file_names = [file['Key'] for file in response['Contents']]
-                return file_names
-            else:
-                return []  # Return an empty list if no files found
+            params = {'Bucket': bucket_name, 'Prefix': prefix, 'MaxKeys': max_keys}
+            if delimiter:
+                params['Delimiter'] = delimiter
+            if continuation_token:
+                params['ContinuationToken'] = continuation_token
+
+            response = self.s3.list_objects_v2(**params)
+            page = {
+                'files': [
+                    {'key': file['Key'], 'size': file['Size'], 'last_modified': file['LastModified'].isoformat()}
+                    for file in response.get('Contents', [])
+                ],
+                'prefixes': [common['Prefix'] for common in response.get('CommonPrefixes', [])],
+                'next_token': response.get('NextContinuationToken') if response.get('IsTruncated') else None
+            }
         except Exception as e:
             print(f"Error listing files in bucket {bucket_name}: {e}")
             return None
-        
+
+        with self.listing_cache_lock:
+            self.listing_cache[cache_key] = (time.time() + LISTING_CACHE_TTL, page)
+            self.listing_cache.move_to_end(cache_key)
+            while len(self.listing_cache) > LISTING_CACHE_MAX_PAGES:
+                self.listing_cache.popitem(last=False)
+        return page
+
+    def cached_listing_page(self, cache_key):
+        with self.listing_cache_lock:
+            cached = self.listing_cache.get(cache_key)
+            if cached is None:
+                return None
+            expires, page = cached
+            if expires < time.time():
+                del self.listing_cache[cache_key]
+                return None
+            self.listing_cache.move_to_end(cache_key)
+            return page
+
+    # Drop the cached listing pages of a bucket after its content changed
+    def invalidate_listing(self, bucket_name):
+        with self.listing_cache_lock:
+            for cache_key in [k for k in self.listing_cache if k[0] == bucket_name]:
+                del self.listing_cache[cache_key]
+
     # Method to create a bucket
     def create_bucket(self, bucket_name):
         try:
@@ -65,42 +202,215 @@ class S3Manager:
         try:
             self.s3.delete_bucket(Bucket=bucket_name)
             print(f"Bucket {bucket_name} deleted successfully.")
+            self.invalidate_listing(bucket_name)
             return True
         except Exception as e:
             print(f"Error deleting bucket {bucket_name}: {e}")
             return False
         
-    # Method to delete files from a bucket
+    # Method to delete files from a bucket, in chunks of DELETE_BATCH_SIZE keys sent concurrently.
+    # Returns the number of deleted keys and the keys that could not be deleted
     def delete_files(self, bucket_name, files):
+        files = list(dict.fromkeys(files))
+        chunks = [files[i:i + DELETE_BATCH_SIZE] for i in range(0, len(files), DELETE_BATCH_SIZE)]
+
+        with ThreadPoolExecutor(max_workers=DELETE_CONCURRENCY) as pool:
+            results = list(pool.map(lambda chunk: self.delete_chunk(bucket_name, chunk), chunks))
+
+        return self.finish_delete(bucket_name, results)
+
+    # Method to delete every file whose key starts with prefix. Pages are deleted as they are listed
+    def delete_prefix(self, bucket_name, prefix):
+        if not prefix:
+            # Deleting the whole bucket content has to be asked for key by key
+            raise ValueError("A prefix is required")
+
+        futures = []
+        results = []
+        with ThreadPoolExecutor(max_workers=DELETE_CONCURRENCY) as pool:
+            try:
+                paginator = self.s3.get_paginator('list_objects_v2')
+                for response in paginator.paginate(Bucket=bucket_name, Prefix=prefix,
+                                                   PaginationConfig={'PageSize': DELETE_BATCH_SIZE}):
+                    if response.get('Contents'):
+                        keys = [file['Key'] for file in response['Contents']]
+                        futures.append((keys, pool.submit(self.delete_chunk, bucket_name, keys)))
+            except Exception as e:
+                # The pages already listed are still deleted, the rest of the prefix is reported as one error
+                print(f"Error listing files under {prefix} in bucket {bucket_name}: {e}")
+                results.append({'deleted': 0, 'errors': [{'key': prefix, 'code': 'ListFailed', 'message': str(e)}]})
+
+            for keys, future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append({'deleted': 0, 'errors': [{'key': key, 'code': 'RequestFailed', 'message': str(e)}
+                                                             for key in keys]})
+
+        # Partial deletes are reported with what was deleted, so the caller knows what is left
+        return self.finish_delete(bucket_name, results)
+
+    def delete_chunk(self, bucket_name, keys):
+        """
+        Deletes up to DELETE_BATCH_SIZE keys, retrying the keys S3 reports as failed with a transient error.
+        """
+        deleted = 0
+        permanent_errors = []  # e.g. AccessDenied, reported as they are
+
+        for attempt in range(DELETE_RETRIES + 1):
+            if attempt:
+                time.sleep(0.2 * 2 ** attempt)
+            try:
+                response = self.s3.delete_objects(
+                    Bucket=bucket_name,
+                    Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+                )
+                # Quiet mode only lists the keys that failed
+                errors = [{'key': error['Key'], 'code': error['Code'], 'message': error['Message']}
+                          for error in response.get('Errors', [])]
+            except Exception as e:
+                errors = [{'key': key, 'code': 'RequestFailed', 'message': str(e)} for key in keys]
+
+            deleted += len(keys) - len(errors)
+            retryable = [error for error in errors if error['code'] in RETRYABLE_DELETE_ERRORS]
+            permanent_errors += [error for error in errors if error['code'] not in RETRYABLE_DELETE_ERRORS]
+
+            if not retryable or attempt == DELETE_RETRIES:
+                return {'deleted': deleted, 'errors': permanent_errors + retryable}
+            keys = [error['key'] for error in retryable]
+
+    @staticmethod
+    def merge_delete_results(results):
+        return {
+            'deleted': sum(result['deleted'] for result in results),
+            'errors': [error for result in results for error in result['errors']]
+        }
+
+    def finish_delete(self, bucket_name, results):
+        result = self.merge_delete_results(results)
+        self.invalidate_listing(bucket_name)
+        with self.url_cache_lock:
+            for cache_key in [k for k in self.url_cache if k[0] == bucket_name]:
+                del self.url_cache[cache_key]
+
+        if result['errors']:
+            print(f"Deleted {result['deleted']} files from {bucket_name}, {len(result['errors'])} could not be deleted.")
+        else:
+            print(f"Files deleted successfully from {bucket_name}.")
+        return result
+
+    def upload_stream(self, bucket_name, file_name, stream, size=None, progress=None):
+        """
+        Uploads whatever stream reads to bucket_name/file_name. A non-seekable stream, e.g. a part
+        of the request body, is sent as it is read, S3_MAX_CONCURRENCY parts at a time.
+        """
+        started_at = time.time()
+        if progress is not None:
+            progress.start(file_name, size)
+        try:
+            self.s3.upload_fileobj(stream, bucket_name, file_name,
+                                   ExtraArgs={'CacheControl': "no-cache, no-store, must-revalidate"},
+                                   Config=self.transfer_config,
+                                   Callback=progress.callback(file_name) if progress is not None else None)
+            status, error = 'uploaded', None
+        except Exception as e:
+            print(f"Error uploading file {file_name} to bucket {bucket_name}: {e}")
+            status, error = 'failed', str(e)
+
+        if progress is not None:
+            progress.finish(file_name, status)
+        # A request part only knows its size once it has been read
+        size = getattr(stream, 'bytes_read', size) if size is None else size
+        return {'file_name': file_name, 'size': size, 'status': status,
+                'error': error, 'seconds': time.time() - started_at}
+
+    def uploads_finished(self, bucket_name, results):
+        uploaded = sum(1 for result in results if result['status'] == 'uploaded')
+        print(f"{uploaded} of {len(results)} files uploaded successfully to {bucket_name}.")
+        if uploaded:
+            self.invalidate_listing(bucket_name)
+
+    # Direct browser uploads: the browser PUTs the parts to S3 on presigned URLs,
+    # the app only starts and completes the multipart upload
+    def multipart_part_size(self, size):
+        return max(S3_MULTIPART_CHUNKSIZE, MULTIPART_MIN_PART_SIZE, math.ceil(size / MULTIPART_MAX_PARTS))
+
+    def create_multipart_upload(self, bucket_name, file_name, size, content_type=None):
+        try:
+            if UPLOAD_CORS_ORIGIN:
+                self.allow_browser_uploads(bucket_name)
+
+            params = {'Bucket': bucket_name, 'Key': file_name, 'CacheControl': "no-cache, no-store, must-revalidate"}
+            if content_type:
+                params['ContentType'] = content_type
+            upload_id = self.s3.create_multipart_upload(**params)['UploadId']
+
+            part_size = self.multipart_part_size(size)
+            part_count = max(1, math.ceil(size / part_size))
+            parts = [
+                {
+                    'part_number': part_number,
+                    'url': self.s3.generate_presigned_url(
+                        'upload_part',
+                        Params={'Bucket': bucket_name, 'Key': file_name, 'UploadId': upload_id, 'PartNumber': part_number},
+                        ExpiresIn=PRESIGNED_PART_EXPIRATION
+                    )
+                }
+                for part_number in range(1, part_count + 1)
+            ]
+            return {'key': file_name, 'upload_id': upload_id, 'part_size': part_size, 'parts': parts}
+        except Exception as e:
+            print(f"Error starting the upload of {file_name} to bucket {bucket_name}: {e}")
+            return None
+
+    def complete_multipart_upload(self, bucket_name, file_name, upload_id, parts):
         try:
-            delete_objects = [{'Key': file_name} for file_name in files]  # Prepare the list of files to delete
-            response = self.s3.delete_objects(
-                Bucket=bucket_name,
-                Delete={'Objects': delete_objects}
+            self.s3.complete_multipart_upload(
+                Bucket=bucket_name, Key=file_name, UploadId=upload_id,
+                MultipartUpload={'Parts': [
+                    {'PartNumber': int(part['part_number']), 'ETag': part['etag']}
+                    for part in sorted(parts, key=lambda part: int(part['part_number']))
+                ]}
             )
-            print(f"Files deleted successfully from {bucket_name}.")
+            print(f"File {file_name} uploaded successfully to {bucket_name}.")
+            self.invalidate_listing(bucket_name)
             return True
         except Exception as e:
-            print(f"Error deleting files from bucket {bucket_name}: {e}")
+            print(f"Error completing the upload of {file_name} to bucket {bucket_name}: {e}")
             return False
-        
-    # Method to upload files to a bucket
-    def upload_files(self, bucket_name, files):
+
+    def abort_multipart_upload(self, bucket_name, file_name, upload_id):
         try:
-            for file in files:
-                self.s3.put_object(Bucket=bucket_name, 
-                                   Key=file.filename, 
-                                   Body=file,
-                                   CacheControl="no-cache, no-store, must-revalidate")
-            print(f"Files uploaded successfully to {bucket_name}.")
+            self.s3.abort_multipart_upload(Bucket=bucket_name, Key=file_name, UploadId=upload_id)
             return True
         except Exception as e:
-            print(f"Error uploading files to bucket {bucket_name}: {e}")
+            print(f"Error aborting the upload of {file_name} to bucket {bucket_name}: {e}")
             return False
-        
+
+    # Let the web app PUT parts to the bucket and read their ETag (needed to complete the upload)
+    def allow_browser_uploads(self, bucket_name):
+        if bucket_name in self.cors_buckets:
+            return
+        try:
+            rules = self.s3.get_bucket_cors(Bucket=bucket_name)['CORSRules']
+        except ClientError:
+            rules = []  # No CORS configuration yet
+
+        if not any(UPLOAD_CORS_ORIGIN in rule.get('AllowedOrigins', []) and 'PUT' in rule.get('AllowedMethods', [])
+                   and 'ETag' in rule.get('ExposeHeaders', []) for rule in rules):
+            rules.append({
+                'AllowedOrigins': [UPLOAD_CORS_ORIGIN],
+                'AllowedMethods': ['PUT'],
+                'AllowedHeaders': ['*'],
+                'ExposeHeaders': ['ETag'],
+                'MaxAgeSeconds': 3600
+            })
+            self.s3.put_bucket_cors(Bucket=bucket_name, CORSConfiguration={'CORSRules': rules})
+            print(f"Allowed direct uploads from {UPLOAD_CORS_ORIGIN} to {bucket_name}")
+        self.cors_buckets.add(bucket_name)
+
      # Method to generate pre-signed URLs for files
-    def generate_presigned_url(self, bucket_name, file_name, expiration=3600):
-        print("generating url ...:", file_name)
+    def generate_presigned_url(self, bucket_name, file_name, expiration=PRESIGNED_URL_EXPIRATION):
         try:
             response = self.s3.generate_presigned_url(
                 'get_object',
@@ -111,16 +421,69 @@ class S3Manager:
         except ClientError as e:
             print(f"Error generating pre-signed URL: {e}")
             return None
-        
+
+    # Method to generate pre-signed URLs for many files at once. URLs signed earlier are
+    # handed out again while they stay valid for PRESIGNED_URL_MIN_REMAINING seconds,
+    # the others are signed concurrently
+    def generate_presigned_urls(self, bucket_name, file_names, expiration=PRESIGNED_URL_EXPIRATION):
+        now = time.time()
+        urls = {}
+        to_sign = []
+
+        with self.url_cache_lock:
+            for file_name in dict.fromkeys(file_names):
+                cached = self.url_cache.get((bucket_name, file_name, expiration))
+                if cached is not None and cached[1] - now > min(PRESIGNED_URL_MIN_REMAINING, expiration / 2):
+                    self.url_cache.move_to_end((bucket_name, file_name, expiration))
+                    urls[file_name] = cached
+                else:
+                    to_sign.append(file_name)
+
+        def sign(file_name):
+            return file_name, self.generate_presigned_url(bucket_name, file_name, expiration)
+
+        if len(to_sign) > 1:
+            with ThreadPoolExecutor(max_workers=PRESIGN_CONCURRENCY) as pool:
+                signed = list(pool.map(sign, to_sign))
+        else:
+            signed = [sign(file_name) for file_name in to_sign]
+
+        with self.url_cache_lock:
+            for file_name, url in signed:
+                if url is None:
+                    continue
+                urls[file_name] = (url, now + expiration)
+                self.url_cache[(bucket_name, file_name, expiration)] = urls[file_name]
+                self.url_cache.move_to_end((bucket_name, file_name, expiration))
+            while len(self.url_cache) > PRESIGNED_URL_CACHE_MAX:
+                self.url_cache.popitem(last=False)
+
+        print(f"Pre-signed URLs for {len(urls)} files of {bucket_name}, {len(signed)} newly signed")
+        return [{'file_name': file_name, 'url': urls[file_name][0], 'expires_at': urls[file_name][1]}
+                for file_name in file_names if file_name in urls]
+
+    # Method to get the ETag and size of an object without downloading it
+    def head_file(self, bucket_name, file_name):
+        try:
+            with span('s3_head', bucket=bucket_name, key=file_name):
+                response = self.s3.head_object(Bucket=bucket_name, Key=file_name)
+            return {'etag': response['ETag'], 'size': response['ContentLength']}
+        except Exception as e:
+            print(f"Error reading metadata of {file_name} in bucket {bucket_name}: {e}")
+            return None
+
     # Method to download a file from S3
-    def download_file(self, bucket_name, file_name, local_path=None):
+    def download_file(self, bucket_name, file_name, local_path=None, extra_args=None):
         try:
             # If local_path is not provided, use the current working directory
             if local_path is None:
                 local_path = os.path.join(os.getcwd(), file_name)
 
             # Download the file from S3
-            self.s3.download_file(bucket_name, file_name, local_path)
+            with span('s3_download', bucket=bucket_name, key=file_name) as s:
+                self.s3.download_file(bucket_name, file_name, local_path, ExtraArgs=extra_args,
+                                      Config=self.transfer_config)
+                s.set(size=os.path.getsize(local_path))
             print(f"File {file_name} downloaded successfully to {local_path}")
             return True
         except Exception as e:
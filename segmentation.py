@@ -0,0 +1,96 @@
+import numpy as np
+
+# Chunk detection shared by alg_audioChunks and alg_audioChunks2, with whole-array operations
+# instead of a Python loop over every sample of the envelope. A chunk starts where the envelope
+# is above the threshold and rises for the next slope_samples samples, and ends at the next such
+# point where it falls; the envelope is scanned in blocks so the temporaries stay small.
+
+# Samples scanned at a time
+BLOCK_SAMPLES = 1 << 20
+
+
+def slope_runs(envelope, start, stop, slope_samples):
+    """
+    For every i in [start, stop): whether envelope[i:i + slope_samples] is strictly increasing,
+    and whether it is strictly decreasing.
+    """
+    window = envelope[start:stop + slope_samples - 1]
+    steps = np.diff(window)
+    rising = steps > 0
+    falling = steps < 0
+
+    # A run of slope_samples - 1 steps in the same direction, by and-ing shifted copies
+    length = stop - start
+    rising_run = rising[:length].copy()
+    falling_run = falling[:length].copy()
+    for shift in range(1, slope_samples - 1):
+        rising_run &= rising[shift:shift + length]
+        falling_run &= falling[shift:shift + length]
+    return rising_run, falling_run
+
+
+def chunk_events(envelope, threshold, margin, slope_samples, block_samples=BLOCK_SAMPLES):
+    """
+    Sample indices where a chunk may start and where it may end.
+    """
+    first, last = margin, len(envelope) - margin
+    starts, ends = [], []
+    for start in range(first, last, block_samples):
+        stop = min(start + block_samples, last)
+        above = envelope[start:stop] > threshold
+        rising_run, falling_run = slope_runs(envelope, start, stop, slope_samples)
+        starts.append(np.flatnonzero(above & rising_run) + start)
+        ends.append(np.flatnonzero(above & falling_run) + start)
+
+    if not starts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(starts), np.concatenate(ends)
+
+
+def pair_events(starts, ends):
+    """
+    Pairs every start with the first end after it and every end with the first start after it,
+    as a scan that is inside or outside a chunk would. An unfinished last chunk is dropped.
+    """
+    # A sample can't be rising and falling, so every index is either a start or an end
+    events = np.concatenate([starts, ends])
+    is_start = np.concatenate([np.ones(len(starts), dtype=bool), np.zeros(len(ends), dtype=bool)])
+    order = np.argsort(events, kind='stable')
+    events, is_start = events[order], is_start[order]
+
+    # Ends before the first start are ignored, then only the first event of each run of starts
+    # (or of ends) changes the state
+    if not is_start.any():
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    first_start = np.argmax(is_start)
+    events, is_start = events[first_start:], is_start[first_start:]
+    kept = np.ones(len(events), dtype=bool)
+    kept[1:] = is_start[1:] != is_start[:-1]
+
+    chunk_starts = events[kept & is_start]
+    chunk_ends = events[kept & ~is_start]
+    return chunk_starts[:len(chunk_ends)], chunk_ends
+
+
+def detect_audio_chunks(envelope_signal, sr, threshold_percent=0.05, min_chunk_duration_ms=100,
+                        padding_ms=0, slope_samples=10, margin=10):
+    """
+    Returns the (start, end) sample ranges of the chunks of envelope_signal: above threshold_percent
+    of its maximum, widened by padding_ms on both sides and at least min_chunk_duration_ms long
+    (padding included). The first and last margin samples are never a start or an end.
+    """
+    envelope_signal = np.asarray(envelope_signal)
+    if len(envelope_signal) <= 2 * margin:
+        return []
+
+    threshold = threshold_percent * np.max(envelope_signal)
+    padding_samples = int(sr * padding_ms / 1000)
+    min_chunk_samples = int(sr * min_chunk_duration_ms / 1000)
+
+    starts, ends = pair_events(*chunk_events(envelope_signal, threshold, margin, slope_samples))
+
+    starts = np.maximum(0, starts - padding_samples)
+    ends = np.minimum(len(envelope_signal), ends + padding_samples)
+    long_enough = ends - starts >= min_chunk_samples
+
+    return list(zip(starts[long_enough].tolist(), ends[long_enough].tolist()))
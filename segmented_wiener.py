@@ -0,0 +1,79 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.signal import correlate
+
+# scipy.signal.wiener for long 1-D signals, block by block on a thread pool (the correlations and
+# array arithmetic release the GIL). Every block is filtered with the filter window's worth of
+# neighbouring samples around it (zeros past the ends, as 'same' correlation pads), so the seams
+# need no stitching. The noise power, when not given, is the mean local variance of the whole
+# signal, summed per block by a first pass. Temporaries are a few blocks per thread instead of
+# several signal-sized float64 arrays.
+
+# Signals at least this long (seconds) are filtered in segments by alg_wienerFiltering
+WIENER_SEGMENT_MIN_SECONDS = float(os.getenv('WIENER_SEGMENT_MIN_SECONDS', '60'))
+
+# Samples filtered at a time by one thread
+WIENER_BLOCK_SAMPLES = int(os.getenv('WIENER_BLOCK_SAMPLES', str(1 << 20)))
+
+# Threads filtering blocks, 0 uses every core
+WIENER_WORKERS = int(os.getenv('WIENER_WORKERS', '0'))
+
+
+def local_statistics(y, start, stop, mysize):
+    """
+    Local mean and variance of y[start:stop] over windows of mysize samples, as scipy.signal.wiener
+    computes them on the whole signal.
+    """
+    # correlate(..., 'same') centers the window mysize // 2 samples before each sample
+    before, after = mysize // 2, mysize - 1 - mysize // 2
+    lo, hi = max(start - before, 0), min(stop + after, len(y))
+    block = np.asarray(y[lo:hi])
+    block = np.concatenate([np.zeros(before - (start - lo), dtype=block.dtype), block,
+                            np.zeros(after - (hi - stop), dtype=block.dtype)])
+
+    window = np.ones(mysize)
+    local_mean = correlate(block, window, 'valid') / float(mysize)
+    local_var = correlate(block ** 2, window, 'valid') / float(mysize) - local_mean ** 2
+    return local_mean, local_var
+
+
+def filter_block(y, start, stop, mysize, noise):
+    local_mean, local_var = local_statistics(y, start, stop, mysize)
+    res = y[start:stop] - local_mean
+    res *= (1 - noise / local_var)
+    res += local_mean
+    return np.where(local_var < noise, local_mean, res)
+
+
+def variance_sum(y, start, stop, mysize):
+    return local_statistics(y, start, stop, mysize)[1].sum()
+
+
+def segmented_wiener(y, mysize=3, noise=None, workers=WIENER_WORKERS, block_samples=WIENER_BLOCK_SAMPLES):
+    """
+    Same result as scipy.signal.wiener(y, mysize, noise) for a 1-D signal.
+    """
+    y = np.asarray(y)
+    if y.ndim != 1:
+        raise ValueError(f"Segmented Wiener filtering takes a 1-D signal, got shape {y.shape}")
+    mysize = int(np.ravel(mysize)[0])
+
+    out = np.empty(len(y))
+    if not len(y):
+        return out
+
+    blocks = [(start, min(start + block_samples, len(y))) for start in range(0, len(y), block_samples)]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        if noise is None:
+            # First pass: the mean local variance over the whole signal
+            sums = pool.map(lambda block: variance_sum(y, block[0], block[1], mysize), blocks)
+            noise = sum(sums) / len(y)
+
+        def run(block):
+            start, stop = block
+            out[start:stop] = filter_block(y, start, stop, mysize, noise)
+
+        # Each block writes its own part of the output
+        list(pool.map(run, blocks))
+    return out
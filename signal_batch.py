@@ -0,0 +1,44 @@
+from contextlib import contextmanager
+import numpy as np
+
+# Signal and intermediate products shared by the algorithms of one batch task.
+# It is only set while algorithm_worker runs a batch, so nothing outlives the task.
+_batch = None
+
+@contextmanager
+def batch_scope(file_path, y, sr):
+    """
+    Makes (y, sr) the signal returned by pcm_cache.load_audio(file_path) for the duration of the batch.
+    """
+    global _batch
+
+    # Every algorithm of the batch sees the same array, so none of them may modify it
+    if y.flags.writeable:
+        y.setflags(write=False)
+
+    _batch = {'file': file_path, 'signal': (y, sr), 'products': {}}
+    try:
+        yield
+    finally:
+        _batch = None
+
+def active_signal(file_path):
+    if _batch is not None and _batch['file'] == file_path:
+        return _batch['signal']
+    return None
+
+def reuse(name, y, compute):
+    """
+    Returns compute(), memoized under name for the rest of the batch when y is the batch signal.
+    Outside a batch, or for any other array, compute() is simply called.
+    """
+    if _batch is None or y is not _batch['signal'][0]:
+        return compute()
+
+    products = _batch['products']
+    if name not in products:
+        value = compute()
+        if isinstance(value, np.ndarray):
+            value.setflags(write=False)
+        products[name] = value
+    return products[name]
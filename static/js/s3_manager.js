@@ -5,6 +5,12 @@ class S3Manager {
         this.bucketList = [];  // Store the list of buckets
         this.selectedBucket = null;  // Member variable to store the selected bucket
         this.accumulatedFiles = {};  // Dictionary to store selected files by bucket
+        this.currentPrefix = '';  // Folder shown in the file list
+        this.pageSize = 500;  // Files loaded per listing page
+        this.directUploads = null;  // Upload parts straight to S3 instead of through the server, asked from /upload_config
+        this.uploadConcurrency = 6;  // Parts in flight across all files of a direct upload
+        this.serverUploadConcurrency = 4;  // Files sent through /upload_files at the same time, one request each
+        this.partRetries = 3;
 
         this.init();
     }
@@ -53,14 +59,15 @@ class S3Manager {
             this.selectedBucket = $(event.target).val();
             console.log('Selected bucket:', this.selectedBucket);  // Log the selected bucket
 
-            // Now that we have the selected bucket, list its files
-            this.listFiles();
+            // Now that we have the selected bucket, list its files from the top
+            this.listFiles('');
         });
     }
 
 
-    // Method to list files in the selected bucket
-    listFiles() {
+    // Method to list files in the selected bucket, one page at a time.
+    // Keys are browsed like folders: prefix is the folder currently shown
+    listFiles(prefix = this.currentPrefix || '') {
         const selectedBucket = this.selectedBucket;
 
         if (!selectedBucket) {
@@ -68,28 +75,75 @@ class S3Manager {
             return;
         }
 
-        //console.log(`Listing files in bucket: ${this.selectedBucket}`);
+        this.currentPrefix = prefix;
+
+        // Clear the file list before appending the first page
+        $('#file-list').empty();
+
+        if (prefix) {
+            // Entry to go back to the parent folder
+            const parent = prefix.slice(0, prefix.slice(0, -1).lastIndexOf('/') + 1);
+            $('#file-list').append(`
+                <li class="list-group-item folder-item" data-prefix="${parent}" style="font-size: 1.7rem; cursor: pointer;">
+                    &#8617; ${prefix}
+                </li>
+            `);
+        }
+
+        this.listFilesPage(prefix, null);
+    }
+
+    // Fetch one listing page and append it to the file list
+    listFilesPage(prefix, continuationToken) {
+        const selectedBucket = this.selectedBucket;
+        const params = { bucket: selectedBucket, prefix: prefix, delimiter: '/', max_keys: this.pageSize };
+        if (continuationToken) {
+            params.continuation_token = continuationToken;
+        }
+
+        $('#load-more-files').remove();
 
         $.ajax({
-            url: '/list_files',
+            url: '/list_files_page',
             type: 'GET',
-            data: { bucket: selectedBucket },  // Send the selected bucket as a query parameter
+            data: params,
             success: (response) => {
-                // Clear the file list before appending new files
-                $('#file-list').empty();
-
-                if (response.files && response.files.length > 0) {
-                    response.files.forEach(file => {
-                        $('#file-list').append(`
-                            <li class="list-group-item" style="font-size: 1.7rem;">
-                                <input type="checkbox" class="file-checkbox" value="${file}" style="transform: scale(1.5);">
-                                ${file}
-                            </li>
-                        `);
-                    });
-                } else {
+                // Ignore pages of a folder or bucket that is no longer shown
+                if (selectedBucket !== this.selectedBucket || prefix !== this.currentPrefix) {
+                    return;
+                }
+
+                response.prefixes.forEach(folder => {
+                    $('#file-list').append(`
+                        <li class="list-group-item folder-item" data-prefix="${folder}" style="font-size: 1.7rem; cursor: pointer;">
+                            &#128193; ${folder.slice(prefix.length)}
+                        </li>
+                    `);
+                });
+
+                response.files.forEach(file => {
+                    $('#file-list').append(`
+                        <li class="list-group-item" style="font-size: 1.7rem;">
+                            <input type="checkbox" class="file-checkbox" value="${file.key}" style="transform: scale(1.5);">
+                            ${file.key}
+                        </li>
+                    `);
+                });
+
+                if (response.next_token) {
+                    $('#file-list').append(`
+                        <li class="list-group-item text-center" id="load-more-files" style="font-size: 1.7rem; cursor: pointer;">
+                            Load more...
+                        </li>
+                    `);
+                    $('#load-more-files').click(() => this.listFilesPage(prefix, response.next_token));
+                } else if ($('#file-list .file-checkbox, #file-list .folder-item').length === 0) {
                     $('#file-list').append(`<li class="list-group-item">No files found in bucket</li>`);
                 }
+
+                $('#file-list .folder-item').off('click').click((event) => {
+                    this.listFiles($(event.currentTarget).data('prefix'));
+                });
             },
             error: (error) => {
                 console.error(`Error listing files in bucket ${selectedBucket}:`, error);
@@ -202,7 +256,7 @@ class S3Manager {
 
 
     // Method to upload files to the selected bucket
-    uploadFiles(files) {
+    async uploadFiles(files) {
         const selectedBucket = this.getSelectedBucket();
 
         if (!selectedBucket) {
@@ -215,28 +269,239 @@ class S3Manager {
             return;
         }
 
+        if (await this.loadUploadConfig()) {
+            this.uploadFilesDirect(selectedBucket, Array.from(files));
+        } else {
+            this.uploadFilesThroughServer(selectedBucket, files);
+        }
+    }
+
+    // Ask the app once whether the browser may upload straight to S3
+    async loadUploadConfig() {
+        if (this.directUploads === null) {
+            try {
+                const response = await fetch('/upload_config');
+                this.directUploads = response.ok && (await response.json()).direct_uploads === true;
+            } catch (error) {
+                this.directUploads = false;
+            }
+        }
+        return this.directUploads;
+    }
+
+    // Send the files to the app, which passes them on to S3: one request per file,
+    // serverUploadConcurrency of them at a time
+    async uploadFilesThroughServer(selectedBucket, files) {
+        const queue = Array.from(files);
+        const results = [];
+
+        const runFileUploads = async () => {
+            while (queue.length > 0) {
+                results.push(await this.uploadFileThroughServer(selectedBucket, queue.shift()));
+            }
+        };
+        await Promise.all(Array.from({ length: this.serverUploadConcurrency }, runFileUploads));
+
+        results.forEach(file => {
+            if (file.status === 'uploaded') {
+                console.log(`${file.file_name}: ${file.status} (${file.size} bytes in ${file.seconds.toFixed(1)}s)`);
+            } else {
+                console.error(`${file.file_name}: ${file.error}`);
+            }
+        });
+        const uploaded = results.filter(file => file.status === 'uploaded').length;
+        if (uploaded === results.length) {
+            console.log(`Files uploaded successfully to ${selectedBucket}.`);
+        } else {
+            console.error(`${results.length - uploaded} of ${results.length} files could not be uploaded to bucket ${selectedBucket}.`);
+        }
+
+        // Refresh the file list after the upload, some of the files may have made it
+        if (uploaded > 0) {
+            this.listFiles();
+        }
+    }
+
+    // Send one file through /upload_files, resolves to its result (never rejects)
+    uploadFileThroughServer(selectedBucket, file) {
         const formData = new FormData();
         formData.append('bucket_name', selectedBucket);
 
-        // Append the files to the form data
-        for (let i = 0; i < files.length; i++) {
-            formData.append('files', files[i]);
+        // ID to follow the transfer from the server to S3
+        const uploadId = `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+        formData.append('upload_id', uploadId);
+
+        // The server reads the fields as they arrive, they must come before the file
+        formData.append('sizes', JSON.stringify({ [file.name]: file.size }));
+        formData.append('files', file);
+
+        let progressTimer = null;
+
+        return new Promise((resolve) => {
+            $.ajax({
+                url: '/upload_files',
+                type: 'POST',
+                processData: false,
+                contentType: false,
+                data: formData,
+                xhr: () => {
+                    const xhr = new window.XMLHttpRequest();
+                    // Progress of the browser sending the file to the server
+                    xhr.upload.addEventListener('progress', (event) => {
+                        if (event.lengthComputable) {
+                            console.log(`Sending ${file.name}: ${Math.round(100 * event.loaded / event.total)}%`);
+                        }
+                    });
+                    // The server sends the file on to S3 while it arrives, follow that from the start
+                    xhr.upload.addEventListener('loadstart', () => {
+                        progressTimer = setInterval(() => this.logUploadProgress(uploadId), 1000);
+                    });
+                    return xhr;
+                },
+                success: (response) => {
+                    clearInterval(progressTimer);
+                    resolve(response.files[0]);
+                },
+                error: (error) => {
+                    clearInterval(progressTimer);
+                    if (error.responseJSON && error.responseJSON.files && error.responseJSON.files.length > 0) {
+                        resolve(error.responseJSON.files[0]);
+                    } else {
+                        const message = (error.responseJSON && error.responseJSON.error) || error.statusText;
+                        resolve({ file_name: file.name, size: file.size, status: 'failed', error: message });
+                    }
+                }
+            });
+        });
+    }
+
+    // POST JSON to the app and return the parsed response, throwing on errors
+    async postJson(url, data) {
+        const response = await fetch(url, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(data)
+        });
+        const body = await response.json();
+        if (!response.ok) {
+            throw new Error(body.error || `${url} failed with status ${response.status}`);
+        }
+        return body;
+    }
+
+    // Upload files straight to S3: the app starts each multipart upload and hands out presigned
+    // part URLs, the parts of all files are PUT in parallel, then the app completes the uploads
+    async uploadFilesDirect(selectedBucket, files) {
+        const uploads = [];
+        const queue = [];
+        // Files that can't go straight to S3 are sent through the app instead
+        const fallback = [];
+
+        for (const file of files) {
+            try {
+                const upload = await this.postJson('/multipart_upload/initiate', {
+                    bucket_name: selectedBucket,
+                    file_name: file.name,
+                    size: file.size,
+                    content_type: file.type
+                });
+                const state = { file: file, upload: upload, etags: {}, sent: 0, failed: false };
+                uploads.push(state);
+                upload.parts.forEach(part => queue.push({ state: state, part: part }));
+            } catch (error) {
+                console.warn(`Could not start the direct upload of ${file.name}, sending it through the server:`, error);
+                fallback.push(file);
+            }
         }
 
+        // A fixed number of part uploads run at once, each takes the next part from the queue
+        const runPartUploads = async () => {
+            while (queue.length > 0) {
+                const { state, part } = queue.shift();
+                if (state.failed) {
+                    continue;
+                }
+                try {
+                    state.etags[part.part_number] = await this.uploadPart(state, part);
+                } catch (error) {
+                    state.failed = true;
+                    console.error(`Error uploading part ${part.part_number} of ${state.file.name}:`, error);
+                }
+            }
+        };
+        await Promise.all(Array.from({ length: this.uploadConcurrency }, runPartUploads));
+
+        for (const state of uploads) {
+            const params = {
+                bucket_name: selectedBucket,
+                file_name: state.upload.key,
+                upload_id: state.upload.upload_id
+            };
+            try {
+                if (state.failed) {
+                    throw new Error('some parts could not be uploaded');
+                }
+                params.parts = Object.entries(state.etags).map(([partNumber, etag]) => ({ part_number: Number(partNumber), etag: etag }));
+                await this.postJson('/multipart_upload/complete', params);
+                console.log(`${state.file.name}: uploaded (${state.file.size} bytes)`);
+            } catch (error) {
+                console.warn(`Direct upload of ${state.file.name} failed, sending it through the server:`, error);
+                // Don't leave the uploaded parts behind in the bucket
+                this.postJson('/multipart_upload/abort', params).catch(() => {});
+                fallback.push(state.file);
+            }
+        }
+
+        if (fallback.length > 0) {
+            // Refreshes the file list when done
+            this.uploadFilesThroughServer(selectedBucket, fallback);
+            return;
+        }
+
+        // Refresh the file list after the upload
+        this.listFiles();
+    }
+
+    // PUT one part of a file to its presigned URL, retrying failed attempts, and return its ETag
+    async uploadPart(state, part) {
+        const partSize = state.upload.part_size;
+        const start = (part.part_number - 1) * partSize;
+        const blob = state.file.slice(start, Math.min(start + partSize, state.file.size));
+
+        for (let attempt = 1; ; attempt++) {
+            try {
+                const response = await fetch(part.url, { method: 'PUT', body: blob });
+                if (!response.ok) {
+                    throw new Error(`status ${response.status}`);
+                }
+                const etag = response.headers.get('ETag');
+                if (!etag) {
+                    throw new Error('ETag header not readable, check the CORS configuration of the bucket');
+                }
+                state.sent += blob.size;
+                console.log(`${state.file.name}: ${Math.round(100 * state.sent / Math.max(state.file.size, 1))}%`);
+                return etag;
+            } catch (error) {
+                if (attempt >= this.partRetries) {
+                    throw error;
+                }
+            }
+        }
+    }
+
+    // Log how far each file of a running upload got on its way to S3
+    logUploadProgress(uploadId) {
         $.ajax({
-            url: '/upload_files',
-            type: 'POST',
-            processData: false,
-            contentType: false,
-            data: formData,
+            url: `/upload_progress/${uploadId}`,
+            type: 'GET',
             success: (response) => {
-                console.log(`Files uploaded successfully to ${selectedBucket}.`);
-
-                // Refresh the file list after successful upload
-                this.listFiles();
+                for (const [fileName, state] of Object.entries(response.files)) {
+                    const percent = state.size ? Math.round(100 * state.transferred / state.size) : 100;
+                    console.log(`${fileName}: ${state.status} ${percent}%`);
+                }
             },
-            error: (error) => {
-                console.error(`Error uploading files to bucket ${selectedBucket}:`, error);
+            error: () => {
+                // The upload finished in the meantime
             }
         });
     }
@@ -1,3 +1,22 @@
+// Follows the progress of a submitted job until all of its algorithm runs completed
+function pollJobStatus(jobId, interval = 2000) {
+    fetch(`/job_status/${jobId}`)
+        .then(response => response.json())
+        .then(status => {
+            if (status.error) {
+                console.error('Job status error:', status.error);
+                return;
+            }
+            console.log(`Job ${jobId}: ${status.state}, ${status.runs_completed}/${status.runs_expected} runs completed, ${status.runs_failed} failed`);
+            if (status.state === 'queued' || status.state === 'running') {
+                setTimeout(() => pollJobStatus(jobId, interval), interval);
+            }
+        })
+        .catch(error => {
+            console.error('Error:', error);
+        });
+}
+
 $(document).ready(function() {
     // Usage Example: Initialize the S3Manager
     const s3Manager = new S3Manager();
@@ -106,6 +125,9 @@ $(document).ready(function() {
                     console.log('Success:', data);
                     // Hide the modal after confirmation
                     $('#confirmationModal').modal('hide');
+                    if (data.job_id) {
+                        pollJobStatus(data.job_id);
+                    }
                 })
                 .catch(error => {
                     console.error('Error:', error);
@@ -0,0 +1,190 @@
+import os
+import hashlib
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+from metrics import counter, gauge
+
+# Spectra of the signals the spectral algorithms (and their spectrogram plots) compute, keyed by
+# a hash of the samples and the STFT parameters. Algorithms run in-process by an algorithm worker
+# share the memory tier, across the algorithms of a file and across tasks for the same file;
+# with STFT_CACHE_DIR set, spectra are also written there for the other workers and for
+# algorithms run as subprocesses.
+
+# Size of the in-memory tier (spectra and dB spectrograms), least recently used evicted first
+STFT_CACHE_BYTES = int(float(os.getenv('STFT_CACHE_MB', '512')) * 1024 ** 2)
+
+# Directory of the on-disk tier, empty keeps the cache in memory only
+STFT_CACHE_DIR = os.getenv('STFT_CACHE_DIR', '')
+
+# Size quota of the on-disk tier, the least recently used files are removed past it
+STFT_CACHE_DISK_QUOTA = int(float(os.getenv('STFT_CACHE_DISK_GB', '5')) * 1024 ** 3)
+
+STFT_CACHE_REQUESTS = counter('stft_cache_requests_total', 'Spectra served from memory, from disk or computed', ['kind', 'result'])
+STFT_CACHE_SIZE = gauge('stft_cache_bytes', 'Bytes held by the in-memory STFT cache')
+
+# Content hashes of read-only arrays (the batch signal, mapped PCM caches), which can't change
+_hashes = {}
+
+
+def content_hash(y):
+    """
+    Hash of the samples, dtype and shape of y.
+    """
+    y = np.asarray(y)
+    memo = _hashes.get(id(y))
+    if memo is not None and memo[0]() is y:
+        return memo[1]
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{y.dtype.str}{y.shape}".encode())
+    digest.update(memoryview(np.ascontiguousarray(y)).cast('B'))
+    value = digest.hexdigest()
+
+    if not y.flags.writeable:
+        try:
+            _hashes[id(y)] = (weakref.ref(y, lambda _, key=id(y): _hashes.pop(key, None)), value)
+        except TypeError:
+            pass
+    return value
+
+
+def stft_key(y, kind, n_fft, hop_length, win_length, window, center):
+    # librosa's defaults spelled out, so stft(y) and stft(y, hop_length=512) are the same entry
+    hop_length = n_fft // 4 if hop_length is None else hop_length
+    win_length = n_fft if win_length is None else win_length
+    return f"{content_hash(y)}-{kind}-{n_fft}-{hop_length}-{win_length}-{window}-{int(center)}"
+
+
+class STFTCache:
+    def __init__(self, max_bytes=STFT_CACHE_BYTES, directory=STFT_CACHE_DIR, disk_quota=STFT_CACHE_DISK_QUOTA):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_quota = disk_quota
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key, kind, compute):
+        """
+        Returns the read-only array cached under key, computing (and storing) it on a miss.
+        """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                STFT_CACHE_REQUESTS.inc(kind=kind, result='memory')
+                return value
+
+        value = self.read(key)
+        result = 'disk'
+        if value is None:
+            value = np.asarray(compute())
+            value.setflags(write=False)
+            self.write(key, value)
+            result = 'miss'
+        STFT_CACHE_REQUESTS.inc(kind=kind, result=result)
+
+        self.store(key, value)
+        return value
+
+    def store(self, key, value):
+        # A spectrum bigger than the whole tier is only kept on disk
+        if value.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = value
+            self.size += value.nbytes
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.nbytes
+            STFT_CACHE_SIZE.set(self.size)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def read(self, key):
+        if not self.directory:
+            return None
+        path = self.path(key)
+        try:
+            value = np.load(path, mmap_mode='r')
+            # Last use, for the quota
+            os.utime(path)
+            return value
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logging.warning(f"Could not read the cached spectrum {path}", exc_info=True)
+            return None
+
+    def write(self, key, value):
+        if not self.directory:
+            return
+        path = self.path(key)
+        # Written under a temporary name and renamed, so other workers never map a partial file
+        tmp_path = f"{path}.tmp{os.getpid()}-{threading.get_ident()}.npy"
+        try:
+            np.save(tmp_path, value)
+            os.replace(tmp_path, path)
+            self.enforce_quota()
+        except OSError:
+            logging.warning(f"Could not write the cached spectrum {path}", exc_info=True)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def enforce_quota(self):
+        if not self.disk_quota:
+            return
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npy') and '.tmp' not in entry.name:
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_quota:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+_cache = None
+_cache_guard = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    with _cache_guard:
+        if _cache is None:
+            _cache = STFTCache()
+        return _cache
+
+
+def stft(y, n_fft=2048, hop_length=None, win_length=None, window='hann', center=True):
+    """
+    librosa.stft(y) with the same parameters, computed once per signal. The array is read-only.
+    """
+    import librosa
+    key = stft_key(y, 'stft', n_fft, hop_length, win_length, window, center)
+    return get_cache().get(key, 'stft', lambda: librosa.stft(y, n_fft=n_fft, hop_length=hop_length,
+                                                             win_length=win_length, window=window, center=center))
+
+
+def stft_db(y, n_fft=2048, hop_length=None, win_length=None, window='hann', center=True):
+    """
+    The dB spectrogram the algorithms plot, amplitude_to_db(|stft(y)|, ref=np.max), computed once per signal.
+    """
+    import librosa
+    key = stft_key(y, 'db', n_fft, hop_length, win_length, window, center)
+    return get_cache().get(key, 'db', lambda: librosa.amplitude_to_db(
+        np.abs(stft(y, n_fft, hop_length, win_length, window, center)), ref=np.max))
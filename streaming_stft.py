@@ -0,0 +1,243 @@
+import os
+import math
+import numpy as np
+from scipy.signal import get_window
+
+# Block by block STFT processing for signals too long to hold their whole spectrogram, e.g.
+# hours of audio mapped from the PCM cache. Frames are taken like librosa.stft (centered, zero
+# padded) and resynthesized like librosa.istft (windowed overlap-add divided by the summed
+# squared window), so the output is the same as processing the full STFT at once, while only
+# one block of frames and its overlap are in memory. Whatever needs the whole signal (the peak
+# magnitude behind ref=np.max, the first frames of a noise estimate) is gathered by a first pass.
+
+# Signals at least this long (seconds) are processed as a stream by the spectral algorithms;
+# 0 streams every file, inf never does
+STREAMING_STFT_MIN_SECONDS = float(os.getenv('STREAMING_STFT_MIN_SECONDS', '1800'))
+
+# Frames transformed at a time, 2048 frames of 2048 samples are ~16 MB of complex64 spectra
+STREAMING_STFT_BLOCK_FRAMES = int(os.getenv('STREAMING_STFT_BLOCK_FRAMES', '2048'))
+
+# Columns of the overview spectrograms and waveforms plotted for a streamed signal
+STREAMING_PLOT_COLUMNS = int(os.getenv('STREAMING_PLOT_COLUMNS', '4000'))
+
+
+def use_streaming(y, sr):
+    return np.ndim(y) == 1 and len(y) >= STREAMING_STFT_MIN_SECONDS * sr
+
+
+def amplitude_to_db(S, ref, amin=1e-5, top_db=80.0):
+    """
+    librosa.amplitude_to_db(S, ref=<global peak>) for one block: with ref the peak magnitude of the
+    whole signal, the top_db floor is simply -top_db.
+    """
+    power = np.square(np.abs(S))
+    db = 10.0 * np.log10(np.maximum(amin ** 2, power))
+    db -= 10.0 * np.log10(max(amin ** 2, ref ** 2))
+    return np.maximum(db, -top_db)
+
+
+def db_to_amplitude(S_db):
+    # librosa.db_to_amplitude with ref=1.0
+    return np.power(10.0, 0.05 * S_db)
+
+
+class PeakEnvelope:
+    """
+    Minimum and maximum of every samples_per_column samples of a signal fed in pieces, for plotting.
+    """
+    def __init__(self, samples_per_column):
+        self.samples_per_column = samples_per_column
+        self.carry = np.empty(0, dtype=np.float32)
+        self.minima = []
+        self.maxima = []
+
+    def add(self, samples):
+        samples = np.concatenate([self.carry, samples])
+        whole = len(samples) - len(samples) % self.samples_per_column
+        if whole:
+            columns = samples[:whole].reshape(-1, self.samples_per_column)
+            self.minima.append(columns.min(axis=1))
+            self.maxima.append(columns.max(axis=1))
+        self.carry = samples[whole:]
+
+    def result(self):
+        # The last, shorter column, of the samples it has
+        if len(self.carry):
+            self.minima.append(self.carry.min(keepdims=True))
+            self.maxima.append(self.carry.max(keepdims=True))
+            self.carry = self.carry[:0]
+        if not self.minima:
+            return np.empty(0), np.empty(0)
+        return np.concatenate(self.minima), np.concatenate(self.maxima)
+
+
+class StreamingSTFT:
+    def __init__(self, n_fft=2048, hop_length=None, window='hann', block_frames=STREAMING_STFT_BLOCK_FRAMES):
+        self.n_fft = n_fft
+        self.hop_length = n_fft // 4 if hop_length is None else hop_length
+        self.window = get_window(window, n_fft, fftbins=True).astype(np.float32)
+        self.block_frames = max(1, block_frames)
+
+    def n_frames(self, length):
+        # Centered frames, as many as librosa.stft returns
+        return 1 + length // self.hop_length
+
+    def output_length(self, length):
+        # What librosa.istft returns for them without length=
+        return self.hop_length * (self.n_frames(length) - 1)
+
+    def padded(self, y, start, stop):
+        """
+        y[start - n_fft // 2:stop - n_fft // 2] of the zero padded signal, as float32.
+        """
+        offset = self.n_fft // 2
+        segment = np.zeros(stop - start, dtype=np.float32)
+        lo, hi = max(start - offset, 0), min(stop - offset, len(y))
+        if hi > lo:
+            segment[lo - (start - offset):hi - (start - offset)] = y[lo:hi]
+        return segment
+
+    def blocks(self, y, block_frames=None):
+        """
+        Yields (first frame, spectra) for consecutive blocks of frames of y, spectra shaped
+        (1 + n_fft // 2, frames) like librosa.stft.
+        """
+        block_frames = block_frames or self.block_frames
+        total = self.n_frames(len(y))
+        for first in range(0, total, block_frames):
+            frames = min(block_frames, total - first)
+            start = first * self.hop_length
+            segment = self.padded(y, start, start + (frames - 1) * self.hop_length + self.n_fft)
+            framed = np.lib.stride_tricks.sliding_window_view(segment, self.n_fft)[::self.hop_length]
+            yield first, np.fft.rfft(framed * self.window, axis=1).astype(np.complex64).T
+
+    def overlap_add(self, spectra_blocks, length):
+        """
+        Resynthesizes the blocks of spectra yielded by blocks() (processed or not), yielding the
+        output samples as soon as no later frame overlaps them.
+        """
+        hop, n_fft = self.hop_length, self.n_fft
+        trim = n_fft // 2
+        remaining = self.output_length(length)
+        window_square = np.square(self.window, dtype=np.float64)
+        tiny = np.finfo(np.float32).tiny
+
+        # Accumulated samples and squared window from position `origin` of the padded output on
+        origin = 0
+        signal = np.zeros(n_fft)
+        weight = np.zeros(n_fft)
+
+        for first, spectra in spectra_blocks:
+            frames = spectra.shape[1]
+            frames_time = np.fft.irfft(spectra.T, n=n_fft, axis=1) * self.window
+
+            end = (first + frames - 1) * hop + n_fft
+            if end - origin > len(signal):
+                signal = np.concatenate([signal, np.zeros(end - origin - len(signal))])
+                weight = np.concatenate([weight, np.zeros(end - origin - len(weight))])
+            position = first * hop - origin
+            if n_fft % hop == 0:
+                # Every hop-long slice of the frames lands on a hop-aligned stretch of the output
+                slices = frames_time.reshape(frames, n_fft // hop, hop)
+                square_slices = window_square.reshape(n_fft // hop, hop)
+                for k in range(n_fft // hop):
+                    stretch = slice(position + k * hop, position + (k + frames) * hop)
+                    signal[stretch] += slices[:, k].ravel()
+                    weight[stretch] += np.tile(square_slices[k], frames)
+            else:
+                for i in range(frames):
+                    at = position + i * hop
+                    signal[at:at + n_fft] += frames_time[i]
+                    weight[at:at + n_fft] += window_square
+
+            # Samples before the start of the next frame are final
+            done = (first + frames) * hop - origin
+            out = signal[:done]
+            nonzero = weight[:done] > tiny
+            out[nonzero] /= weight[:done][nonzero]
+
+            # The first n_fft // 2 samples are the centering padding
+            skip = min(max(trim - origin, 0), done)
+            chunk = out[skip:skip + remaining]
+            remaining -= len(chunk)
+            if len(chunk):
+                yield chunk.astype(np.float32)
+
+            signal = signal[done:].copy()
+            weight = weight[done:].copy()
+            origin += done
+
+        # Whatever istft keeps of the tail
+        if remaining > 0:
+            skip = max(trim - origin, 0)
+            out = signal[skip:skip + remaining]
+            nonzero = weight[skip:skip + remaining] > tiny
+            out[nonzero] /= weight[skip:skip + remaining][nonzero]
+            yield out.astype(np.float32)
+
+
+def spectrum_statistics(engine, y, head_frames=10):
+    """
+    First pass: the peak magnitude of the whole spectrogram (librosa's ref=np.max) and the
+    magnitudes of its first head_frames frames.
+    """
+    peak = 0.0
+    head = []
+    for first, spectra in engine.blocks(y):
+        magnitude = np.abs(spectra)
+        if magnitude.size:
+            peak = max(peak, float(magnitude.max()))
+        if first < head_frames:
+            head.append(magnitude[:, :head_frames - first])
+    return peak, np.concatenate(head, axis=1) if head else np.empty((engine.n_fft // 2 + 1, 0))
+
+
+def stream_process(engine, y, sr, process, write, plot_columns=STREAMING_PLOT_COLUMNS):
+    """
+    Second pass: applies process(spectra, first_frame) to every block of spectra of y and passes
+    the resynthesized signal to write() block by block.
+
+    Returns an overview for plotting: the input and processed spectra max-pooled over
+    'pool' frames each, and the min/max of the input and output waveforms per column.
+    """
+    total = engine.n_frames(len(y))
+    pool = max(1, math.ceil(total / plot_columns))
+    # Whole pools per block, so no pool straddles two blocks
+    block_frames = math.ceil(engine.block_frames / pool) * pool
+    starts = np.arange(0, block_frames, pool)
+
+    input_columns, processed_columns = [], []
+    input_waveform = PeakEnvelope(pool * engine.hop_length)
+    output_waveform = PeakEnvelope(pool * engine.hop_length)
+
+    def processed_blocks():
+        for first, spectra in engine.blocks(y, block_frames):
+            # Decoded audio is at most block sized here, the waveform is read a block at a time
+            start = first * engine.hop_length
+            input_waveform.add(np.asarray(y[start:start + spectra.shape[1] * engine.hop_length], dtype=np.float32))
+
+            processed = process(spectra, first)
+            frames_starts = starts[starts < spectra.shape[1]]
+            input_columns.append(np.maximum.reduceat(np.abs(spectra), frames_starts, axis=1))
+            processed_columns.append(np.maximum.reduceat(np.abs(processed), frames_starts, axis=1))
+            yield first, processed
+
+    for samples in engine.overlap_add(processed_blocks(), len(y)):
+        output_waveform.add(samples)
+        write(samples)
+
+    empty = np.empty((engine.n_fft // 2 + 1, 0))
+    return {
+        'pool': pool,
+        'hop_length': pool * engine.hop_length,
+        'input_spectrum': np.concatenate(input_columns, axis=1) if input_columns else empty,
+        'processed_spectrum': np.concatenate(processed_columns, axis=1) if processed_columns else empty,
+        'input_waveform': input_waveform.result(),
+        'output_waveform': output_waveform.result()
+    }
+
+
+def overview_db(magnitudes):
+    # The overview spectrogram in dB, relative to its own peak like the full plots
+    peak = float(magnitudes.max()) if magnitudes.size else 0.0
+    return amplitude_to_db(magnitudes, peak)
@@ -0,0 +1,105 @@
+import zmq
+import os
+import json
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+
+# Submissions from the Flask app go to the download router through a small pool of
+# long-lived DEALER sockets on the process-wide ZMQ context, instead of a new context
+# and socket per request.
+DOWNLOAD_ROUTER_ENDPOINT = os.getenv('DOWNLOAD_ROUTER_ENDPOINT', 'tcp://localhost:5557')
+
+SUBMISSION_POOL_SIZE = int(os.getenv('SUBMISSION_POOL_SIZE', '4'))
+
+# Send all tasks of a submission as one multipart message (one frame per task);
+# the router splits it into individual tasks
+SUBMISSION_BATCH = os.getenv('SUBMISSION_BATCH', '1') == '1'
+
+# Queued messages per socket before sends fail with zmq.Again
+SUBMISSION_SNDHWM = int(os.getenv('SUBMISSION_SNDHWM', '1000'))
+
+
+class SubmissionClient:
+    """
+    Thread-safe client for the download router. ZMQ sockets must not be shared between
+    threads, so every send checks a socket out of the pool and returns it afterwards.
+    """
+    def __init__(self, endpoint=DOWNLOAD_ROUTER_ENDPOINT, pool_size=SUBMISSION_POOL_SIZE,
+                 batch=SUBMISSION_BATCH, context=None):
+        self.context = context or zmq.Context.instance()
+        self.endpoint = endpoint
+        self.batch = batch
+        self.pool = queue.LifoQueue()
+        self.pool_size = pool_size
+        self.created = 0
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def create_socket(self):
+        socket = self.context.socket(zmq.DEALER)  # Dealer to forword to router
+        socket.setsockopt(zmq.SNDHWM, SUBMISSION_SNDHWM)
+        socket.setsockopt(zmq.LINGER, 1000)
+        socket.connect(self.endpoint)
+        logging.info(f"Submission socket connected to {self.endpoint}")
+        return socket
+
+    @contextmanager
+    def socket(self):
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Submission client is closed")
+            create = self.pool.empty() and self.created < self.pool_size
+            if create:
+                self.created += 1
+
+        if create:
+            try:
+                socket = self.create_socket()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        else:
+            # All sockets are in use, wait for one to come back
+            socket = self.pool.get()
+
+        try:
+            yield socket
+        finally:
+            self.pool.put(socket)
+
+    def submit(self, tasks):
+        """
+        Sends the tasks (JSON-serializable dicts) to the download router without blocking.
+        Returns the tasks that could not be queued.
+        """
+        if not tasks:
+            return []
+
+        frames = [json.dumps(task).encode('utf-8') for task in tasks]
+
+        with self.socket() as socket:
+            if self.batch:
+                try:
+                    socket.send_multipart(frames, zmq.NOBLOCK)
+                    return []
+                except zmq.Again:
+                    logging.warning(f"Download router queue is full, could not send {len(tasks)} tasks")
+                    return list(tasks)
+
+            failed = []
+            for task, frame in zip(tasks, frames):
+                try:
+                    socket.send(frame, zmq.NOBLOCK)
+                except zmq.Again:
+                    logging.warning(f"Download router queue is full, could not send task: {task}")
+                    failed.append(task)
+            return failed
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        while not self.pool.empty():
+            self.pool.get().close()
@@ -0,0 +1,88 @@
+"""
+Compares the envelope alg_EMD computes with the full decomposition, slow_modes(EMD().emd(x)), with
+the fast decimated one of fast_emd (EMD_FAST=1), on signal files as alg_EMD reads them. --last N
+compares the sums of the last N IMFs instead, what alg_EMD used to keep.
+
+    python tools/emd_comparison.py signal1.csv signal2.txt            # real inputs
+    python tools/emd_comparison.py --synthetic 50000 100000 200000    # respiration-like test signals
+
+For every input: the run time of both, the correlation of the two envelopes and their RMS
+difference relative to the RMS of the full envelope.
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from scipy.signal import resample_poly
+from scipy.interpolate import CubicSpline
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyEMD import EMD
+from fast_emd import fast_emd_envelope, slow_modes, decimation_factor, EMD_MAX_SIFTINGS
+
+
+def synthetic_signal(length, seed=0):
+    # Breathing at ~0.25 Hz sampled at 100 Hz, with a slow drift, a heartbeat ripple and noise
+    rng = np.random.default_rng(seed)
+    t = np.arange(length) / 100.0
+    rate = 0.25 + 0.03 * np.sin(2 * np.pi * t / 120)
+    breathing = np.sin(2 * np.pi * np.cumsum(rate) / 100.0)
+    drift = 0.5 * np.sin(2 * np.pi * t / 600)
+    ripple = 0.1 * np.sin(2 * np.pi * 1.2 * t)
+    return breathing + drift + ripple + 0.2 * rng.standard_normal(length)
+
+
+def last_imfs_fast(signal, last):
+    # fast_emd's decimated path, keeping the last IMFs
+    factor = decimation_factor(len(signal))
+    IMFs = EMD(MAX_ITERATION=EMD_MAX_SIFTINGS).emd(resample_poly(signal, 1, factor))
+    envelope = np.sum(IMFs[-last:], axis=0)
+    return CubicSpline(np.arange(len(envelope)) * factor, envelope)(np.arange(len(signal)))
+
+
+def compare(signal, last=None):
+    started_at = time.time()
+    IMFs = EMD().emd(signal)
+    full = np.sum(IMFs[-last:], axis=0) if last else slow_modes(IMFs)
+    full_seconds = time.time() - started_at
+
+    started_at = time.time()
+    fast = last_imfs_fast(signal, last) if last else fast_emd_envelope(signal)
+    fast_seconds = time.time() - started_at
+
+    rms = np.sqrt(np.mean(full ** 2))
+    return {
+        'samples': len(signal),
+        'full_seconds': full_seconds,
+        'fast_seconds': fast_seconds,
+        'correlation': float(np.corrcoef(full, fast)[0, 1]),
+        'relative_rms_error': float(np.sqrt(np.mean((full - fast) ** 2)) / rms) if rms else float('nan')
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help='signal files, one column of samples')
+    parser.add_argument('--synthetic', nargs='*', type=int, default=[], metavar='SAMPLES',
+                        help='lengths of synthetic respiration signals to compare on')
+    parser.add_argument('--last', type=int, default=None, metavar='N',
+                        help='compare the sums of the last N IMFs instead of the slow modes')
+    args = parser.parse_args()
+
+    inputs = [(path, lambda path=path: np.loadtxt(path, delimiter=',' if path.endswith('.csv') else None))
+              for path in args.files]
+    inputs += [(f"synthetic-{length}", lambda length=length: synthetic_signal(length)) for length in args.synthetic]
+    if not inputs:
+        parser.error("Give signal files or --synthetic lengths")
+
+    print(f"{'input':<40} {'samples':>9} {'full s':>8} {'fast s':>8} {'corr':>7} {'rel rms':>8}")
+    for name, load in inputs:
+        result = compare(np.asarray(load(), dtype=np.float64).ravel(), args.last)
+        print(f"{name:<40} {result['samples']:>9} {result['full_seconds']:>8.1f} {result['fast_seconds']:>8.1f} "
+              f"{result['correlation']:>7.3f} {result['relative_rms_error']:>8.3f}")
+
+
+if __name__ == '__main__':
+    main()
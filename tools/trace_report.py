@@ -0,0 +1,149 @@
+"""
+Puts the spans written by the pipeline (TRACING=1) back together, from TRACE_FILE
+(/tmp/pipeline_traces/traces.jsonl by default) and the rotated TRACE_FILE.1 when there is one.
+
+    python tools/trace_report.py traces.jsonl                  # slowest stages over all traces
+    python tools/trace_report.py traces.jsonl --key a.wav      # journey of the latest trace of a file
+    python tools/trace_report.py traces.jsonl --trace <id>     # journey of one trace (trace_id in /job_status)
+    python tools/trace_report.py traces.jsonl --job <job id>   # journeys of all the files of a job
+
+Self time is a span's duration minus that of its children: for an 'algorithm' span it is the
+DSP itself, with loading the signal and the algorithm's plotting/saving functions in their own spans.
+Several files (e.g. one per host) can be given.
+"""
+import sys
+import json
+import argparse
+from collections import defaultdict
+
+
+def load_spans(paths):
+    spans = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    spans.append(json.loads(line))
+    return spans
+
+
+def group_traces(spans):
+    traces = defaultdict(list)
+    for span in spans:
+        traces[span['trace_id']].append(span)
+    return traces
+
+
+def self_times(spans):
+    children = defaultdict(float)
+    for span in spans:
+        if span['parent_id']:
+            children[span['parent_id']] += span['duration']
+    # Children running in parallel (e.g. output uploads) can add up to more than their parent
+    return {span['span_id']: max(0.0, span['duration'] - children[span['span_id']]) for span in spans}
+
+
+def find_traces(traces, key=None, job=None):
+    selected = []
+    for trace_id, spans in traces.items():
+        roots = [span for span in spans if span['name'] == 'submit']
+        attributes = roots[0]['attributes'] if roots else {}
+        if key is not None and attributes.get('key') != key:
+            continue
+        if job is not None and attributes.get('job_id') != job:
+            continue
+        selected.append((min(span['start'] for span in spans), trace_id))
+    return [trace_id for _, trace_id in sorted(selected)]
+
+
+def print_trace(trace_id, spans):
+    spans = sorted(spans, key=lambda span: span['start'])
+    by_parent = defaultdict(list)
+    ids = {span['span_id'] for span in spans}
+    for span in spans:
+        # Spans whose parent was not recorded are shown at the top level
+        by_parent[span['parent_id'] if span['parent_id'] in ids else None].append(span)
+    selfs = self_times(spans)
+    origin = spans[0]['start']
+    end = max(span['end'] for span in spans)
+
+    root = next((span for span in spans if span['name'] == 'submit'), None)
+    title = f"{root['attributes'].get('bucket')}/{root['attributes'].get('key')}" if root else ''
+    print(f"Trace {trace_id} {title}: {end - origin:.3f}s end to end")
+    print(f"{'offset':>9} {'duration':>9} {'self':>9}  span")
+
+    def walk(parent_id, depth):
+        for span in by_parent.get(parent_id, []):
+            details = ', '.join(f"{name}={value}" for name, value in span['attributes'].items()
+                                if name in ('algorithm', 'cached', 'size', 'files', 'bytes', 'error'))
+            status = '' if span['status'] == 'ok' else f" [{span['status']}]"
+            print(f"{span['start'] - origin:>9.3f} {span['duration']:>9.3f} {selfs[span['span_id']]:>9.3f}  "
+                  f"{'  ' * depth}{span['name']}{status} {details} ({span['component']} {span['pid']})")
+            walk(span['span_id'], depth + 1)
+
+    walk(None, 0)
+
+    slowest = max(spans, key=lambda span: selfs[span['span_id']])
+    print(f"Slowest stage: {stage_name(slowest)}, {selfs[slowest['span_id']]:.3f}s of its own\n")
+
+
+def stage_name(span):
+    algorithm = span['attributes'].get('algorithm')
+    return f"{span['name']} ({algorithm})" if algorithm and span['name'] == 'algorithm' else span['name']
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def print_summary(traces):
+    stages = defaultdict(list)
+    slowest = defaultdict(int)
+    for spans in traces.values():
+        selfs = self_times(spans)
+        for span in spans:
+            stages[stage_name(span)].append(selfs[span['span_id']])
+        slowest[stage_name(max(spans, key=lambda span: selfs[span['span_id']]))] += 1
+
+    print(f"{len(traces)} traces")
+    print(f"{'stage':<40} {'spans':>7} {'p50 s':>9} {'p95 s':>9} {'total s':>10} {'slowest in':>11}")
+    for name, values in sorted(stages.items(), key=lambda item: -sum(item[1])):
+        print(f"{name:<40} {len(values):>7} {percentile(values, 0.5):>9.3f} {percentile(values, 0.95):>9.3f} "
+              f"{sum(values):>10.3f} {slowest[name]:>11}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', default=['traces.jsonl'])
+    parser.add_argument('--trace', help='trace ID')
+    parser.add_argument('--key', help='S3 key of the file, its latest trace is shown')
+    parser.add_argument('--job', help='job ID, every file of the job is shown')
+    args = parser.parse_args()
+
+    traces = group_traces(load_spans(args.files))
+    if not traces:
+        sys.exit("No spans found")
+
+    if args.trace:
+        if args.trace not in traces:
+            sys.exit(f"No spans of trace {args.trace}")
+        print_trace(args.trace, traces[args.trace])
+    elif args.key:
+        found = find_traces(traces, key=args.key)
+        if not found:
+            sys.exit(f"No trace of {args.key}")
+        print_trace(found[-1], traces[found[-1]])
+    elif args.job:
+        found = find_traces(traces, job=args.job)
+        if not found:
+            sys.exit(f"No trace of job {args.job}")
+        for trace_id in found:
+            print_trace(trace_id, traces[trace_id])
+    else:
+        print_summary(traces)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+
+# Spans of one file's way through the pipeline. process_data starts a trace for every file
+# and the trace context ({'trace_id', 'parent_id', 'sent_at'}) travels in the 'trace' field
+# of the ZMQ tasks, so the download and algorithm workers add their spans to the same trace.
+# Every process appends its finished spans as JSON lines to TRACE_FILE; tools/trace_report.py
+# puts a trace back together and points at its slowest stage.
+TRACING = os.getenv('TRACING', '0') == '1'
+
+# Absolute, so the workers write to the same file whatever directory they are started from
+TRACE_FILE = os.path.abspath(os.getenv('TRACE_FILE', '/tmp/pipeline_traces/traces.jsonl'))
+
+# Past this size TRACE_FILE is renamed to TRACE_FILE.1 (replacing the previous one) and started over
+TRACE_FILE_MAX_BYTES = int(float(os.getenv('TRACE_FILE_MAX_MB', '100')) * 1024 ** 2)
+
+# Recorded with every span, e.g. download_worker or app
+COMPONENT = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+
+_local = threading.local()
+_export_lock = threading.Lock()
+_export_fd = None
+
+
+def is_current(fd):
+    # False once another process has rotated the file this descriptor writes to
+    try:
+        return os.stat(TRACE_FILE).st_ino == os.fstat(fd).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def export(record):
+    global _export_fd, TRACING
+    line = (json.dumps(record, default=str) + '\n').encode('utf-8')
+    with _export_lock:
+        try:
+            if _export_fd is not None and not is_current(_export_fd):
+                os.close(_export_fd)
+                _export_fd = None
+            if _export_fd is None:
+                os.makedirs(os.path.dirname(TRACE_FILE), exist_ok=True)
+                # O_APPEND keeps the lines of all the processes sharing the file whole
+                _export_fd = os.open(TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            elif TRACE_FILE_MAX_BYTES and os.fstat(_export_fd).st_size >= TRACE_FILE_MAX_BYTES:
+                # The other processes notice the rename before their next write and reopen
+                os.replace(TRACE_FILE, TRACE_FILE + '.1')
+                os.close(_export_fd)
+                _export_fd = os.open(TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.write(_export_fd, line)
+        except OSError:
+            logging.warning(f"Could not write spans to {TRACE_FILE}, tracing is off", exc_info=True)
+            TRACING = False
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id, start=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.start = time.time() if start is None else start
+        self.attributes = dict(attributes or {})
+        self.ended = False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def context(self):
+        # What a message carries so the receiver's spans become children of this one
+        return {'trace_id': self.trace_id, 'parent_id': self.span_id, 'sent_at': time.time()}
+
+    def end(self, status='ok', end=None, **attributes):
+        if self.ended:
+            return
+        self.ended = True
+        self.attributes.update(attributes)
+        end = time.time() if end is None else end
+        export({
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'end': end,
+            'duration': end - self.start,
+            'status': status,
+            'component': COMPONENT,
+            'pid': os.getpid(),
+            'attributes': self.attributes
+        })
+
+
+class NullSpan:
+    """
+    Stands in for a span when there is no trace to add it to, so callers never check.
+    """
+    def set(self, **attributes):
+        pass
+
+    def context(self):
+        return None
+
+    def end(self, status='ok', end=None, **attributes):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def new_trace():
+    return {'trace_id': uuid.uuid4().hex}
+
+
+def current():
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def start_span(name, context=None, start=None, **attributes):
+    """
+    Starts a span under context (a trace context received in a message) or under the current
+    span of this thread. Without either, or with tracing off, a NullSpan is returned.
+    """
+    if not TRACING:
+        return NULL_SPAN
+    if context:
+        return Span(name, context['trace_id'], context.get('parent_id'), start, attributes)
+    parent = current()
+    if parent is None:
+        return NULL_SPAN
+    return Span(name, parent.trace_id, parent.span_id, start, attributes)
+
+
+@contextmanager
+def activate(span):
+    """
+    Makes span the parent of the spans started by this thread inside the block, e.g. on a transfer thread.
+    """
+    if span is NULL_SPAN:
+        yield span
+        return
+    stack = _local.__dict__.setdefault('stack', [])
+    stack.append(span)
+    try:
+        yield span
+    finally:
+        stack.pop()
+
+
+@contextmanager
+def span(name, context=None, **attributes):
+    """
+    Times the block as a span; an exception marks it as failed and is raised again.
+    """
+    s = start_span(name, context, **attributes)
+    with activate(s):
+        try:
+            yield s
+        except Exception as e:
+            s.end(status='error', error=str(e))
+            raise
+        s.end()
+
+
+def record_span(name, context, start, end, **attributes):
+    """
+    Records an interval measured elsewhere, e.g. the time a task waited in a router.
+    """
+    if context and start is not None:
+        start_span(name, context, start=start, **attributes).end(end=end)
+
+
+def traced(name):
+    """
+    Decorator making every call of the function a span when it happens inside a trace, e.g. the
+    functions of the algorithms that plot and write their outputs.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if current() is None:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
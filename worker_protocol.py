@@ -0,0 +1,218 @@
+import zmq
+import os
+import time
+import logging
+from collections import deque
+from metrics import counter, gauge, histogram
+
+# Load-aware dispatch between a router and its workers, following the Paranoid Pirate pattern:
+# a worker sends READY once for every free task slot, the router only hands a task to a
+# worker that has a free slot, and both sides heartbeat while the worker is idle so that
+# dead workers (or a dead router) are noticed.
+
+# 'lru' only hands tasks to workers that announced free capacity,
+# 'roundrobin' is the plain DEALER fan-out used before
+WORKER_DISPATCH = os.getenv('WORKER_DISPATCH', 'lru')
+
+# Control frames
+READY = b"\x01"
+HEARTBEAT = b"\x02"
+
+HEARTBEAT_INTERVAL = float(os.getenv('HEARTBEAT_INTERVAL', '1.0'))  # seconds
+HEARTBEAT_LIVENESS = int(os.getenv('HEARTBEAT_LIVENESS', '5'))  # missed heartbeats before a peer is dead
+
+ROUTER_MESSAGES_RECEIVED = counter('router_messages_received_total', 'Messages received from the frontend', ['router'])
+ROUTER_TASKS_RECEIVED = counter('router_tasks_received_total', 'Tasks received from the frontend', ['router'])
+ROUTER_TASKS_FORWARDED = counter('router_tasks_forwarded_total', 'Tasks handed to a worker', ['router'])
+ROUTER_QUEUED_TASKS = gauge('router_queued_tasks', 'Tasks waiting in the router for a free worker slot', ['router'])
+ROUTER_FREE_SLOTS = gauge('router_free_worker_slots', 'Free task slots announced by the workers', ['router'])
+ROUTER_QUEUE_SECONDS = histogram('router_queue_seconds', 'Time tasks waited in the router for a free worker slot', ['router'])
+
+
+class WorkerQueue:
+    """
+    Router side bookkeeping: free slots announced by workers, least recently used first.
+    """
+    def __init__(self):
+        self.slots = deque()  # worker identities, once per free slot
+        self.expiry = {}  # worker identity -> time after which it is considered dead
+
+    def ready(self, worker_id):
+        self.slots.append(worker_id)
+        self.refresh(worker_id)
+
+    def refresh(self, worker_id):
+        self.expiry[worker_id] = time.time() + HEARTBEAT_INTERVAL * HEARTBEAT_LIVENESS
+
+    def next(self):
+        return self.slots.popleft()
+
+    def remove(self, worker_id):
+        self.slots = deque(w for w in self.slots if w != worker_id)
+        self.expiry.pop(worker_id, None)
+
+    def idle_workers(self):
+        return set(self.slots)
+
+    def purge(self):
+        now = time.time()
+        for worker_id in list(self.expiry):
+            if worker_id not in self.slots:
+                # Busy workers don't heartbeat, they come back with READY
+                del self.expiry[worker_id]
+            elif self.expiry[worker_id] < now:
+                logging.warning(f"Worker {worker_id} missed its heartbeats, dropping its free slots")
+                self.remove(worker_id)
+
+    def __len__(self):
+        return len(self.slots)
+
+
+def split_tasks(message):
+    """
+    A client may send several tasks as one multipart message: [client_id, task, task, ...].
+    Workers expect one task per message, so it is split into [client_id, task] messages.
+    """
+    client_id, tasks = message[0], message[1:]
+    return [[client_id, task] for task in tasks]
+
+
+def lru_broker(frontend, backend, name='router'):
+    """
+    Forwards every message from the frontend to a worker with a free slot on the backend ROUTER.
+    Messages are queued in the router while all workers are busy.
+    The backend socket must have been created with ROUTER_MANDATORY set.
+    name labels the metrics of this router.
+    """
+    workers = WorkerQueue()
+    pending = deque()  # (queued at, task message)
+
+    poller = zmq.Poller()
+    poller.register(frontend, zmq.POLLIN)
+    poller.register(backend, zmq.POLLIN)
+
+    heartbeat_at = time.time() + HEARTBEAT_INTERVAL
+
+    while True:
+        events = dict(poller.poll(int(HEARTBEAT_INTERVAL * 1000)))
+
+        if events.get(backend) == zmq.POLLIN:
+            frames = backend.recv_multipart()
+            worker_id, control = frames[0], frames[1:]
+            if control == [READY]:
+                workers.ready(worker_id)
+            elif control == [HEARTBEAT]:
+                workers.refresh(worker_id)
+            else:
+                logging.error(f"Invalid message from worker {worker_id}: {control}")
+
+        if events.get(frontend) == zmq.POLLIN:
+            message = frontend.recv_multipart()
+            logging.info(f"Received message from frontend: {message}")
+            tasks = split_tasks(message)
+            queued_at = time.time()
+            pending.extend((queued_at, task) for task in tasks)
+            ROUTER_MESSAGES_RECEIVED.inc(router=name)
+            ROUTER_TASKS_RECEIVED.inc(len(tasks), router=name)
+
+        # Hand queued tasks to the least recently used workers with a free slot
+        while pending and workers:
+            worker_id = workers.next()
+            try:
+                backend.send_multipart([worker_id] + pending[0][1])
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EHOSTUNREACH:
+                    raise
+                logging.warning(f"Worker {worker_id} is gone, dropping its free slots")
+                workers.remove(worker_id)
+                continue
+            queued_at, _ = pending.popleft()
+            ROUTER_TASKS_FORWARDED.inc(router=name)
+            ROUTER_QUEUE_SECONDS.observe(time.time() - queued_at, router=name)
+            logging.info(f"Forwarded message to worker {worker_id}, {len(pending)} still queued")
+
+        if time.time() >= heartbeat_at:
+            for worker_id in workers.idle_workers():
+                try:
+                    backend.send_multipart([worker_id, HEARTBEAT])
+                except zmq.ZMQError as e:
+                    if e.errno != zmq.EHOSTUNREACH:
+                        raise
+                    workers.remove(worker_id)
+            heartbeat_at = time.time() + HEARTBEAT_INTERVAL
+
+        workers.purge()
+
+        ROUTER_QUEUED_TASKS.set(len(pending), router=name)
+        ROUTER_FREE_SLOTS.set(len(workers), router=name)
+
+
+class WorkerConnection:
+    """
+    Worker side of the protocol: a DEALER connection to a router that announces free task slots.
+    In 'roundrobin' mode it is a plain DEALER and the router pushes tasks regardless of load.
+    """
+    def __init__(self, context, endpoint, capacity=1):
+        self.context = context
+        self.endpoint = endpoint
+        self.free_slots = capacity
+        self.socket = None
+        self.connect()
+
+    def connect(self):
+        if self.socket is not None:
+            self.socket.setsockopt(zmq.LINGER, 0)
+            self.socket.close()
+
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.connect(self.endpoint)
+
+        self.liveness = HEARTBEAT_LIVENESS
+        self.heartbeat_at = time.time() + HEARTBEAT_INTERVAL
+
+        if WORKER_DISPATCH == 'lru':
+            for _ in range(self.free_slots):
+                self.socket.send(READY)
+
+    def task_done(self):
+        # Announce the freed slot so the router can send the next task
+        self.free_slots += 1
+        if WORKER_DISPATCH == 'lru':
+            self.socket.send(READY)
+            self.liveness = HEARTBEAT_LIVENESS
+
+    def recv_task(self, timeout=None):
+        """
+        Returns the frames of the next task, or None if timeout (seconds) elapses first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            wait = HEARTBEAT_INTERVAL
+            if deadline is not None:
+                wait = max(0, min(wait, deadline - time.time()))
+
+            if self.socket.poll(int(wait * 1000), zmq.POLLIN):
+                frames = self.socket.recv_multipart()
+                self.liveness = HEARTBEAT_LIVENESS
+                if frames == [HEARTBEAT]:
+                    continue
+                self.free_slots -= 1
+                return frames
+
+            # The router only heartbeats workers that have a free slot
+            if WORKER_DISPATCH == 'lru' and self.free_slots > 0:
+                if time.time() >= self.heartbeat_at:
+                    self.socket.send(HEARTBEAT)
+                    self.heartbeat_at = time.time() + HEARTBEAT_INTERVAL
+                    self.liveness -= 1
+                    if self.liveness <= 0:
+                        logging.warning(f"Router at {self.endpoint} is not responding, reconnecting")
+                        self.connect()
+
+            if deadline is not None and time.time() >= deadline:
+                return None
+
+    def close(self):
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.close()